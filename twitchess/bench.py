@@ -0,0 +1,298 @@
+"""
+Play queue benchmark. Simulated players play random games against fake
+engines (see engines/fakes) through a PlayQueue, so engine drivers and
+ActionManager changes can be measured without chess engines installed.
+Reports moves per second, move and board lookup latency percentiles seen
+by players, queue wait and engine latency, scheduler wait per command
+class, and threads, file descriptors and RSS of the
+queue process and engine processes (read from /proc).
+
+Usage:
+    python -m twitchess.bench --engine gnuchess --players 50 --moves 20
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import random
+import threading
+from optparse import OptionParser
+
+from twitchess import settings
+from twitchess.board import Board
+from twitchess.stats import Histogram
+from twitchess.playqueue import PlayQueue
+from twitchess.scheduler import CLASSES, SCHEDULERS
+from twitchess.exceptions import InvalidMove
+from twitchess.engines import fakes
+from twitchess.engines.uci import UCIEngine
+from twitchess.engines.crafty import Crafty
+from twitchess.engines.gnuchess import GNUChess
+
+
+ENGINES = {'gnuchess': GNUChess, 'crafty': Crafty, 'uci': UCIEngine}
+
+
+def children(pid):
+    """Returns pids of @pid child processes."""
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as fobj:
+                stat = fobj.read()
+        except IOError: # process ended
+            continue
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            pids.append(int(name))
+    return pids
+
+
+def rss(pid):
+    """Returns @pid resident set size in kB."""
+    try:
+        with open('/proc/%d/status' % pid) as fobj:
+            for line in fobj:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError: # process ended
+        pass
+    return 0
+
+
+def resources():
+    """Returns dict with threads, open file descriptors and RSS of this
+    process and RSS and number of its child processes."""
+    pid = os.getpid()
+    engines = children(pid)
+    return {'threads': threading.active_count(),
+            'fds': len(os.listdir('/proc/self/fd')),
+            'rss': rss(pid),
+            'engines': len(engines),
+            'engines_rss': sum(rss(child) for child in engines)}
+
+
+class Sampler(threading.Thread):
+    """Samples resources each @interval seconds, keeps peak values."""
+    def __init__(self, interval=0.5):
+        super(Sampler, self).__init__(name='resources sampler')
+        self.interval = interval
+        self.peak = {}
+        self.stopped = threading.Event()
+
+    def sample(self):
+        for name, value in resources().iteritems():
+            self.peak[name] = max(self.peak.get(name, 0), value)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+class Player(threading.Thread):
+    """Simulated player, plays @moves random moves waiting @pause
+    milliseconds before each and looking the board up before @lookups
+    percent of them, a new game is started when a game ends or fails.
+    Move and lookup latencies are kept in latency and lookup_latency
+    lists."""
+    def __init__(self, name, queue, moves, seed=None, pause=0, lookups=0):
+        super(Player, self).__init__(name=name)
+        self.queue = queue
+        self.moves = moves
+        self.pause = pause / 1000.0
+        self.lookups = lookups
+        self.random = random.Random(seed)
+        self.latency = []
+        self.lookup_latency = []
+        self.played = 0
+        self.errors = 0
+        self.games = 0
+
+    def new_game(self):
+        """Starts a game, waits until its engine started."""
+        command = self.queue.new(self.name)
+        command.wait()
+        if command.error is not None:
+            raise command.error
+        self.games += 1
+        return Board()
+
+    def run(self):
+        board = self.new_game()
+        for i in xrange(self.moves):
+            move = self.random.choice(board.legal_moves())
+            time.sleep(self.pause)
+            if self.random.random() * 100 < self.lookups:
+                start = time.time()
+                self.queue.fen(self.name, None).wait()
+                self.lookup_latency.append((time.time() - start) * 1000.0)
+            start = time.time()
+            command = self.queue.move(self.name, board.san(move), None)
+            command.wait()
+            self.latency.append((time.time() - start) * 1000.0)
+            board.push(move)
+            self.played += 1
+            try:
+                if command.error is not None:
+                    raise command.error
+                if board.result() is not None: # result is game outcome
+                    pass
+                elif command.result:
+                    board.push(board.parse(command.result))
+                else: # no reply, game is on
+                    raise InvalidMove, 'missing reply'
+            except Exception:
+                self.errors += 1
+                board = None
+            if board is None or board.result() is not None:
+                self.queue.remove(self.name).wait()
+                board = self.new_game()
+        self.queue.remove(self.name).wait()
+
+
+def run(engine='gnuchess', players=10, moves=20, think=0, noise=0,
+        board=False, seed=None, pause=0, lookups=0):
+    """Runs benchmark, returns results dict."""
+    if engine == 'uci':
+        args = ['--think', str(think), '--info', str(max(1, noise))]
+    else:
+        args = ['--think', str(think), '--noise', str(noise)]
+        if board:
+            args.append('--board')
+    engine_class = fakes.engine(ENGINES[engine], engine, *args)
+
+    sampler = Sampler()
+    sampler.start()
+    started = time.time()
+    queue = PlayQueue(engine_class)
+    threads = [Player('player%d' % i, queue, moves,
+                      None if seed is None else seed + i, pause, lookups)
+                    for i in xrange(players)]
+    for player in threads:
+        player.start()
+    for player in threads:
+        player.join()
+    elapsed = time.time() - started
+    stats = queue.stats()
+    sampler.stop()
+    queue.end()
+
+    latency = Histogram(players * moves)
+    lookup_latency = Histogram(players * moves)
+    for player in threads:
+        for value in player.latency:
+            latency.add(value)
+        for value in player.lookup_latency:
+            lookup_latency.add(value)
+    played = sum(player.played for player in threads)
+    queue_latency = stats['latency'].get(engine_class.__name__, {})\
+                                    .get('Move', {})
+    return {'engine': engine, 'players': players, 'moves': played,
+            'games': sum(player.games for player in threads),
+            'errors': sum(player.errors for player in threads),
+            'elapsed': elapsed,
+            'moves_per_second': played / elapsed,
+            'latency': latency.summary(),
+            'lookup_latency': lookup_latency.count and
+                                lookup_latency.summary(),
+            'wait': queue_latency.get('wait'),
+            'engine_latency': queue_latency.get('engine'),
+            'scheduler': stats['scheduler'],
+            'speculation': dict(stats['counters'], hit_rate=
+                                stats['gauges']['speculation_hit_rate']),
+            'peak': sampler.peak}
+
+
+def report(results, out=sys.stdout):
+    """Prints benchmark @results."""
+    def latency(summary):
+        if not summary:
+            return '-'
+        return 'p50 %.1fms  p95 %.1fms  p99 %.1fms  max %.1fms' % \
+                    (summary['p50'], summary['p95'], summary['p99'],
+                     summary['max'])
+    peak = results['peak']
+    print >>out, 'engine      %s' % results['engine']
+    print >>out, 'players     %d (%d games)' % (results['players'],
+                                                results['games'])
+    print >>out, 'moves       %d in %.2fs, %.1f moves/s, %d errors' % \
+                    (results['moves'], results['elapsed'],
+                     results['moves_per_second'], results['errors'])
+    print >>out, 'latency     %s' % latency(results['latency'])
+    print >>out, 'lookups     %s' % latency(results['lookup_latency'])
+    print >>out, 'queue wait  %s' % latency(results['wait'])
+    print >>out, 'engine io   %s' % latency(results['engine_latency'])
+    for klass in CLASSES:
+        summary = results['scheduler'][klass]['wait']
+        if summary['count']:
+            print >>out, '%-11s %s' % (klass[:11], latency(summary))
+    speculation = results['speculation']
+    if speculation.get('speculations'):
+        print >>out, 'speculation %d replies, %d hits, %d misses ' \
+                     '(%.1f%% hit rate)' % \
+                        (speculation['speculations'],
+                         speculation.get('speculation_hits', 0),
+                         speculation.get('speculation_misses', 0),
+                         speculation['hit_rate'] * 100)
+    print >>out, 'threads     %d peak' % peak.get('threads', 0)
+    print >>out, 'fds         %d peak' % peak.get('fds', 0)
+    print >>out, 'rss         %d kB queue, %d kB in %d engines (peak)' % \
+                    (peak.get('rss', 0), peak.get('engines_rss', 0),
+                     peak.get('engines', 0))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--engine', default='gnuchess',
+                      choices=sorted(ENGINES.keys()),
+                      help='Fake engine dialect (%s)' % \
+                                ', '.join(sorted(ENGINES.keys())))
+    parser.add_option('--players', type='int', default=10,
+                      help='Concurrent players')
+    parser.add_option('--moves', type='int', default=20,
+                      help='Moves played by each player')
+    parser.add_option('--think', type='int', default=0,
+                      help='Engine think time in milliseconds')
+    parser.add_option('--noise', type='int', default=0,
+                      help='Engine output lines per move')
+    parser.add_option('--board', action='store_true', default=False,
+                      help='Engine prints board after each move')
+    parser.add_option('--workers', type='int',
+                      default=settings.PLAYQUEUE_WORKERS,
+                      help='Play queue workers')
+    parser.add_option('--pool', type='int', default=settings.ENGINE_POOL_MAX,
+                      help='Max idle engine processes')
+    parser.add_option('--multiplex', action='store_true',
+                      default=settings.ENGINE_MULTIPLEX,
+                      help='Lease engine processes for each move')
+    parser.add_option('--pause', type='int', default=0,
+                      help='Player think time in milliseconds')
+    parser.add_option('--speculate', type='int',
+                      default=settings.SPECULATE_MOVES,
+                      help='Player moves speculated after each engine move')
+    parser.add_option('--lookups', type='int', default=0,
+                      help='Percent of moves preceded by a board lookup')
+    parser.add_option('--scheduler', default=settings.PLAYQUEUE_SCHEDULER,
+                      choices=sorted(SCHEDULERS.keys()),
+                      help='Play queue scheduler (%s)' % \
+                                ', '.join(sorted(SCHEDULERS.keys())))
+    parser.add_option('--seed', type='int', default=None,
+                      help='Random seed for players moves')
+    options, args = parser.parse_args()
+
+    settings.PLAYQUEUE_WORKERS = options.workers
+    settings.ENGINE_POOL_MAX = options.pool
+    settings.ENGINE_MULTIPLEX = options.multiplex
+    settings.SPECULATE_MOVES = options.speculate
+    settings.PLAYQUEUE_SCHEDULER = options.scheduler
+    report(run(options.engine, options.players, options.moves,
+               options.think, options.noise, options.board, options.seed,
+               options.pause, options.lookups))
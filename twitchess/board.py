@@ -0,0 +1,501 @@
+"""
+In-process chess board, used to validate moves before they reach an
+engine process.
+
+Board is represented as a 0x88 array, squares are indexed as
+rank * 16 + file (a1 = 0, h1 = 7, a8 = 112), an index is off the board
+when index & 0x88 is not zero. Pieces are stored as FEN chars, uppercase
+for white and lowercase for black, empty squares are None.
+
+Moves are (from, to, promotion) tuples, promotion is a lowercase piece
+char or None.
+"""
+import re
+
+from twitchess.exceptions import InvalidMove
+
+
+STARTING_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+WHITE, BLACK = 'w', 'b'
+
+KNIGHT_STEPS = (33, 31, 18, 14, -33, -31, -18, -14)
+BISHOP_STEPS = (17, 15, -17, -15)
+ROOK_STEPS   = (16, -16, 1, -1)
+KING_STEPS   = BISHOP_STEPS + ROOK_STEPS
+PROMOTIONS   = 'qrbn'
+
+# castling right -> (king from, king to, rook from, rook to)
+CASTLING = {'K': (4, 6, 7, 5),
+            'Q': (4, 2, 0, 3),
+            'k': (116, 118, 119, 117),
+            'q': (116, 114, 112, 115)}
+# squares whose pieces are tied to castling rights
+CASTLING_SQUARES = {0: 'Q', 4: 'KQ', 7: 'K', 112: 'q', 116: 'kq', 119: 'k'}
+
+# move notations
+COORD_RE  = re.compile('^([a-h][1-8])[-x]?([a-h][1-8])=?([qrbnQRBN])?$')
+SAN_RE    = re.compile('^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])'
+                       '(?:=?([QRBNqrbn]))?$')
+CASTLE_RE = re.compile('^([O0]-[O0])(-[O0])?$')
+SUFFIX_RE = re.compile('[+#!?]+$')
+
+
+def square(name):
+    """Returns 0x88 index for square @name (like e4)."""
+    return (int(name[1]) - 1) * 16 + ord(name[0]) - ord('a')
+
+
+def square_name(index):
+    """Returns name for 0x88 square @index."""
+    return 'abcdefgh'[index & 7] + str((index >> 4) + 1)
+
+
+def encode_move(move):
+    """Returns 16 bits code of @move: from and to squares (0-63) in the
+    low 12 bits and promotion (PROMOTIONS index + 1, 0 if none) above."""
+    start, end, promotion = move
+    code = (start >> 4) * 8 + (start & 7) | ((end >> 4) * 8 + (end & 7)) << 6
+    if promotion:
+        code |= (PROMOTIONS.index(promotion) + 1) << 12
+    return code
+
+
+def decode_move(code):
+    """Returns (start, end, promotion) move for @code, see encode_move."""
+    start, end, promotion = code & 63, code >> 6 & 63, code >> 12
+    return ((start >> 3) * 16 + (start & 7), (end >> 3) * 16 + (end & 7),
+            PROMOTIONS[promotion - 1] if promotion else None)
+
+
+def color(piece):
+    """Returns piece color."""
+    return WHITE if piece.isupper() else BLACK
+
+
+def opponent(side):
+    """Returns opponent color."""
+    return BLACK if side == WHITE else WHITE
+
+
+class Board(object):
+    """Chess position updated incrementally on each move."""
+    def __init__(self, fen=STARTING_FEN):
+        self.set_fen(fen)
+
+    def set_fen(self, fen):
+        """Sets position from FEN notation."""
+        try:
+            fields = fen.split()
+            placement, turn = fields[0], fields[1]
+            castling = fields[2] if len(fields) > 2 else '-'
+            ep = fields[3] if len(fields) > 3 else '-'
+            halfmove = int(fields[4]) if len(fields) > 4 else 0
+            fullmove = int(fields[5]) if len(fields) > 5 else 1
+            rows = placement.split('/')
+            if len(rows) != 8 or turn not in (WHITE, BLACK):
+                raise ValueError
+            squares = [None] * 128
+            kings = {}
+            for rank, row in zip(xrange(7, -1, -1), rows):
+                col = 0
+                for char in row:
+                    if char.isdigit():
+                        col += int(char)
+                    elif char.lower() in 'pnbrqk' and col < 8:
+                        squares[rank * 16 + col] = char
+                        if char.lower() == 'k':
+                            kings[color(char)] = rank * 16 + col
+                        col += 1
+                    else:
+                        raise ValueError
+                if col != 8:
+                    raise ValueError
+            if len(kings) != 2:
+                raise ValueError
+        except (ValueError, IndexError):
+            raise InvalidMove, 'Invalid FEN %s' % fen
+        self.squares = squares
+        self.kings = kings
+        self.turn = turn
+        self.castling = '' if castling == '-' else castling
+        self.ep = None if ep == '-' else square(ep)
+        self.halfmove = halfmove
+        self.fullmove = fullmove
+        self._fen = None
+
+    def fen(self):
+        """Returns FEN notation for current position, cached until the
+        position changes."""
+        if self._fen is None:
+            rows = []
+            for rank in xrange(7, -1, -1):
+                row, empty = '', 0
+                for index in xrange(rank * 16, rank * 16 + 8):
+                    piece = self.squares[index]
+                    if piece is None:
+                        empty += 1
+                    else:
+                        if empty:
+                            row += str(empty)
+                            empty = 0
+                        row += piece
+                if empty:
+                    row += str(empty)
+                rows.append(row)
+            ep = square_name(self.ep) if self.ep is not None else '-'
+            self._fen = '%s %s %s %s %d %d' % ('/'.join(rows), self.turn,
+                                               self.castling or '-', ep,
+                                               self.halfmove, self.fullmove)
+        return self._fen
+
+    def copy(self):
+        """Returns a copy of this board."""
+        board = Board.__new__(Board)
+        board.__dict__.update(self.__dict__)
+        board.squares = self.squares[:]
+        board.kings = self.kings.copy()
+        return board
+
+    def attacked(self, index, by):
+        """Returns True if square @index is attacked by @by side."""
+        squares = self.squares
+        # pawns
+        if by == WHITE:
+            pawn, steps = 'P', (-15, -17)
+        else:
+            pawn, steps = 'p', (15, 17)
+        for step in steps:
+            target = index + step
+            if not target & 0x88 and squares[target] == pawn:
+                return True
+        # knights and king
+        knight, king = ('N', 'K') if by == WHITE else ('n', 'k')
+        for step in KNIGHT_STEPS:
+            target = index + step
+            if not target & 0x88 and squares[target] == knight:
+                return True
+        for step in KING_STEPS:
+            target = index + step
+            if not target & 0x88 and squares[target] == king:
+                return True
+        # sliders
+        if by == WHITE:
+            diagonal, straight = 'BQ', 'RQ'
+        else:
+            diagonal, straight = 'bq', 'rq'
+        for steps, pieces in ((BISHOP_STEPS, diagonal),
+                              (ROOK_STEPS, straight)):
+            for step in steps:
+                target = index + step
+                while not target & 0x88:
+                    piece = squares[target]
+                    if piece is not None:
+                        if piece in pieces:
+                            return True
+                        break
+                    target += step
+        return False
+
+    def in_check(self, side=None):
+        """Returns True if @side (side to move by default) is in check."""
+        side = side or self.turn
+        return self.attacked(self.kings[side], opponent(side))
+
+    def pseudo_moves(self):
+        """Generates moves for side to move without checking if own king
+        is left in check."""
+        squares = self.squares
+        turn = self.turn
+        for index in xrange(128):
+            if index & 0x88:
+                continue
+            piece = squares[index]
+            if piece is None or color(piece) != turn:
+                continue
+            kind = piece.lower()
+            if kind == 'p':
+                for move in self._pawn_moves(index):
+                    yield move
+                continue
+            if kind == 'n':
+                steps, slide = KNIGHT_STEPS, False
+            elif kind == 'b':
+                steps, slide = BISHOP_STEPS, True
+            elif kind == 'r':
+                steps, slide = ROOK_STEPS, True
+            elif kind == 'q':
+                steps, slide = KING_STEPS, True
+            else:
+                steps, slide = KING_STEPS, False
+            for step in steps:
+                target = index + step
+                while not target & 0x88:
+                    other = squares[target]
+                    if other is not None:
+                        if color(other) != turn:
+                            yield (index, target, None)
+                        break
+                    yield (index, target, None)
+                    if not slide:
+                        break
+                    target += step
+            if kind == 'k':
+                for move in self._castling_moves():
+                    yield move
+
+    def _pawn_moves(self, index):
+        """Generates pawn moves from @index."""
+        squares = self.squares
+        if self.turn == WHITE:
+            step, start, last, captures = 16, 1, 7, (15, 17)
+        else:
+            step, start, last, captures = -16, 6, 0, (-15, -17)
+        targets = []
+        target = index + step
+        if not target & 0x88 and squares[target] is None:
+            targets.append(target)
+            if index >> 4 == start and squares[target + step] is None:
+                targets.append(target + step)
+        for capture in captures:
+            target = index + capture
+            if target & 0x88:
+                continue
+            other = squares[target]
+            if (other is not None and color(other) != self.turn) or \
+               target == self.ep:
+                targets.append(target)
+        for target in targets:
+            if target >> 4 == last:
+                for promotion in PROMOTIONS:
+                    yield (index, target, promotion)
+            else:
+                yield (index, target, None)
+
+    def _castling_moves(self):
+        """Generates castling moves, king can't castle out of, through or
+        into check."""
+        squares = self.squares
+        enemy = opponent(self.turn)
+        rights = 'KQ' if self.turn == WHITE else 'kq'
+        for right in rights:
+            if right not in self.castling:
+                continue
+            king_from, king_to, rook_from, rook_to = CASTLING[right]
+            low, high = sorted((king_from, rook_from))
+            if any(squares[index] is not None
+                        for index in xrange(low + 1, high)):
+                continue
+            step = 1 if king_to > king_from else -1
+            path = xrange(king_from, king_to + step, step)
+            if any(self.attacked(index, enemy) for index in path):
+                continue
+            yield (king_from, king_to, None)
+
+    def make(self, move):
+        """Applies @move without validation. Returns undo information to
+        be passed to unmake."""
+        squares = self.squares
+        start, end, promotion = move
+        piece = squares[start]
+        captured_at = end
+        if piece in 'Pp' and end == self.ep: # en passant capture
+            captured_at = end - 16 if piece == 'P' else end + 16
+        captured = squares[captured_at]
+        undo = (move, piece, captured, captured_at, self.castling, self.ep,
+                self.halfmove, self.fullmove, self._fen)
+        self._fen = None
+
+        squares[captured_at] = None
+        squares[start] = None
+        if promotion:
+            piece_to = promotion.upper() if piece == 'P' else promotion
+        else:
+            piece_to = piece
+        squares[end] = piece_to
+
+        if piece in 'Kk':
+            self.kings[color(piece)] = end
+            if abs(end - start) == 2: # castling, move rook too
+                for right, (king_from, king_to, rook_from, rook_to) in \
+                        CASTLING.iteritems():
+                    if king_from == start and king_to == end:
+                        squares[rook_to] = squares[rook_from]
+                        squares[rook_from] = None
+
+        if self.castling:
+            for index in (start, end):
+                for right in CASTLING_SQUARES.get(index, ''):
+                    self.castling = self.castling.replace(right, '')
+
+        if piece in 'Pp' and abs(end - start) == 32:
+            self.ep = (start + end) / 2
+        else:
+            self.ep = None
+        if piece in 'Pp' or captured is not None:
+            self.halfmove = 0
+        else:
+            self.halfmove += 1
+        if self.turn == BLACK:
+            self.fullmove += 1
+        self.turn = opponent(self.turn)
+        return undo
+
+    def unmake(self, undo):
+        """Reverts a move applied with make."""
+        move, piece, captured, captured_at, castling, ep, halfmove, \
+            fullmove, self._fen = undo
+        start, end, promotion = move
+        squares = self.squares
+        self.turn = opponent(self.turn)
+        squares[start] = piece
+        squares[end] = None
+        squares[captured_at] = captured
+        if piece in 'Kk':
+            self.kings[color(piece)] = start
+            if abs(end - start) == 2:
+                for king_from, king_to, rook_from, rook_to in \
+                        CASTLING.itervalues():
+                    if king_from == start and king_to == end:
+                        squares[rook_from] = squares[rook_to]
+                        squares[rook_to] = None
+        self.castling = castling
+        self.ep = ep
+        self.halfmove = halfmove
+        self.fullmove = fullmove
+
+    def is_legal(self, move):
+        """Returns True if pseudo legal @move doesn't leave own king in
+        check."""
+        side = self.turn
+        undo = self.make(move)
+        legal = not self.in_check(side)
+        self.unmake(undo)
+        return legal
+
+    def legal_moves(self):
+        """Returns list of legal moves."""
+        return [move for move in self.pseudo_moves() if self.is_legal(move)]
+
+    def has_moves(self):
+        """Returns True if side to move has any legal move."""
+        for move in self.pseudo_moves():
+            if self.is_legal(move):
+                return True
+        return False
+
+    def is_checkmate(self):
+        """Returns True if side to move is mated."""
+        return self.in_check() and not self.has_moves()
+
+    def is_stalemate(self):
+        """Returns True if side to move has no moves and is not in
+        check."""
+        return not self.in_check() and not self.has_moves()
+
+    def result(self):
+        """Returns game result (1-0, 0-1 or 1/2-1/2) or None if game is
+        still on."""
+        if self.has_moves():
+            return None
+        if self.in_check():
+            return '0-1' if self.turn == WHITE else '1-0'
+        return '1/2-1/2'
+
+    def parse(self, text):
+        """Returns legal move for @text in coordinate (e2e4, e7e8q) or SAN
+        (e4, Nbd2, exd5, e8=Q, O-O) notation. Raises InvalidMove if text
+        is not a legal move in current position."""
+        text = SUFFIX_RE.sub('', text.strip())
+
+        match = COORD_RE.match(text)
+        if match:
+            start, end, promotion = match.groups()
+            candidates = [(square(start), square(end),
+                           promotion and promotion.lower())]
+            return self._legal(candidates, text)
+
+        match = CASTLE_RE.match(text)
+        if match:
+            long = match.group(2) is not None
+            right = ('Q' if long else 'K')
+            if self.turn == BLACK:
+                right = right.lower()
+            king_from, king_to = CASTLING[right][:2]
+            return self._legal([(king_from, king_to, None)], text)
+
+        match = SAN_RE.match(text)
+        if match:
+            kind, file, rank, end, promotion = match.groups()
+            kind = (kind or 'P').lower()
+            if self.turn == WHITE:
+                kind = kind.upper()
+            end = square(end)
+            promotion = promotion and promotion.lower()
+            candidates = []
+            for move in self.pseudo_moves():
+                start = move[0]
+                if move[1] != end or self.squares[start] != kind or \
+                   move[2] != promotion:
+                    continue
+                if file and square_name(start)[0] != file:
+                    continue
+                if rank and square_name(start)[1] != rank:
+                    continue
+                candidates.append(move)
+            return self._legal(candidates, text)
+
+        raise InvalidMove, '%s is an invalid move' % text
+
+    def _legal(self, candidates, text):
+        """Returns the only legal move in @candidates."""
+        pseudo = set(self.pseudo_moves()) if candidates else set()
+        legal = [move for move in candidates
+                    if move in pseudo and self.is_legal(move)]
+        if len(legal) != 1: # illegal or ambiguous
+            raise InvalidMove, '%s is an invalid move' % text
+        return legal[0]
+
+    def push(self, move):
+        """Applies a legal move to the position."""
+        self.make(move)
+
+    def san(self, move):
+        """Returns SAN notation for legal @move."""
+        start, end, promotion = move
+        piece = self.squares[start]
+        kind = piece.upper()
+        if kind == 'K' and abs(end - start) == 2:
+            text = 'O-O' if end > start else 'O-O-O'
+        elif kind == 'P':
+            text = ''
+            if start & 7 != end & 7: # capture
+                text = square_name(start)[0] + 'x'
+            text += square_name(end)
+            if promotion:
+                text += '=' + promotion.upper()
+        else:
+            others = [other for other in self.legal_moves()
+                        if other[1] == end and other[0] != start and
+                           self.squares[other[0]] == piece]
+            text = kind
+            if others:
+                if all(other[0] & 7 != start & 7 for other in others):
+                    text += square_name(start)[0]
+                elif all(other[0] >> 4 != start >> 4 for other in others):
+                    text += square_name(start)[1]
+                else:
+                    text += square_name(start)
+            if self.squares[end] is not None:
+                text += 'x'
+            text += square_name(end)
+        undo = self.make(move)
+        if self.in_check():
+            text += '#' if not self.has_moves() else '+'
+        self.unmake(undo)
+        return text
+
+    def coordinate(self, move):
+        """Returns coordinate notation for @move (e2e4, e7e8q)."""
+        start, end, promotion = move
+        return square_name(start) + square_name(end) + (promotion or '')
@@ -0,0 +1,180 @@
+"""
+Engine replies cache. Replies are keyed by engine configuration and
+position, so the same position at the same engine settings is answered
+once for every game. Cache has an in-memory LRU tier and an optional
+on-disk tier that survives restarts, and can be seeded from an opening
+book file.
+"""
+from __future__ import with_statement
+
+import anydbm
+import threading
+from collections import OrderedDict
+
+from twitchess import settings
+from twitchess.board import Board
+from twitchess.exceptions import InvalidMove
+
+
+class LRUCache(object):
+    """Bounded mapping, least recently used keys are dropped first."""
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        """Returns value for @key and marks it as recently used."""
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        """Stores @value for @key, drops least recently used key if full."""
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        """Drops every key."""
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+def position_key(fen):
+    """Returns FEN without move counters."""
+    return ' '.join(fen.split()[:4])
+
+
+class ReplyCache(object):
+    """
+    Engine replies cache.
+
+    @size       in-memory entries
+    @path       on-disk database file or None to disable disk tier
+    @book       opening book file used to seed replies
+    """
+    def __init__(self, size=10000, path=None, book=None):
+        self.memory = LRUCache(size)
+        self.lock = threading.Lock()
+        self.disk = anydbm.open(path, 'c') if path else None
+        self.book = {}
+        self.hits = 0 # replies served from memory
+        self.disk_hits = 0 # replies served from disk
+        self.book_hits = 0 # replies served from opening book
+        self.misses = 0
+        self.stores = 0
+        if book:
+            self.load_book(book)
+
+    def key(self, engine, fen):
+        """Returns cache key for @engine configuration and position."""
+        return '%s|%s' % (engine, position_key(fen))
+
+    def get(self, engine, fen):
+        """Returns cached reply for @engine settings string in position
+        @fen, or None."""
+        key = self.key(engine, fen)
+        reply = self.memory.get(key)
+        if reply is not None:
+            with self.lock:
+                self.hits += 1
+            return reply
+
+        if self.disk is not None:
+            with self.lock:
+                reply = self.disk.get(key)
+                if reply is not None:
+                    self.disk_hits += 1
+            if reply is not None:
+                self.memory.set(key, reply)
+                return reply
+
+        reply = self.book.get(position_key(fen))
+        with self.lock:
+            if reply is not None:
+                self.book_hits += 1
+            else:
+                self.misses += 1
+        return reply
+
+    def set(self, engine, fen, reply):
+        """Stores @reply for @engine settings string in position @fen."""
+        key = self.key(engine, fen)
+        self.memory.set(key, reply)
+        with self.lock:
+            self.stores += 1
+            if self.disk is not None:
+                self.disk[key] = reply
+                if hasattr(self.disk, 'sync'):
+                    self.disk.sync()
+
+    def load_book(self, path):
+        """
+        Loads opening book from file at @path. Each line is a moves
+        sequence from starting position, last move is the reply for the
+        position reached by the previous ones. Lines starting with # are
+        comments.
+            e4 e5
+            e4 c5 Nf3 d6
+        """
+        with open(path) as fobj:
+            for line in fobj:
+                moves = line.split('#')[0].split()
+                if len(moves) < 2:
+                    continue
+                board = Board()
+                try:
+                    for move in moves[:-1]:
+                        board.push(board.parse(move))
+                    reply = board.san(board.parse(moves[-1]))
+                except InvalidMove: # skip broken lines
+                    continue
+                self.book[position_key(board.fen())] = reply
+
+    def stats(self):
+        """Returns cache counters."""
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.book_hits + \
+                      self.misses
+            return {'size': len(self.memory),
+                    'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'book_hits': self.book_hits,
+                    'misses': self.misses,
+                    'stores': self.stores,
+                    'hit_rate': lookups and \
+                            float(lookups - self.misses) / lookups}
+
+    def close(self):
+        """Closes disk tier."""
+        with self.lock:
+            if self.disk is not None:
+                self.disk.close()
+                self.disk = None
+
+
+REPLY_CACHE = None
+REPLY_CACHE_LOCK = threading.Lock()
+
+def reply_cache():
+    """Returns shared replies cache configured from settings or None if
+    disabled."""
+    global REPLY_CACHE
+    if not settings.REPLY_CACHE_SIZE:
+        return None
+    with REPLY_CACHE_LOCK:
+        if REPLY_CACHE is None:
+            REPLY_CACHE = ReplyCache(settings.REPLY_CACHE_SIZE,
+                                     settings.REPLY_CACHE_FILE,
+                                     settings.REPLY_CACHE_BOOK)
+        return REPLY_CACHE
@@ -0,0 +1,103 @@
+"""
+Crash-safe checkpoint of the last processed mention id.
+
+Checkpoint file is replaced atomically (write temporary file, fsync and
+rename) every N messages or T seconds. Messages processed since last
+checkpoint are appended to a journal, on restart messages found in the
+journal are skipped so moves are not sent twice to the engines.
+"""
+from __future__ import with_statement
+
+import os
+import time
+
+
+class Checkpoint(object):
+    """
+    Last processed message id.
+
+    @path       checkpoint file, journal is stored at path + .journal
+    @every      messages processed between checkpoints
+    @interval   max seconds between checkpoints
+    """
+    def __init__(self, path, every=100, interval=30):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.every = every
+        self.interval = interval
+        self.lastid = None # checkpointed id
+        self.seen = set() # ids processed after checkpoint
+        self.last_commit = time.time()
+        self.load()
+        self.journal = open(self.journal_path, 'a')
+
+    def load(self):
+        """Reads checkpoint and journal files."""
+        try:
+            with open(self.path) as fobj:
+                self.lastid = int(fobj.readline())
+        except (IOError, ValueError): # missing or empty file
+            self.lastid = None
+        try:
+            with open(self.journal_path) as fobj:
+                for line in fobj:
+                    try:
+                        msgid = int(line)
+                    except ValueError: # partial line written on a crash
+                        continue
+                    if self.lastid is None or msgid > self.lastid:
+                        self.seen.add(msgid)
+        except IOError: # no journal
+            pass
+
+    def is_done(self, msgid):
+        """Returns True if message @msgid was already processed."""
+        return (self.lastid is not None and msgid <= self.lastid) or \
+               msgid in self.seen
+
+    def newest(self):
+        """Returns newest processed message id, checkpointed or not."""
+        ids = list(self.seen)
+        if self.lastid is not None:
+            ids.append(self.lastid)
+        return max(ids) if ids else None
+
+    def mark(self, msgids):
+        """Journals @msgids as processed, checkpoints if enough messages
+        or time passed since last checkpoint."""
+        msgids = [msgid for msgid in msgids if not self.is_done(msgid)]
+        if msgids:
+            self.journal.write(''.join('%d\n' % msgid for msgid in msgids))
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.seen.update(msgids)
+        if len(self.seen) >= self.every or \
+           time.time() - self.last_commit >= self.interval:
+            self.commit()
+
+    def commit(self):
+        """Atomically stores newest processed id and clears journal."""
+        self.last_commit = time.time()
+        if not self.seen:
+            return
+        lastid = self.newest()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fobj:
+            fobj.write(str(lastid))
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        os.rename(tmp_path, self.path)
+        fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try: # make rename durable
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.lastid = lastid
+        self.seen.clear()
+        self.journal.close()
+        self.journal = open(self.journal_path, 'w')
+
+    def close(self):
+        """Checkpoints and closes journal."""
+        self.commit()
+        self.journal.close()
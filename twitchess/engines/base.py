@@ -1,13 +1,52 @@
+from __future__ import with_statement
+
+import sys
+import time
+import threading
+from array import array
+from itertools import count
 from os.path import sep
 
-from twitchess.exceptions import InvalidMove, UnknowError
-from twitchess.engines.utils import SubProcess
+from twitchess import settings
+from twitchess.board import Board, WHITE, encode_move, decode_move
+from twitchess.cache import reply_cache
+from twitchess.exceptions import InvalidMove, UnknowError, EngineError, \
+                                 EngineTimeout, EngineDied
+from twitchess.engines.utils import get_pool, Matcher
+
+
+def engine_pool(path, args=None, setup=None, quit=None):
+    """Returns warm processes pool for engine configuration, pool sizes
+    are read from settings. Multiplexed games check processes in after
+    each move, so at least a process per worker is kept."""
+    max_size = settings.ENGINE_POOL_MAX
+    if settings.ENGINE_MULTIPLEX:
+        max_size = max(max_size, settings.PLAYQUEUE_WORKERS)
+    return get_pool(path, args, setup, quit, settings.ENGINE_POOL_MIN,
+                    max_size)
+
+
+# game keys, owners of engine processes
+GAME_KEYS = count(1)
+
+# piece values used to rank speculation candidates
+PIECE_VALUES = {'p': 1, 'n': 3, 'b': 3, 'r': 5, 'q': 9, 'k': 0}
+
+
+# game states
+ACTIVE    = 'active'
+FINISHED  = 'finished'  # game is over, kept until FINISHED_TIMEOUT
+ABANDONED = 'abandoned' # idle for ABANDON_TIMEOUT, about to be removed
+FAILED    = 'failed'    # engine failed to start, game was removed
 
 
 class ChessEngine(object):
     """Simple Chess Engine Protocol (tm) ;)."""
-    def __init__(self, players, path, args=None):
-        """Inits process"""
+    # engine process keeps no position between moves
+    stateless = False
+
+    def __init__(self, players, pool):
+        """Inits game played on processes checked out from @pool"""
         self.is_white = True # engines start with white user by default
         if not isinstance(players, tuple):
             self.multiplayer = False # single player mode
@@ -16,10 +55,39 @@ class ChessEngine(object):
             self.multiplayer = True # multiplayer mode
         self.white, self.black = players
         self.turn = self.white
-        self.path = path
-        self.args = args
-        self.moves = []
-        self.process = SubProcess(path, args)
+        self.path = pool.path
+        self.args = pool.args
+        self.plies = array('H') # encoded moves, see board.encode_move
+        self.board = Board()
+        self.state = ACTIVE
+        # think limits, engine settings override global settings
+        self.movetime = settings.ENGINE_MOVETIME
+        self.depth = settings.ENGINE_DEPTH
+        self.nodes = settings.ENGINE_NODES
+        self.limit(**settings.ENGINE_LIMITS.get(self.__class__.__name__, {}))
+        self.budget = None # movetime cap set by the play queue under load
+        self._limits = None # limits sent to the engine
+        self.process_pool = pool
+        self.last_active = time.time()
+        self.stale = False # engine process position is behind board
+        self.failures = () # engine errors caught by supervised()
+        self.times = None # running command timestamps, see Command
+        self.predicted = None # player move expected by the engine
+        # position after player move -> (reply, predicted player move)
+        self.speculations = {}
+        self.speculated = None # last move reply was speculated (True),
+                               # missed speculations (False) or neither
+        self.searching = False # speculative search running
+        self.stopped = False # speculative search was stopped
+        self._search_lock = threading.Lock()
+        self.key = GAME_KEYS.next()
+        self.ended = False # game ended or leaving the play queue
+        # multiplexed games lease a process for each engine move
+        self.multiplex = settings.ENGINE_MULTIPLEX
+        # engine process is checked out by start() or first engine
+        # command, so creating a game does no engine IO
+        self._process = None
+        self.new()
 
     def is_white_turn(self):
         """Return if next move corresponds to white player"""
@@ -33,54 +101,458 @@ class ChessEngine(object):
         """Switch turns"""
         self.turn = self.black if self.is_white_turn() else self.white
 
-    def move(self, pos):
+    def move(self, pos, budget=None):
         """Move method. Try to not override this, override do_move
-        instead."""
+        instead. Moves are validated against the board and reach the
+        engine in SAN whatever notation was used, engine is not asked
+        for a reply if player move ends the game, game outcome is
+        returned instead (see outcome()). @budget caps engine think time
+        in milliseconds."""
+        self.last_active = time.time()
+        self.budget = budget
         try:
-            result = self.do_move(pos)
+            move = self.board.parse(pos)
+            undo = self.board.make(move)
+            over = self.board.result() is not None
+            fen = self.board.fen()
+            self.board.unmake(undo)
+            if over and not self.multiplayer:
+                result = None
+            else:
+                result = self.reply(move, fen)
         except InvalidMove: # pretify error
             raise InvalidMove, '%s is an invalid move' % pos
+        reply = None
+        if result and not self.multiplayer: # nothing played if invalid
+            reply = self.parse_reply(move, result)
+        self.board.push(move)
+        self.plies.append(encode_move(move))
 
         if self.multiplayer:
-            if self.is_white_turn():
-                self.moves.append((pos, None))
-            else:
-                self.moves[-1] = (self.moves[-1][0], None)
             self.next_turn()
-        else:
-            self.moves.append((pos, result))
+        elif reply is not None:
+            self.board.push(reply)
+            self.plies.append(encode_move(reply))
+        if self.board.result() is not None:
+            self.state = FINISHED
+            if result is None and not self.multiplayer: # player won
+                result = self.outcome()
+        self.speculations = {} # replies for previous position
+        return result
+
+    @property
+    def moves(self):
+        """Returns moves as (white, black) SAN pairs, black move is None
+        if not played yet. Pairs are decoded from plies on each call."""
+        board = Board()
+        sans = []
+        for code in self.plies:
+            move = decode_move(code)
+            sans.append(board.san(move))
+            board.push(move)
+        if len(sans) % 2:
+            sans.append(None)
+        return zip(sans[::2], sans[1::2])
+
+    def move_count(self):
+        """Returns number of moves pairs, last one may be incomplete."""
+        return (len(self.plies) + 1) / 2
+
+    def replay(self, moves):
+        """Loads game from @moves pairs list, like moves attribute, used
+        to move a game between play queues. Engine process is synced on
+        next engine move."""
+        board = Board()
+        plies = array('H')
+        for pair in moves:
+            for pos in pair:
+                if pos:
+                    move = board.parse(pos)
+                    board.push(move)
+                    plies.append(encode_move(move))
+        self.board = board
+        self.plies = plies
+        self.speculations = {}
+        self.state = ACTIVE if board.result() is None else FINISHED
+        if self.multiplayer:
+            self.turn = self.white if board.turn == WHITE else self.black
+        self.stale = True
+
+    def is_over(self):
+        """Returns game result (1-0, 0-1 or 1/2-1/2) or None if game is
+        still on."""
+        return self.board.result()
+
+    def outcome(self):
+        """Returns game result and how it ended, like '1-0, checkmate',
+        or None if game is still on."""
+        result = self.board.result()
+        if result is None:
+            return None
+        return '%s, %s' % (result, 'stalemate' if result == '1/2-1/2'
+                                              else 'checkmate')
+
+    def memory(self):
+        """Returns approximate bytes used by game state, engine process
+        not included."""
+        board = self.board
+        return sys.getsizeof(self) + sys.getsizeof(self.__dict__) + \
+               sys.getsizeof(self.plies) + sys.getsizeof(board) + \
+               sys.getsizeof(board.__dict__) + sys.getsizeof(board.squares)
+
+    def reply(self, move, fen):
+        """Returns engine reply to player @move which leads to position
+        @fen. Replies are served from the shared replies cache when
+        possible, engine process is synced on next engine move. Engine
+        replies are validated before they are cached."""
+        self.predicted = None
+        self.speculated = None
+        if self.speculations:
+            speculation = self.speculations.get(fen)
+            self.speculated = speculation is not None
+            if speculation is not None:
+                if not self.stateless:
+                    self.stale = True # engine process played a candidate
+                result, self.predicted = speculation
+                return result
+
+        cache = None if self.multiplayer else reply_cache()
+        if cache is not None:
+            result = cache.get(self.cache_id(), fen)
+            if result is not None:
+                self.stale = True # engine process missed these moves
+                return result
+
+        san = self.board.san(move) # engines get normalized notation
+        started = time.time()
+        try:
+            result = self.supervised(lambda: self.do_move(san),
+                                     settings.ENGINE_RETRIES)
+        finally:
+            if self.multiplex: # give leased process back
+                self.hibernate()
+        searched = time.time() - started
+        if result and not self.multiplayer:
+            self.parse_reply(move, result)
+        if cache is not None and result and self.deterministic() and \
+           not self.capped(searched):
+            cache.set(self.cache_id(), fen, result)
         return result
 
+    def parse_reply(self, move, result):
+        """Returns engine reply @result to player @move as a board move.
+        Raises UnknowError if it isn't legal after @move, engine process
+        is then synced on next engine command."""
+        undo = self.board.make(move)
+        try:
+            return self.board.parse(result)
+        except InvalidMove:
+            self.stale = True # engine position is unknown
+            raise UnknowError, 'Unknow engine move %s' % result
+        finally:
+            self.board.unmake(undo)
+
+    def candidates(self, count):
+        """Returns up to @count likely player moves in current position:
+        move predicted by the engine, then captures of most valuable
+        pieces, checks and other moves in generation order."""
+        board = self.board
+        predicted = None
+        if self.predicted:
+            try:
+                predicted = board.parse(self.predicted)
+            except InvalidMove:
+                pass
+
+        def rank(move):
+            if move == predicted:
+                return -100
+            target = board.squares[move[1]]
+            if target is not None:
+                return -10 - PIECE_VALUES[target.lower()]
+            undo = board.make(move)
+            check = board.in_check()
+            board.unmake(undo)
+            return -1 if check else 0
+        return sorted(board.legal_moves(), key=rank)[:count]
+
+    def speculate(self, move, budget=None):
+        """Computes engine reply to candidate player @move without playing
+        it, reply is kept in speculations until next move. Returns True
+        if a reply was computed. A process checked out for the search is
+        given back, ended games are not searched."""
+        if self.ended:
+            return False
+        undo = self.board.make(move)
+        fen = self.board.fen()
+        over = self.board.result() is not None
+        self.board.unmake(undo)
+        if over or fen in self.speculations:
+            return False
+        self.budget = budget
+        predicted = self.predicted
+        leased = self.multiplex or self._process is None
+        with self._search_lock:
+            self.searching, self.stopped = True, False
+        try:
+            result = self.supervised(lambda: self.do_move(self.board.san(move)))
+        finally:
+            with self._search_lock:
+                self.searching = False
+            self.predicted, predicted = predicted, self.predicted
+            if not self.stateless: # engine process played the candidate
+                self.stale = True
+            if leased: # give process checked out for the search back
+                self.hibernate()
+        if not result or self.stopped: # stopped searches are weaker
+            return False
+        try:
+            self.parse_reply(move, result)
+        except UnknowError:
+            return False
+        self.speculations[fen] = (result, predicted)
+        return True
+
+    def stop(self):
+        """Stops running speculative search, its reply is dropped. Called
+        from other threads."""
+        with self._search_lock:
+            self.stopped = True
+            if self.searching and self._process is not None:
+                self.stop_search()
+
+    def stop_search(self):
+        """Asks engine process to cut current search short. Override in
+        engines that support it, don't use write() as it discards
+        output."""
+        pass
+
+    def supervised(self, action, retries=0):
+        """Runs @action, a function doing engine IO, on a synced engine
+        process. If the engine hangs or dies its process is replaced and
+        the game restored on the new one before retrying, up to @retries
+        times. Raises EngineError when out of retries. Every error is
+        added to failures, recovered or not."""
+        while True:
+            try:
+                if self.stale:
+                    self.sync()
+                return action()
+            except EngineError, e:
+                self.failures += (e,)
+                self.recover()
+                if not retries:
+                    raise
+                retries -= 1
+
+    def recover(self):
+        """Discards game engine process after it hung or died, game is
+        restored on a new process by next engine command."""
+        with self._search_lock:
+            process, self._process = self._process, None
+        if process is not None:
+            self.process_pool.discard(process)
+        self.stale = True
+
+    def is_dead(self):
+        """Returns True if game engine process ended."""
+        process = self._process
+        return process is not None and not process.is_alive()
+
+    def timeout(self):
+        """Returns seconds the engine has to answer, think time plus
+        ENGINE_TIMEOUT."""
+        movetime = self.limits()[0]
+        return settings.ENGINE_TIMEOUT + (movetime or 0) / 1000.0
+
+    def cache_id(self):
+        """Returns engine configuration string used in cache keys. Game
+        limits are used, budget caps not included, so only full strength
+        replies are stored (see capped())."""
+        command = [self.path] + list(self.args or []) + \
+                  list(self.process_pool.setup)
+        return '%s %s %s' % (self.__class__.__name__, ' '.join(command),
+                             (self.movetime, self.depth, self.nodes))
+
+    def deterministic(self):
+        """Returns True if engine replies can be cached. Only games
+        limited by depth or nodes alone are cached if
+        REPLY_CACHE_DETERMINISTIC is set, a game movetime makes replies
+        depend on timing. Play queue budget caps are checked by
+        capped()."""
+        return not settings.REPLY_CACHE_DETERMINISTIC or \
+               (self.movetime is None and bool(self.depth or self.nodes))
+
+    def capped(self, elapsed):
+        """Returns True if last search, which took @elapsed seconds, could
+        have been cut short by the budget. A budget below game movetime
+        always cuts it, a search without game movetime is cut if it ran
+        until the budget (10% margin for engines stopping early)."""
+        movetime = self.limits()[0]
+        if movetime is None or movetime == self.movetime:
+            return False
+        if self.movetime is not None:
+            return True
+        return elapsed * 1000 >= movetime * 0.9
+
+    def sync(self):
+        """Loads current position in engine process."""
+        if self._process is None:
+            self.wake()
+        else:
+            self._limits = None # process could have other limits
+            self.restore()
+            self.stale = False
+
     def do_move(self, pos):
         """Move method. Return engine result or return False on invalid
         move or error."""
         raise NotImplementedError
 
+    def limit(self, movetime=None, depth=None, nodes=None):
+        """Sets engine think limits for this game, @movetime is in
+        milliseconds. None values are left untouched."""
+        if movetime is not None:
+            self.movetime = movetime
+        if depth is not None:
+            self.depth = depth
+        if nodes is not None:
+            self.nodes = nodes
+
+    def game_limits(self):
+        """Returns game think limits dict (movetime, depth, nodes), budget
+        caps not included, like limit() arguments."""
+        return {'movetime': self.movetime, 'depth': self.depth,
+                'nodes': self.nodes}
+
+    def limits(self):
+        """Returns (movetime, depth, nodes) limits in effect, movetime is
+        capped by current budget. Depth and nodes limited searches are
+        capped too, they can take any time in complex positions."""
+        movetime = self.movetime
+        if self.budget:
+            movetime = min(movetime or self.budget, self.budget)
+        return movetime, self.depth, self.nodes
+
+    def apply_limits(self):
+        """Sends think limits to the engine if they changed since last
+        time. Call it from do_move before writing player move."""
+        limits = self.limits()
+        if limits != self._limits:
+            self.send_limits(*limits)
+            self._limits = limits
+
+    def send_limits(self, movetime, depth, nodes):
+        """Sends think limits to the engine. Override in engines that
+        support them."""
+        pass
+
     def display(self):
         """Display method."""
         raise NotImplementedError
 
     def new(self):
         """Starts a new game."""
+        self.board = Board()
+        self.plies = array('H')
+        self.state = ACTIVE
+        self.speculations = {}
+        self.stale = True
+        if self._process is not None: # otherwise restored on wake up
+            self.supervised(lambda: None, settings.ENGINE_RETRIES)
+
+    def start(self):
+        """Checks out an engine process and loads the game on it, so an
+        engine that fails to start is reported before the first move.
+        Multiplexed games lease a process on each move instead."""
+        if not self.multiplex:
+            self.supervised(lambda: self.process, settings.ENGINE_RETRIES)
+
+    def restore(self):
+        """Resets engine process and loads current board position on it.
+        Override in engines."""
+        raise NotImplementedError
+
+    @property
+    def process(self):
+        """Returns game engine process, a hibernated game is woken up."""
+        if self._process is None:
+            self.wake()
+        return self._process
+
+    def hibernate(self):
+        """Parks game, engine process is returned to the pool. Game state
+        is kept in the board and plies."""
+        if self._process is not None:
+            self.process_pool.checkin(self._process)
+            self._process = None
+
+    def is_hibernated(self):
+        """Returns True if game has no engine process."""
+        return self._process is None
+
+    def wake(self):
+        """Checks out a process and restores game position on it, unless
+        it's the process this game used last and no moves were missed.
+        Raises EngineDied if a process couldn't be spawned."""
+        try:
+            process = self.process_pool.checkout(self.key)
+        except EnvironmentError, e: # missing binary, out of descriptors
+            raise EngineDied, 'engine failed, try again (%s)' % e
+        self._process = process
+        if process.owner != self.key or self.stale:
+            process.owner = self.key
+            self._limits = None
+            self.restore()
+        self.stale = False
+
+    @classmethod
+    def pool(cls, pondering=False):
+        """Returns warm processes pool for engine configuration."""
         raise NotImplementedError
 
     def end(self):
-        """Ends game."""
-        self.process.kill()
+        """Ends game, process is returned to the pool."""
+        self.ended = True
+        self.hibernate()
 
     def write(self, msg, truncate=True):
-        """Write msg to process"""
-        if truncate:
-            self.process.truncate()
-        self.process.write(msg)
+        """Write msg to process, write time is recorded in running command
+        timestamps and output times are reset. Raises EngineDied if the
+        process ended."""
+        try:
+            self.process.write(msg, truncate)
+        except IOError, e: # broken pipe
+            raise EngineDied, 'engine failed, try again (%s)' % e
+        if self.times is not None:
+            self.times['write'] = time.time()
+            self.times.pop('output', None)
+            self.times.pop('match', None)
 
     def read(self):
-        """Reads process output"""
-        return self.process.read()
+        """Reads process output. Waits until read deadline set by expect,
+        or for timeout() seconds. Raises EngineDied if process output was
+        closed and EngineTimeout if deadline passed."""
+        process = self.process
+        reader = process.reader
+        own = reader.deadline is None
+        if own:
+            reader.set_deadline(time.time() + self.timeout())
+        try:
+            lines = process.read()
+        finally:
+            if own:
+                reader.set_deadline(None)
+        if not lines:
+            if reader.closed:
+                raise EngineDied, 'engine failed, try again'
+            raise EngineTimeout, 'engine timed out, try again'
+        return lines
 
     def fen(self):
-        """Returns FEN notation for current board."""
-        raise NotImplementedError
+        """Returns FEN notation for current board, engine is not
+        involved."""
+        return self.board.fen()
 
     def illegal(self, result):
         """InvalidMove handler for expect function."""
@@ -101,14 +573,33 @@ class ChessEngine(object):
         @regex_mapping is a tuples list which contanins
             (regex_expression, function)
         if regex_expression matches read content, then function
-        is invoked and it's valued returned back.
+        is invoked and it's valued returned back. Lines are checked
+        once as they arrive and first matching line wins, lines after it
+        are left for next read. First output and match times are
+        recorded in running command timestamps.
+
+        Engine must match within timeout() seconds, EngineTimeout is
+        raised otherwise and EngineDied if the process ends first.
         """
-        while self.process.is_alive():
-            lines = self.read()
-            for regex, func in regex_mapping:
-                result = filter(regex.findall, lines)
-                if result:
+        matcher = Matcher(regex_mapping)
+        times = self.times
+        reader = self.process.reader
+        reader.set_deadline(time.time() + self.timeout())
+        try:
+            while True:
+                lines = self.read()
+                if times is not None and 'output' not in times:
+                    times['output'] = time.time()
+                match = matcher.feed(lines)
+                if match:
+                    if times is not None:
+                        times['match'] = time.time()
+                    if matcher.rest:
+                        reader.unread(matcher.rest)
+                    func, result = match
                     return func(result)
+        finally:
+            reader.set_deadline(None)
 
     def __str__(self):
         """User friendly string representantion."""
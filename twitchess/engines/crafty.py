@@ -1,8 +1,9 @@
 import re
 
 from twitchess.exceptions import GameError
-from twitchess.engines.base import ChessEngine
-from twitchess.engines.utils import parse_move
+from twitchess.board import STARTING_FEN
+from twitchess.engines.base import ChessEngine, engine_pool
+from twitchess.engines.utils import parse_move, prompt_re
 
 
 # binary path
@@ -30,30 +31,38 @@ CRAFTY      = '/usr/games/crafty'
 
 # regular expressions to detect interesting output
 BOARD_RE   = re.compile('^[ \|1-8<>\+\-a-h\.RNBQKP]+$')      # board
-FEN_RE     = re.compile('^setboard .*')                      # FEN
 ILLEGAL_RE = re.compile('^Illegal move')                     # illegal
-MYMOVE_RE  = re.compile('Black\(\d+\): [RNBQKP]?[a-h][1-8]') # maching
+MYMOVE_RE  = re.compile('Black\(\d+\): '                     # machine move
+                        '(?:[RNBQKP]?[a-h]?[1-8]?x?[a-h][1-8]|O-O)')
 WHITE_RE   = '^White\(%d\):'                                 # white prompt
 BLACK_RE   = '^Black\(%d\):'                                 # black prompt
 
 
 class Crafty(ChessEngine):
-    """Crafty chess engine access"""
-    def __init__(self, players, pondering=False):
-        super(Crafty, self).__init__(players, CRAFTY)
-        if self.multiplayer:
+    """Crafty chess engine access, @path and @args override Crafty binary
+    and arguments."""
+    def __init__(self, players, pondering=False, path=None, args=None):
+        if isinstance(players, tuple):
             raise GameError, 'multiplayer not supported by Crafty yet'
+        super(Crafty, self).__init__(players,
+                                     self.pool(pondering, path, args))
+
+    @classmethod
+    def pool(cls, pondering=False, path=None, args=None):
+        """Returns warm Crafty processes pool, processes are already
+        configured when checked out."""
         # Disable log files (game.xxx and log.xxx files)
-        self.write('log off')
+        setup = ['log off']
         # Disable noise as much as possible while thinking engine move
         # noice <big number> will disable maching thinking noise for a lot of
         # time until level reaches is too deep (something that can happen on
         # advanced games)
-        self.write('noise 937459712')
+        setup.append('noise 937459712')
         # Disable pondering
         # Disables thinking on player time. What? who said it was a fair game?
         if not pondering:
-            self.write('ponder off')
+            setup.append('ponder off')
+        return engine_pool(path or CRAFTY, args, setup, quit='end')
 
     def display(self):
         """Display method."""
@@ -61,32 +70,16 @@ class Crafty(ChessEngine):
         return ''.join(line[4:] for line in filter(BOARD_RE.match,
                                                    self.read()))
 
-    def new(self):
-        """Starts a new game."""
+    def restore(self):
+        """Starts a new game in engine and loads current position."""
         self.write('new')
-
-    def end(self):
-        """Ends game."""
-        self.write('end')
-        super(Crafty, self).end()
-
-    def fen(self):
-        """Reads FEN notation from Crafty. Appends completes moves at end."""
-        self.write('savepos')
-        prompt = re.compile((WHITE_RE if self.is_white_turn() else BLACK_RE) %
-                                    (len(self.moves) + 1,))
-
-        out = self.expect(((FEN_RE, lambda result: result),
-                           (ILLEGAL_RE, self.illegal),
-                           (prompt, self.unknow)))
-        if out:
-            moves = ' 0 %d' % len(self.moves)
-            return out[0].replace('setboard ', '').replace('\n', '') + moves
+        if self.board.fen() != STARTING_FEN:
+            self.write('setboard ' + self.board.fen())
 
     def do_move(self, pos):
         # regular expression to detect prompt, adds 2 becuse it's 1-indexed
-        prompt = re.compile((WHITE_RE if self.is_white_turn() else BLACK_RE) %
-                                    (len(self.moves) + 2,))
+        prompt = prompt_re(WHITE_RE if self.is_white_turn() else BLACK_RE,
+                           self.move_count() + 2)
 
         if self.multiplayer:
             expect = [(ILLEGAL_RE, self.illegal), # user introduced an illegal move
@@ -96,5 +89,18 @@ class Crafty(ChessEngine):
                       (ILLEGAL_RE, self.illegal), # user introduced an illegal move
                       (prompt, self.unknow)] # prompt reached without result
 
+        self.apply_limits()
         self.write(pos) # write player move
-        return self.expect(expect)
+        result = self.expect(expect)
+        if (self.multiplex or self.searching) and not self.multiplayer:
+            # consume prompt so it isn't read after the process is restored
+            # to this position, by next game or next speculation
+            self.expect([(prompt, self.noop)])
+        return result
+
+    def send_limits(self, movetime, depth, nodes):
+        """Sets search time and depth, Crafty has no nodes limit."""
+        if movetime:
+            self.write('st %.2f' % (movetime / 1000.0))
+        if depth:
+            self.write('sd %d' % depth)
@@ -0,0 +1,33 @@
+"""
+Scripted fake engines, they speak engines protocols without any chess
+knowledge beyond legal moves. Used to run the play queue where real
+engines are not installed.
+
+    gnuchess    GNUChess console dialect
+    crafty      Crafty console dialect
+    uci         UCI protocol
+"""
+import sys
+from os.path import dirname, join
+
+
+FAKES_DIR = dirname(__file__)
+
+
+def command(name, *args):
+    """Returns (path, args) to run fake engine @name."""
+    return sys.executable, [join(FAKES_DIR, name + '.py')] + list(args)
+
+
+def engine(cls, name, *args):
+    """Returns @cls engine subclass running fake engine @name with command
+    line @args, like engine(GNUChess, 'gnuchess', '--think', '50')."""
+    path, args = command(name, *args)
+
+    class FakeEngine(cls):
+        @classmethod
+        def pool(klass, pondering=False, *overrides): # path, args ignored
+            return super(FakeEngine, klass).pool(pondering, path, args)
+
+    FakeEngine.__name__ = cls.__name__ # stats and cache keys
+    return FakeEngine
@@ -0,0 +1,136 @@
+"""
+Console engines fakes loop, shared by GNUChess and Crafty fakes. Player
+moves are read from stdin, engine replies the first legal move in
+coordinate order after thinking --think milliseconds (bounded by st
+search time), printing --noise thinking lines and the board when --board
+is set.
+"""
+import sys
+import time
+from optparse import OptionParser
+
+from twitchess.board import Board, WHITE
+from twitchess.exceptions import InvalidMove
+
+
+def out(line):
+    """Writes a line to stdout."""
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+class ConsoleEngine(object):
+    """Console engine dialect, subclasses define output formats."""
+    # commands accepted and ignored
+    IGNORED = ()
+
+    def __init__(self, options):
+        self.options = options
+        self.board = Board()
+        self.manual = False # both sides are played from stdin
+        self.search_time = None # st limit in seconds
+
+    def side(self):
+        """Returns side to move name."""
+        return 'White' if self.board.turn == WHITE else 'Black'
+
+    def prompt(self):
+        """Prints move prompt."""
+        raise NotImplementedError
+
+    def dump_board(self):
+        """Prints board."""
+        raise NotImplementedError
+
+    def thinking(self, depth, move):
+        """Returns a thinking output line."""
+        raise NotImplementedError
+
+    def played(self, number, side, move):
+        """Prints engine move."""
+        raise NotImplementedError
+
+    def illegal(self, move):
+        """Prints illegal move error."""
+        out('Illegal move: %s' % move)
+
+    def command(self, command, args):
+        """Handles engine specific @command, returns False if unknown."""
+        return False
+
+    def think(self):
+        """Waits think time, prints thinking noise, returns move or None."""
+        think = self.options.think / 1000.0
+        if self.search_time is not None:
+            think = min(think, self.search_time)
+        time.sleep(think)
+        moves = sorted(self.board.legal_moves(), key=self.board.coordinate)
+        if not moves:
+            return None
+        san = self.board.san(moves[0])
+        for depth in xrange(self.options.noise):
+            out(self.thinking(depth + 1, san))
+        return moves[0]
+
+    def move(self, text):
+        """Plays player move @text and engine reply unless in manual
+        mode."""
+        try:
+            move = self.board.parse(text)
+        except InvalidMove:
+            self.illegal(text)
+            return
+        self.board.push(move)
+        if self.options.board:
+            self.dump_board()
+        if self.manual or self.board.result() is not None:
+            return
+        number, side = self.board.fullmove, self.side()
+        reply = self.think()
+        if reply is not None:
+            san = self.board.san(reply)
+            self.board.push(reply)
+            self.played(number, side, san)
+            if self.options.board:
+                self.dump_board()
+
+    def run(self):
+        """Reads commands until quit."""
+        self.prompt()
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                break
+            args = line.split()
+            if not args:
+                continue
+            command, args = args[0], args[1:]
+            if command in ('quit', 'end', 'exit'):
+                break
+            elif command == 'new':
+                self.board = Board()
+                self.manual = False
+            elif command == 'setboard':
+                try:
+                    self.board = Board(' '.join(args))
+                except InvalidMove:
+                    out('Illegal position')
+            elif command == 'st' and args:
+                self.search_time = float(args[0])
+            elif command in self.IGNORED:
+                pass
+            elif not self.command(command, args):
+                self.move(command)
+                self.prompt()
+
+
+def options(usage):
+    """Returns parsed command line options of a console engine fake."""
+    parser = OptionParser(usage=usage)
+    parser.add_option('--think', type='int', default=0,
+                      help='Think time in milliseconds')
+    parser.add_option('--noise', type='int', default=0,
+                      help='Thinking lines printed per move')
+    parser.add_option('--board', action='store_true', default=False,
+                      help='Print board after each move')
+    return parser.parse_args()[0]
@@ -0,0 +1,71 @@
+"""
+Fake Crafty console engine, see console.py.
+
+Usage: crafty.py [--think MILLISECONDS] [--noise LINES] [--board]
+"""
+from __future__ import with_statement
+
+import sys
+from os.path import abspath, dirname
+
+if __name__ == '__main__': # running as a script, make package importable
+    sys.path.insert(0, dirname(dirname(dirname(dirname(abspath(__file__))))))
+
+from twitchess.engines.fakes.console import ConsoleEngine, out, options
+
+
+ROW_SEP = '       +---+---+---+---+---+---+---+---+'
+
+
+class FakeCrafty(ConsoleEngine):
+    """Crafty output dialect:
+        White(1): e4
+                      Black(1): a6
+        White(2):
+    """
+    IGNORED = ('log', 'noise', 'ponder', 'sd', 'level', 'xboard')
+
+    def prompt(self):
+        out('%s(%d): ' % (self.side(), self.board.fullmove))
+
+    def dump_board(self):
+        out(ROW_SEP)
+        for rank in xrange(7, -1, -1):
+            line = '    %d  |' % (rank + 1)
+            for col in xrange(8):
+                piece = self.board.squares[rank * 16 + col]
+                if piece is None:
+                    line += ' . |' if (rank + col) % 2 == 0 else '   |'
+                elif piece.isupper():
+                    line += '-%s-|' % piece
+                else:
+                    line += '<%s>|' % piece.upper()
+            out(line)
+            out(ROW_SEP)
+        out('         a   b   c   d   e   f   g   h')
+
+    def thinking(self, depth, move):
+        return '              %2d     0.00   0.00   %s' % (depth, move)
+
+    def played(self, number, side, move):
+        out('              %s(%d): %s' % (side, number, move))
+
+    def command(self, command, args):
+        if command == 'display':
+            self.dump_board()
+        elif command == 'force':
+            self.manual = True
+        elif command == 'savepos':
+            line = 'setboard ' + self.board.fen()
+            if args:
+                with open(args[0], 'w') as fobj:
+                    fobj.write(line + '\n')
+            else:
+                out(line)
+        else:
+            return False
+        return True
+
+
+if __name__ == '__main__':
+    FakeCrafty(options(__doc__.strip().split('\n')[-1])).run()
@@ -0,0 +1,63 @@
+"""
+Fake GNUChess console engine, see console.py.
+
+Usage: gnuchess.py [--think MILLISECONDS] [--noise LINES] [--board]
+"""
+from __future__ import with_statement
+
+import sys
+from os.path import abspath, dirname
+
+if __name__ == '__main__': # running as a script, make package importable
+    sys.path.insert(0, dirname(dirname(dirname(dirname(abspath(__file__))))))
+
+from twitchess.engines.fakes.console import ConsoleEngine, out, options
+
+
+class FakeGNUChess(ConsoleEngine):
+    """GNUChess output dialect:
+        White (1) : e4
+        1. e4
+        My move is : a6
+        White (2) :
+    """
+    IGNORED = ('sd', 'depth', 'level', 'easy', 'hard', 'post', 'nopost')
+
+    def prompt(self):
+        out('%s (%d) : ' % (self.side(), self.board.fullmove))
+
+    def dump_board(self):
+        fields = self.board.fen().split()
+        out('%s  %s  %s' % (self.side().lower(), fields[2],
+                            fields[3] if fields[3] != '-' else ''))
+        for row in fields[0].split('/'):
+            line = ''
+            for char in row:
+                line += '. ' * int(char) if char.isdigit() else char + ' '
+            out(line)
+
+    def thinking(self, depth, move):
+        return '%3d    %4d  %5d  %7d %s' % (depth, 0, depth * 10,
+                                            depth * 1000, move)
+
+    def played(self, number, side, move):
+        out('%d. ... %s' % (number, move))
+        out('My move is : %s' % move)
+
+    def command(self, command, args):
+        if command == 'show' and args[:1] == ['board']:
+            self.dump_board()
+        elif command in ('manual', 'force'):
+            self.manual = True
+        elif command == 'save' and args:
+            # EPD: rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - bm 1; id 1;
+            fields = self.board.fen().split()[:4]
+            with open(args[0], 'w') as fobj:
+                fobj.write('%s bm 1; id 1;\n' % ' '.join(fields))
+        else:
+            return False
+        return True
+
+
+if __name__ == '__main__':
+    FakeGNUChess(options(__doc__.strip().split('\n')[-1])).run()
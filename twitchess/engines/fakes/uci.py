@@ -0,0 +1,115 @@
+"""
+Fake UCI engine. Replies the first legal move in coordinate order,
+waits --think milliseconds (bounded by movetime) before answering or
+until stop command is received.
+
+Usage: uci.py [--think MILLISECONDS] [--info LINES]
+"""
+import os
+import sys
+import time
+import select
+from os.path import abspath, dirname
+from optparse import OptionParser
+
+if __name__ == '__main__': # running as a script, make package importable
+    sys.path.insert(0, dirname(dirname(dirname(dirname(abspath(__file__))))))
+
+from twitchess.board import Board
+from twitchess.exceptions import InvalidMove
+
+
+def out(line):
+    """Writes a line to stdout."""
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def position(args):
+    """Returns board for position command arguments."""
+    if args and args[0] == 'fen':
+        fen, args = args[1:7], args[7:]
+        board = Board(' '.join(fen))
+    else:
+        board, args = Board(), args[1:]
+    if args and args[0] == 'moves':
+        for move in args[1:]:
+            board.push(board.parse(move))
+    return board
+
+
+def think(seconds):
+    """Waits @seconds or until stop command is read, isready commands are
+    answered meanwhile."""
+    deadline = time.time() + seconds
+    while True:
+        timeout = deadline - time.time()
+        if timeout <= 0 or not select.select([sys.stdin], [], [], timeout)[0]:
+            return
+        line = sys.stdin.readline()
+        if not line or line.strip() == 'stop':
+            return
+        if line.strip() == 'isready':
+            out('readyok')
+
+
+def go(board, args, options):
+    """Searches position and prints bestmove."""
+    seconds = options.think
+    if 'movetime' in args:
+        seconds = min(seconds, int(args[args.index('movetime') + 1]))
+    think(seconds / 1000.0)
+    moves = sorted(board.legal_moves(), key=board.coordinate)
+    for depth in xrange(options.info):
+        out('info depth %d score cp 0 nodes %d' % (depth + 1, depth * 100))
+    if not moves:
+        out('bestmove (none)')
+        return
+    best = board.coordinate(moves[0])
+    board.push(moves[0])
+    replies = sorted(board.legal_moves(), key=board.coordinate)
+    if replies:
+        out('bestmove %s ponder %s' % (best, board.coordinate(replies[0])))
+    else:
+        out('bestmove %s' % best)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--think', type='int', default=0,
+                      help='Think time in milliseconds')
+    parser.add_option('--info', type='int', default=1,
+                      help='Info lines printed per search')
+    options, args = parser.parse_args()
+
+    sys.stdin = os.fdopen(sys.stdin.fileno(), 'r', 0) # select friendly
+    board = Board()
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        args = line.split()
+        if not args:
+            continue
+        command, args = args[0], args[1:]
+        if command == 'uci':
+            out('id name twitchess fake')
+            out('id author twitchess')
+            out('uciok')
+        elif command == 'isready':
+            out('readyok')
+        elif command == 'ucinewgame':
+            board = Board()
+        elif command == 'position':
+            try:
+                board = position(args)
+            except InvalidMove:
+                out('info string invalid position')
+        elif command == 'go':
+            go(board, args, options)
+        elif command == 'quit':
+            break
+
+
+if __name__ == '__main__':
+    main()
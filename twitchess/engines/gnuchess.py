@@ -1,10 +1,8 @@
-import os
-import tempfile
 import re
-import time
 
-from twitchess.engines.base import ChessEngine
-from twitchess.engines.utils import crafty_board, parse_move
+from twitchess.board import STARTING_FEN
+from twitchess.engines.base import ChessEngine, engine_pool
+from twitchess.engines.utils import crafty_board, parse_move, prompt_re
 
 # binary path and arguments
 GNUCHESS = '/usr/games/gnuchess'
@@ -23,7 +21,6 @@ GNUCHESS_ARGS = ['-e']
 
 # regular expressions to detect interesting output
 BOARD_RE   = re.compile('^[\.rnbqkpRNBQKP ]+$')           # board
-FEN_RE     = re.compile('^[\.rnbqkpRNBQKP1-8a-hwitl ]+$') # full board
 ILLEGAL_RE = re.compile('^Illegal move')                  # illegal move
 MYMOVE_RE  = re.compile('^My move is')                    # machine move
 WHITE_RE   = '^White \(%d\) :'                           # white prompt
@@ -31,12 +28,18 @@ BLACK_RE   = '^Black \(%d\) :'                           # black prompt
 
 
 class GNUChess(ChessEngine):
-    """GNUChess engine access"""
-    def __init__(self, players, pondering=False):
-        args = GNUCHESS_ARGS if not pondering else []
-        super(GNUChess, self).__init__(players, GNUCHESS, args)
-        if self.multiplayer:
-            self.write('manual') # enter manualmode
+    """GNUChess engine access, @path and @args override GNUChess binary
+    and arguments."""
+    def __init__(self, players, pondering=False, path=None, args=None):
+        super(GNUChess, self).__init__(players,
+                                       self.pool(pondering, path, args))
+
+    @classmethod
+    def pool(cls, pondering=False, path=None, args=None):
+        """Returns warm GNUChess processes pool."""
+        if args is None:
+            args = GNUCHESS_ARGS if not pondering else []
+        return engine_pool(path or GNUCHESS, args, quit='quit')
 
     def display(self):
         """Reads GNUChess board and converts to ritcher format."""
@@ -44,39 +47,18 @@ class GNUChess(ChessEngine):
         result = self.read()
         return crafty_board(filter(BOARD_RE.match, result))
 
-    def new(self):
-        """Starts a new game."""
+    def restore(self):
+        """Starts a new game in engine and loads current position."""
         self.write('new')
-
-    def end(self):
-        """Ends game."""
-        self.write('quit')
-        super(GNUChess, self).end()
-
-    def fen(self):
-        """Reads FEN notation stored in a temporary file saved by GNUChess.
-        GNUChess Output format:
-            rnbqkbnr/ppp1pppp/8/8/P3p3/8/1PPP1PPP/RNBQKBNR w KQkq - bm 1; id 1;
-        Converts to:
-            rnbqkbnr/ppp1pppp/8/8/P3p3/8/1PPP1PPP/RNBQKBNR w KQkq - 0 1
-        """
-        fd, path = tempfile.mkstemp()
-        self.write('save ' + path)
-        time.sleep(0.5) # some delay :(
-        fobj = os.fdopen(fd)
-        out = fobj.readline()
-        fobj.close()
-        os.unlink(path)
-        if out:
-            out = out.strip().split(';')[0].split()
-            out[-2] = '0'
-            out = ' '.join(out)
-            return out
+        if self.multiplayer:
+            self.write('manual') # enter manualmode
+        if self.board.fen() != STARTING_FEN:
+            self.write('setboard ' + self.board.fen())
 
     def do_move(self, pos):
         # regular expression to detect prompt, adds 2 becuse it's 1-indexed
-        prompt = re.compile((WHITE_RE if self.is_white_turn() else BLACK_RE) %
-                                    (len(self.moves) + 2,))
+        prompt = prompt_re(WHITE_RE if self.is_white_turn() else BLACK_RE,
+                           self.move_count() + 2)
 
         if self.multiplayer:
             expect = [(ILLEGAL_RE, self.illegal), # user introduced an illegal move
@@ -86,5 +68,19 @@ class GNUChess(ChessEngine):
                       (ILLEGAL_RE, self.illegal), # user introduced an illegal move
                       (prompt, self.unknow)] # prompt reached without result
 
+        self.apply_limits()
         self.write(pos) # write player move
-        return self.expect(expect)
+        result = self.expect(expect)
+        if (self.multiplex or self.searching) and not self.multiplayer:
+            # consume prompt so it isn't read after the process is restored
+            # to this position, by next game or next speculation
+            self.expect([(prompt, self.noop)])
+        return result
+
+    def send_limits(self, movetime, depth, nodes):
+        """Sets search time (whole seconds) and depth, GNUChess has no
+        nodes limit."""
+        if movetime:
+            self.write('st %d' % max(1, movetime / 1000))
+        if depth:
+            self.write('sd %d' % depth)
@@ -0,0 +1,108 @@
+import re
+
+from twitchess.board import decode_move
+from twitchess.exceptions import GameError, InvalidMove, EngineError
+from twitchess.engines.base import ChessEngine, engine_pool
+
+
+# binary path
+UCI = '/usr/games/stockfish'
+
+# UCI session:
+#     > uci
+#     < id name Stockfish
+#     < uciok
+#     > ucinewgame
+#     > isready
+#     < readyok
+#     > position startpos moves e2e4
+#     > go movetime 1000
+#     < info depth 12 score cp -30 pv c7c5 g1f3
+#     < bestmove c7c5 ponder g1f3
+
+# regular expressions to detect interesting output
+READYOK_RE  = re.compile('^readyok')                    # engine ready
+BESTMOVE_RE = re.compile('^bestmove ([a-h][1-8][a-h][1-8][qrbn]?)' # move
+                         '(?: ponder ([a-h][1-8][a-h][1-8][qrbn]?))?')
+NOMOVE_RE   = re.compile('^bestmove')                   # no move (mate)
+
+
+class UCIEngine(ChessEngine):
+    """Universal Chess Interface engine access. Engine is stateless, the
+    board position is sent on each move."""
+    stateless = True
+
+    def __init__(self, players, pondering=False, path=UCI, args=None,
+                 movetime=None, depth=None, nodes=None):
+        if isinstance(players, tuple):
+            raise GameError, 'multiplayer not supported by UCI engines yet'
+        super(UCIEngine, self).__init__(players,
+                                        self.pool(pondering, path, args))
+        self.limit(movetime, depth, nodes)
+
+    @classmethod
+    def pool(cls, pondering=False, path=UCI, args=None):
+        """Returns warm UCI engine processes pool."""
+        setup = ['uci',
+                 'setoption name Ponder value %s' % \
+                        ('true' if pondering else 'false')]
+        return engine_pool(path, args, setup, quit='quit')
+
+    def restore(self):
+        """Resets engine, waits until it's ready. Position is sent on
+        each move."""
+        self.write('ucinewgame')
+        self.write('isready', truncate=False)
+        self.expect([(READYOK_RE, self.noop)])
+
+    def display(self):
+        """Display method."""
+        return self.fen()
+
+    def go(self):
+        """Returns go command for engine limits, limits are sent on each
+        search."""
+        command = 'go'
+        movetime, depth, nodes = self.limits()
+        if depth:
+            command += ' depth %d' % depth
+        if nodes:
+            command += ' nodes %d' % nodes
+        if movetime:
+            command += ' movetime %d' % movetime
+        return command
+
+    def position(self, move):
+        """Returns position command for game moves followed by coordinate
+        @move. Whole game is sent so the engine sees repetitions, and
+        position doesn't depend on moves the engine saw (cached replies,
+        replayed games)."""
+        moves = [self.board.coordinate(decode_move(code))
+                    for code in self.plies]
+        moves.append(move)
+        return 'position startpos moves %s' % ' '.join(moves)
+
+    def do_move(self, pos):
+        board = self.board.copy()
+        move = board.parse(pos)
+        board.push(move)
+
+        self.write(self.position(self.board.coordinate(move)))
+        self.write(self.go(), truncate=False)
+        reply = self.expect([(BESTMOVE_RE, self.bestmove),
+                             (NOMOVE_RE, self.unknow)])
+        try:
+            return board.san(board.parse(reply))
+        except InvalidMove: # engine fault, process is replaced
+            raise EngineError, 'Unknow engine move %s' % reply
+
+    def stop_search(self):
+        """Engine answers bestmove right away."""
+        self._process.write('stop')
+
+    def bestmove(self, result):
+        """Returns move from bestmove line, engine ponder move is kept as
+        predicted player move."""
+        match = BESTMOVE_RE.match(result[-1])
+        self.predicted = match.group(2)
+        return match.group(1)
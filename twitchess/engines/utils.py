@@ -1,9 +1,14 @@
 from __future__ import with_statement
 
 import os
+import re
+import time
+import errno
 import fcntl
+import heapq
+import select
 import threading
-from select import select
+from itertools import count
 from subprocess import Popen, PIPE, STDOUT
 
 
@@ -11,21 +16,59 @@ class Reader(object):
     def __init__(self):
         self.lock = threading.Condition()
         self.buff = []
+        self.closed = False # pipe reached EOF
+        self.deadline = None # reads stop waiting at this time
+        self.expired = False # deadline passed, set by the supervisor
+        self.watched = None # supervisor entry of current deadline
 
     def readlines(self):
-        """Reads lines in buffer"""
+        """Reads lines in buffer. Waits for lines until the pipe is closed
+        or the read deadline passed, then an empty list is returned."""
         self.lock.acquire()
 
-        while not self.buff:
+        while not self.buff and not self.closed and not self.expired:
             self.lock.wait()
 
         result, self.buff = self.buff, []
         self.lock.release()
         return result
 
+    def set_deadline(self, deadline):
+        """Sets time when reads stop waiting, None waits forever. Previous
+        deadline is no longer watched."""
+        with self.lock:
+            self.deadline = deadline
+            self.expired = False
+            watched, self.watched = self.watched, None
+        if watched is not None:
+            SUPERVISOR.cancel(watched)
+        if deadline is not None:
+            self.watched = SUPERVISOR.watch(self, deadline)
+
+    def expire(self, deadline):
+        """Wakes up readers if @deadline is still the read deadline."""
+        with self.lock:
+            if self.deadline == deadline:
+                self.expired = True
+                self.lock.notify()
+
+    def close(self):
+        """Marks pipe as closed, waiting readers are woken up."""
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+
     def truncate(self):
         """Truncates read data to nothing."""
-        self.buff = []
+        with self.lock:
+            self.buff = []
+
+    def unread(self, lines):
+        """Puts back @lines not consumed by a reader, they are read again
+        before newer lines."""
+        with self.lock:
+            self.buff[:0] = lines
+            self.lock.notify()
 
     def writelines(self, lines):
         """Writes lines in buffer"""
@@ -35,20 +78,210 @@ class Reader(object):
         self.lock.release()
 
 
-def pipe_reader(subprocess):
-    """Reads from subprocess stdout pipe and writes to it's io buffer."""
-    def _read(subprocess):
+def set_nonblocking(fd):
+    """Sets non-blocking IO mode to file descriptor @fd."""
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+
+class Supervisor(object):
+    """
+    Watches engine read deadlines from a single thread, readers waiting
+    past their deadline are woken up. Readers wait on their condition
+    without timeout, which is much faster than timed waits, and only the
+    supervisor thread polls.
+    """
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.deadlines = [] # heap of [deadline, sequence, reader] entries
+        self.cancelled = 0 # entries in heap with reader set to None
+        self.sequence = count()
+        self._thread = None
+
+    def watch(self, reader, deadline):
+        """Expires @reader at @deadline, unless its deadline changed.
+        Supervisor thread is started if needed. Returns entry to
+        cancel()."""
+        with self.lock:
+            entry = [deadline, self.sequence.next(), reader]
+            heapq.heappush(self.deadlines, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='engines supervisor')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            if self.deadlines[0] is entry: # wait less
+                self.lock.notify()
+            return entry
+
+    def cancel(self, entry):
+        """Stops watching deadline @entry. Cancelled entries are dropped
+        when they reach the top, or all at once when they are half the
+        heap."""
+        with self.lock:
+            if entry[2] is None:
+                return
+            entry[2] = None
+            self.cancelled += 1
+            if self.cancelled * 2 > len(self.deadlines):
+                self.deadlines = [watched for watched in self.deadlines
+                                        if watched[2] is not None]
+                heapq.heapify(self.deadlines)
+                self.cancelled = 0
+
+    def stop(self):
+        """Stops supervisor thread, next watch() starts it again."""
+        with self.lock:
+            thread, self._thread = self._thread, None
+            self.lock.notifyAll()
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        """Supervisor loop, runs until stop() replaces this thread."""
+        current = threading.currentThread()
+        while True:
+            with self.lock:
+                while not self.deadlines and self._thread is current:
+                    self.lock.wait()
+                if self._thread is not current:
+                    return
+                entry = self.deadlines[0]
+                deadline, sequence, reader = entry
+                if reader is None: # cancelled
+                    heapq.heappop(self.deadlines)
+                    self.cancelled -= 1
+                    continue
+                now = time.time()
+                if deadline > now:
+                    self.lock.wait(deadline - now)
+                    continue
+                heapq.heappop(self.deadlines)
+                entry[2] = None # not in heap, cancel() is a no-op
+            reader.expire(deadline)
+
+
+SUPERVISOR = Supervisor()
+
+
+class Reactor(object):
+    """
+    Reads every engine stdout pipe from a single thread. Pipes are watched
+    with epoll (poll where not available), data is read in chunks with
+    os.read, split in lines over a per pipe buffer and lines are passed to
+    the pipe Reader.
+    """
+    CHUNK = 65536
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.events = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+        else:
+            self.poller = select.poll()
+            self.events = select.POLLIN | select.POLLHUP | select.POLLERR
+        self.lock = threading.Lock()
+        self.readers = {} # fd -> (reader, pending partial line buffer)
+        # pipe used to wake up poller when fds are registered
+        self._wake_in, self._wake_out = os.pipe()
+        set_nonblocking(self._wake_in)
+        set_nonblocking(self._wake_out)
+        self.poller.register(self._wake_in, self.events)
+        self._thread = None
+
+    def register(self, fd, reader):
+        """Starts reading @fd, read lines are written into @reader."""
+        set_nonblocking(fd)
+        with self.lock:
+            self.readers[fd] = (reader, bytearray())
+            self.poller.register(fd, self.events)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='pipes reactor')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        self.wakeup()
+
+    def unregister(self, fd):
+        """Stops reading @fd, it can be closed once this returns."""
+        with self.lock:
+            self._unregister(fd)
+
+    def _unregister(self, fd):
+        """Stops reading @fd, call it with lock held."""
+        if self.readers.pop(fd, None) is not None:
+            try:
+                self.poller.unregister(fd)
+            except (IOError, OSError, KeyError): # already closed
+                pass
+
+    def wakeup(self):
+        """Wakes up poller thread."""
         try:
-            while subprocess.is_alive():
-                yield subprocess.process.stdout.readline()
-        except IOError: # no more data to read
+            os.write(self._wake_out, 'x')
+        except OSError: # pipe full, poller will wake up anyway
             pass
-        raise StopIteration
 
-    fileno = [subprocess.process.stdout.fileno()]
-    while subprocess.is_alive():
-        select(fileno, [], []) # block until there's something to read
-        subprocess.reader.writelines([line for line in _read(subprocess)])
+    def _run(self):
+        """Poller loop."""
+        while True:
+            try:
+                events = self.poller.poll()
+            except (IOError, OSError, select.error), e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wake_in:
+                    try:
+                        while os.read(self._wake_in, self.CHUNK):
+                            pass
+                    except OSError: # drained
+                        pass
+                else:
+                    self._read(fd)
+
+    def _read(self, fd):
+        """Reads available data from @fd and passes complete lines to its
+        reader. Pending data is flushed on EOF. Reader lookup and read are
+        done with lock held, so a closed fd reused by a new process is
+        never read on behalf of the old reader."""
+        with self.lock:
+            entry = self.readers.get(fd)
+            if entry is None:
+                return
+            try:
+                data = os.read(fd, self.CHUNK)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                data = ''
+            if not data: # EOF, process ended
+                self._unregister(fd)
+        reader, buff = entry
+
+        if not data:
+            if buff:
+                reader.writelines([str(buff)])
+                del buff[:]
+            reader.close()
+            return
+
+        end = data.rfind('\n')
+        if end == -1: # no complete line yet
+            buff.extend(data)
+            return
+        lines = data[:end + 1].splitlines(True)
+        if buff: # first line started on a previous read
+            buff.extend(lines[0])
+            lines[0] = str(buff)
+            del buff[:]
+        buff.extend(data[end + 1:])
+        reader.writelines(lines)
+
+
+REACTOR = Reactor()
+
 
 class SubProcess(object):
     """Chess engine base class"""
@@ -59,8 +292,8 @@ class SubProcess(object):
         """
         self.command = [path] + (args or [])
         self.reader = Reader()
+        self.owner = None # key of the game whose position is loaded
         self._process = None
-        self._reader_thread = None
 
     def is_alive(self):
         """Returns true/false according to process live status."""
@@ -72,30 +305,37 @@ class SubProcess(object):
         Returns current process.
 
         Starts subprocess if not started, std{in,out,err} are redirected
-        to pipes and stdout is set to nonblocking IO.
+        to pipes and stdout is read by the reactor.
         """
+        if self._process is None:
+            self.start()
+        return self._process
+
+    def start(self):
+        """Starts subprocess and registers its stdout in the reactor if
+        not started yet."""
         if self._process is None:
             process = Popen(self.command, stdin=PIPE, stdout=PIPE,
                             stderr=STDOUT)
-            # set non-blocking IO mode to stdout
-            fd = process.stdout.fileno()
-            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
             self._process = process
+            self.reader = Reader() # previous process output is closed
+            REACTOR.register(process.stdout.fileno(), self.reader)
 
-            # starts reader thread
-            thread = threading.Thread(target=pipe_reader, name='pipe reader',
-                                      args=(self,))
-            thread.start()
-            self._reader_thread = thread
-        return self._process
-
-    def write(self, msg):
-        """Writes msg to process stdin."""
-        self.process.stdin.write(msg + '\n')
+    def write(self, msg, truncate=False):
+        """Writes msg to process stdin. If @truncate is True, read data is
+        discarded before writing while holding the reader lock, so output
+        produced in response to msg is never discarded."""
+        process = self.process
+        if truncate:
+            with self.reader.lock:
+                self.reader.buff = []
+                process.stdin.write(msg + '\n')
+        else:
+            process.stdin.write(msg + '\n')
 
     def read(self):
-        """Reads process stdout."""
+        """Reads process stdout, an empty list is returned if output is
+        closed or read deadline passed."""
         return self.reader.readlines()
 
     def truncate(self):
@@ -104,12 +344,272 @@ class SubProcess(object):
 
     def kill(self):
         """Kills process"""
-        self._process.kill()
-        self._reader_thread.join()
-        self._reader_thread = None
+        if self._process is None:
+            return
+        REACTOR.unregister(self._process.stdout.fileno())
+        if self.is_alive():
+            self._process.kill()
+        self._process.wait()
+        self._process.stdin.close()
+        self._process.stdout.close()
         self._process = None
 
 
+class ProcessPool(object):
+    """
+    Pool of warm engine processes. Processes are started and configured
+    with @setup commands before any game asks for them, games check out
+    a process and check it in back when they end or hibernate. A game
+    gets back the process it used last if it's still idle, so its
+    position doesn't have to be reloaded.
+
+    @min_size   idle processes kept warm, refilled in background
+    @max_size   max idle processes kept, extra processes are killed
+    """
+    def __init__(self, path, args=None, setup=None, quit=None, min_size=0,
+                 max_size=4):
+        self.path = path
+        self.args = args
+        self.setup = setup or []
+        self.quit = quit
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.hits = 0 # checkouts served by a warm process
+        self.misses = 0 # checkouts that had to wait for a spawn
+        self.failed = 0 # processes discarded after hanging or dying
+        self.affinity = 0 # checkouts served by the owner last process
+        self.spawned = 0 # processes started
+        self.killed = 0 # processes discarded
+        self.spawn_time = 0.0 # seconds spent starting processes
+        self._filler = None
+
+    def spawn(self):
+        """Starts and configures a new process."""
+        start = time.time()
+        process = SubProcess(self.path, self.args)
+        process.start()
+        for msg in self.setup:
+            process.write(msg)
+        with self.lock:
+            self.spawned += 1
+            self.spawn_time += time.time() - start
+        return process
+
+    def checkout(self, owner=None):
+        """Returns a healthy warm process, or a new one if there's none
+        idle. Process last used by @owner is preferred, otherwise least
+        recently used process is taken so recent owners keep theirs. Dead
+        idle processes found on the way are killed. Triggers a refill if the pool went below its minimum."""
+        process = None
+        dead = []
+        with self.lock:
+            if owner is not None:
+                for candidate in self.idle:
+                    if candidate.owner == owner:
+                        self.idle.remove(candidate)
+                        if candidate.is_alive():
+                            process = candidate
+                            self.affinity += 1
+                        else:
+                            dead.append(candidate)
+                        break
+            while self.idle and process is None:
+                process = self.idle.pop(0)
+                if not process.is_alive():
+                    dead.append(process)
+                    process = None
+            if process is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        for candidate in dead: # reaped like check() does
+            self.kill(candidate)
+        if process is None:
+            process = self.spawn()
+        else:
+            process.truncate() # drop previous game output
+        self.refill()
+        return process
+
+    def checkin(self, process):
+        """Returns @process to the pool, it's killed if it's dead or the
+        pool is full."""
+        with self.lock:
+            if process.is_alive() and len(self.idle) < self.max_size:
+                process.truncate()
+                self.idle.append(process)
+                process = None
+        if process is not None:
+            self.kill(process)
+
+    def kill(self, process):
+        """Sends quit command and kills @process."""
+        if self.quit and process.is_alive():
+            try:
+                process.write(self.quit)
+            except IOError: # broken pipe
+                pass
+        process.kill()
+        with self.lock:
+            self.killed += 1
+
+    def discard(self, process):
+        """Kills a failed @process, a hung or dead process is never
+        returned to the pool."""
+        with self.lock:
+            self.failed += 1
+        self.kill(process)
+
+    def check(self):
+        """Health check, discards dead idle processes and refills pool."""
+        with self.lock:
+            dead = [process for process in self.idle
+                        if not process.is_alive()]
+            self.idle = [process for process in self.idle
+                            if process not in dead]
+        for process in dead:
+            self.kill(process)
+        self.refill()
+
+    def fill(self):
+        """Spawns processes until pool reaches its minimum size."""
+        for i in xrange(self.min_size - len(self.idle)):
+            try:
+                process = self.spawn()
+            except OSError: # binary not available
+                break
+            self.checkin(process)
+
+    def refill(self):
+        """Fills pool in background if it went below its minimum size."""
+        with self.lock:
+            if len(self.idle) >= self.min_size or \
+               (self._filler and self._filler.is_alive()):
+                return
+            self._filler = threading.Thread(target=self.fill,
+                                            name='pool filler')
+            self._filler.setDaemon(True)
+            self._filler.start()
+
+    def close(self):
+        """Kills idle processes."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for process in idle:
+            self.kill(process)
+
+    def stats(self):
+        """Returns pool counters."""
+        with self.lock:
+            return {'idle': len(self.idle),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'affinity': self.affinity,
+                    'failed': self.failed,
+                    'spawned': self.spawned,
+                    'killed': self.killed,
+                    'spawn_time': self.spawn_time}
+
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def get_pool(path, args=None, setup=None, quit=None, min_size=0,
+             max_size=4):
+    """Returns the process pool for the given engine configuration,
+    creating it if needed."""
+    key = (path, tuple(args or []), tuple(setup or []))
+    with POOLS_LOCK:
+        if key not in POOLS:
+            POOLS[key] = ProcessPool(path, args, setup, quit, min_size,
+                                     max_size)
+        return POOLS[key]
+
+
+def check_pools():
+    """Runs health check on every pool."""
+    with POOLS_LOCK:
+        pools = POOLS.values()
+    for pool in pools:
+        pool.check()
+
+
+def close_pools():
+    """Kills idle processes in every pool and stops the engines
+    supervisor."""
+    with POOLS_LOCK:
+        pools = POOLS.values()
+    for pool in pools:
+        pool.close()
+    SUPERVISOR.stop()
+
+
+def pools_stats():
+    """Returns counters of every pool keyed by engine command and setup
+    commands."""
+    with POOLS_LOCK:
+        pools = POOLS.items()
+    stats = {}
+    for (path, args, setup), pool in pools:
+        name = ' '.join((path,) + args)
+        if setup:
+            name += ' (%s)' % ', '.join(setup)
+        stats[name] = pool.stats()
+    return stats
+
+
+class Matcher(object):
+    """
+    Streaming matcher for engine output. Expected regular expressions are
+    combined in a single precompiled pattern and each line is checked once
+    as it arrives, first matching line wins.
+
+    @rules is a list of (regex, function) tuples.
+    """
+    CACHE_SIZE = 512
+    _cache = {}
+
+    def __init__(self, rules):
+        key = tuple(regex.pattern for regex, func in rules)
+        pattern = self._cache.get(key)
+        if pattern is None:
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.clear()
+            pattern = re.compile('|'.join('(?P<r%d>%s)' % (i, source)
+                                            for i, source in enumerate(key)))
+            self._cache[key] = pattern
+        self.pattern = pattern
+        self.funcs = dict(('r%d' % i, func)
+                            for i, (regex, func) in enumerate(rules))
+        self.lines = 0 # lines checked so far
+        self.rest = [] # lines after the matching line
+
+    def feed(self, lines):
+        """Checks new @lines, returns (function, [matched line]) for the
+        first matching line or None."""
+        search = self.pattern.search
+        for index, line in enumerate(lines):
+            self.lines += 1
+            match = search(line)
+            if match:
+                self.rest = lines[index + 1:]
+                return self.funcs[match.lastgroup], [line]
+
+
+PROMPTS = {}
+
+def prompt_re(template, number):
+    """Returns compiled prompt regular expression for @template and move
+    @number, expressions are compiled once."""
+    key = (template, number)
+    regex = PROMPTS.get(key)
+    if regex is None:
+        regex = PROMPTS[key] = re.compile(template % (number,))
+    return regex
+
+
 def parse_move(value):
     """Parses result string usually used by GNUChess and Crafty to get move.
     Examples:
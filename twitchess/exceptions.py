@@ -9,3 +9,15 @@ class InvalidMove(GameError):
 
 class UnknowError(GameError):
     """An unknow error has ocurred"""
+
+class ServerBusy(GameError):
+    """Play queue is overloaded, command was rejected"""
+
+class EngineError(GameError):
+    """Engine process failed"""
+
+class EngineTimeout(EngineError):
+    """Engine didn't answer before its deadline"""
+
+class EngineDied(EngineError):
+    """Engine process ended"""
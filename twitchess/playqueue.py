@@ -1,12 +1,29 @@
-import time
-from threading import Thread
-from Queue import Queue, Empty
+from __future__ import with_statement
 
-from twitchess.exceptions import GameExistsError, GameError, InvalidMove
+import sys
+import time
+from collections import deque
+from traceback import print_exc
+from threading import Thread, Lock, Event
+
+import simplejson
+
+from twitchess import settings
+from twitchess.stats import Stats
+from twitchess.scheduler import get_scheduler, INTERACTIVE, LOOKUP, \
+                                BACKGROUND
+from twitchess.cache import reply_cache
+from twitchess.exceptions import GameExistsError, GameError, InvalidMove, \
+                                 ServerBusy, EngineTimeout
+from twitchess.engines.base import ACTIVE, FINISHED, ABANDONED, FAILED
+from twitchess.engines.utils import close_pools, check_pools, \
+                                    pools_stats
 from twitchess.engines.gnuchess import GNUChess as DefaultEngine
 
 
 INVALID_MOVE = False
+BUSY = 'server busy, retry later'
+NO_GAME = 'No game exists for %s'
 
 
 def print_result(cmd):
@@ -15,41 +32,112 @@ def print_result(cmd):
 
 
 class Command(object):
-    """Representation of an engine command."""
+    """Representation of an engine command. Works as a future, callers
+    can wait() until the command was ran."""
+    # command can be rejected when the queue is overloaded
+    sheddable = True
+    # command runs only on idle workers and is cancelled by game commands
+    speculative = False
+    # scheduler class (see scheduler.py)
+    klass = INTERACTIVE
+
     def __init__(self, game, handler):
         """
         Init method. Details:
             @game       game instance
             @handler    function to invoke on some result
             @result     store result on this attribute
+            @error      exception raised by action, if any
+            @times      timestamps (enqueue, dequeue, write, output, match,
+                        finish) recorded while the command is ran
         """
         self.game = game
         self.handler = handler
+        self.user = None # user who sent the command, if any
         self.result = None
+        self.error = None
+        self.budget = None # engine think time budget in milliseconds
+        self.cancelled = False
+        self.finished = Event()
+        self.times = {}
 
     def notify(self):
         """Notify listener"""
         if self.handler and callable(self.handler):
             self.handler(self)
 
-    def execute(self):
+    def execute(self, ran=None):
         """
-        Call engine action and notify after action was ran.
+        Call engine action and notify after action was ran. @ran is called
+        with the command before it's notified and marked as finished, so
+        commands it queues go before the ones queued by waiting callers.
 
         Note: Do not override this method, instead override do_execute.
         """
-        self.do_execute()
-        self.notify()
+        self.game.times = self.times # engine IO timestamps
+        try:
+            self.do_execute()
+        except Exception, e:
+            self.error = e
+        finally:
+            self.game.times = None
+            self.times['finish'] = time.time()
+        try:
+            if ran is not None:
+                ran(self)
+            self.notify()
+        finally:
+            self.finished.set()
+
+    def cancel(self):
+        """Marks command as finished without running it."""
+        self.cancelled = True
+        self.finished.set()
+
+    def fail(self, error):
+        """Marks command as finished with @error without running it,
+        listener is notified."""
+        self.error = error
+        try:
+            self.notify()
+        finally:
+            self.finished.set()
+
+    def done(self):
+        """Returns True if command was ran or cancelled."""
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until command is finished or @timeout seconds passed.
+        Returns True if command is finished."""
+        self.finished.wait(timeout)
+        return self.finished.is_set()
 
     def do_execute(self):
         """Call engine action. Override in subclasses with needed action."""
         raise NotImplementedError
 
+    def followup(self):
+        """Returns command to queue for the same game after this one ran,
+        or None. Override in subclasses."""
+        return None
+
     def __str__(self):
         """Command str method."""
         return '%s in %s' % (self.result or self.__class__.__name__, self.game)
 
 
+class Start(Command):
+    """Starts a new game on an engine process, spawning or resetting the
+    process runs on a worker instead of the caller thread."""
+    sheddable = False
+
+    def do_execute(self):
+        """Starts game engine. Stores True in result."""
+        self.game.start()
+        self.result = True
+
+
 class Move(Command):
     """Move class, stores move and response"""
     def __init__(self, game, handler, move):
@@ -60,14 +148,23 @@ class Move(Command):
             @move       player move position
         """
         self.move = move
+        self.speculated = None # reply was speculated (True), missed (False)
         super(Move, self).__init__(game, handler)
 
     def do_execute(self):
         """Passes move to current game. Stores engine response in result."""
         try:
-            self.result = self.game.move(self.move)
+            self.result = self.game.move(self.move, self.budget)
         except InvalidMove:
             self.result = INVALID_MOVE
+        self.speculated = self.game.speculated
+
+    def followup(self):
+        """Returns speculation of player next move if enabled and the
+        engine replied."""
+        if settings.SPECULATE_MOVES and self.result and \
+           not self.game.multiplayer and self.game.is_over() is None:
+            return Speculate(self.game, None, settings.SPECULATE_MOVES)
 
     def __str__(self):
         """Print move pair (user, engine) or invalid move message."""
@@ -77,8 +174,42 @@ class Move(Command):
             return '%s %s in %s' % (self.move, self.result, self.game)
 
 
+class Speculate(Command):
+    """Precomputes engine replies to likely player moves while the player
+    thinks. Stores number of replies computed in result."""
+    speculative = True
+    klass = BACKGROUND
+
+    def __init__(self, game, handler, count):
+        """
+        Init method. Argument details:
+            @game       game instance
+            @handler    handler to invoke on response
+            @count      candidate player moves
+        """
+        self.count = count
+        self.interrupted = False # set when a game command arrives
+        super(Speculate, self).__init__(game, handler)
+
+    def interrupt(self):
+        """Stops speculation, engine search in progress is cut short."""
+        self.interrupted = True
+        self.game.stop()
+
+    def do_execute(self):
+        """Computes candidates replies until done or interrupted."""
+        self.result = 0
+        for move in self.game.candidates(self.count):
+            if self.interrupted:
+                break
+            if self.game.speculate(move, self.budget):
+                self.result += 1
+
+
 class Fen(Command):
     """FEN notation command."""
+    klass = LOOKUP
+
     def do_execute(self):
         """Store FEN string in result."""
         self.result = self.game.fen()
@@ -88,97 +219,639 @@ class Fen(Command):
         return self.result
 
 
+class Hibernate(Command):
+    """Parks an idle game, its engine process is returned to the pool
+    and restored on next engine command."""
+    sheddable = False
+    klass = BACKGROUND
+
+    def __init__(self, game, handler, timeout):
+        """
+        Init method. Argument details:
+            @game       game instance
+            @handler    handler to invoke on response
+            @timeout    seconds game must be idle to be parked
+        """
+        self.timeout = timeout
+        super(Hibernate, self).__init__(game, handler)
+
+    def do_execute(self):
+        """Hibernates game if it's still idle. Stores True in result if
+        game was parked."""
+        if time.time() - self.game.last_active >= self.timeout and \
+           not self.game.is_hibernated():
+            self.game.hibernate()
+            self.result = True
+
+
+class Recover(Command):
+    """Discards the dead engine process of a game, position is restored on
+    a new process by next engine command."""
+    sheddable = False
+    klass = BACKGROUND
+
+    def do_execute(self):
+        """Recovers game if its process is still dead. Stores True in
+        result if process was discarded."""
+        if self.game.is_dead():
+            self.game.recover()
+            self.result = True
+
+
+class End(Command):
+    """Ends a game, engine process is returned to the pool."""
+    sheddable = False
+    klass = LOOKUP
+
+    def do_execute(self):
+        """Ends game."""
+        self.game.end()
+        self.result = True
+
+
+class Export(Command):
+    """Ends a game and stores its moves pairs list and think limits in
+    result, used to move the game to another play queue."""
+    sheddable = False
+    klass = LOOKUP
+
+    def do_execute(self):
+        """Ends game and stores {'moves': pairs, 'limits': limits}."""
+        self.game.end()
+        self.result = {'moves': list(self.game.moves),
+                       'limits': self.game.game_limits()}
+
+
 class ActionManager(object):
     """
     Asynchronous action manager. Accepts Command objects which passes
-    commands to game engines. Works over two queues, one where commands
-    are stored before running, and a second where results are proceesed.
+    commands to game engines. Commands are stored in per-game mailboxes
+    and ran by a fixed number of workers, commands for the same game are
+    ran one at a time in arrival order while different games run in
+    parallel. Games without pending commands don't have a mailbox.
+    Games with pending commands wait for a worker in the scheduler (see
+    scheduler.py) in the class of their next command.
+
+    Sheddable commands are rejected with ServerBusy when the queue, the
+    game mailbox or the user has too many commands queued.
+
+    Speculative commands are low priority: they are dropped when other
+    games are waiting for a worker or the game has commands pending or
+    is ending, a running speculation is interrupted when a game command
+    finds no idle worker, and queued or running speculations of a game
+    are cancelled or interrupted when a command for it arrives.
     """
-    def __init__(self):
-        self.pending = Queue()
-        self.made = []
+    def __init__(self, workers=None, scheduler=None):
+        self.size = workers or settings.PLAYQUEUE_WORKERS
+        # games with pending commands, PLAYQUEUE_SCHEDULER by default
+        self.ready = scheduler or get_scheduler()
+        self.mailboxes = {} # game -> commands not ran yet
+        self.queued = 0 # commands queued or running
+        self.users = {} # user -> commands queued or running
+        self.rejected = 0
+        self.speculating = {} # game -> running speculative command
+        self.idle = 0 # workers waiting for a game
+        self.stats = Stats(settings.STATS_SAMPLES)
+        self.lock = Lock()
         self.running = False
-        self._in_thread, self._out_thread = None, None
+        self.workers = []
+
+    def admit(self, command, mailbox):
+        """Raises ServerBusy if @command can't be queued, call it with lock
+        held."""
+        if not command.sheddable:
+            return
+        # queued speculations are cancelled by game commands
+        speculative = len([queued for queued in mailbox or ()
+                                if queued.speculative])
+        if (settings.MAX_QUEUED_COMMANDS and
+            self.queued - speculative >= settings.MAX_QUEUED_COMMANDS) or \
+           (settings.MAX_GAME_COMMANDS and mailbox is not None and
+            len(mailbox) - speculative >= settings.MAX_GAME_COMMANDS) or \
+           (settings.MAX_USER_COMMANDS and command.user is not None and
+            self.users.get(command.user, 0) >= settings.MAX_USER_COMMANDS):
+            self.rejected += 1
+            raise ServerBusy, BUSY
 
     def add(self, command):
-        """Add item to queue to be processing."""
+        """Add item to queue to be processing. Raises ServerBusy if the
+        command is rejected."""
         if isinstance(command, Command):
-            self.pending.put(command)
+            command.times['enqueue'] = time.time()
+            with self.lock:
+                failed = command.game.state == FAILED
+                if not failed:
+                    self.enqueue(command)
+            if failed: # game was removed meanwhile
+                command.fail(GameError(NO_GAME % command.game.white))
+
+    def enqueue(self, command):
+        """Queues @command in its game mailbox, call it with lock held."""
+        mailbox = self.mailboxes.get(command.game)
+        if command.speculative and (mailbox or command.game.ended):
+            command.cancel() # would be interrupted or game is gone
+            self.stats.count('speculations_dropped')
+            return
+        self.admit(command, mailbox)
+        if not command.speculative:
+            self.interrupt(command.game, mailbox)
+        self.queued += 1
+        if command.user is not None:
+            self.users[command.user] = \
+                    self.users.get(command.user, 0) + 1
+        if mailbox is None: # game idle, schedule it
+            self.mailboxes[command.game] = deque([command])
+            self.ready.put(command.game, command.klass,
+                           command.user)
+            if not command.speculative and \
+               self.ready.qsize() > self.idle:
+                self.make_room()
+        else: # game already scheduled or running
+            mailbox.append(command)
+            # next command changed if speculations were cancelled
+            self.ready.reschedule(command.game, mailbox[0].klass,
+                                  mailbox[0].user)
+
+    def fail(self, game, error):
+        """Marks @game as failed, its queued commands and commands added
+        later fail with @error without running. Call it from a command of
+        @game, so the game isn't waiting for a worker."""
+        with self.lock:
+            game.state = FAILED
+            mailbox = self.mailboxes.get(game) or deque()
+            commands = list(mailbox)
+            mailbox.clear()
+            for command in commands:
+                self.release(command)
+        for command in commands:
+            command.fail(error)
+
+    def release(self, command):
+        """Drops @command from queue counters, call it with lock held."""
+        self.queued -= 1
+        if command.user is not None:
+            self.users[command.user] -= 1
+            if not self.users[command.user]:
+                del self.users[command.user]
+
+    def interrupt(self, game, mailbox):
+        """Cancels speculative commands queued for @game and interrupts
+        its running one, call it with lock held."""
+        running = self.speculating.get(game)
+        if running is not None and not running.interrupted:
+            running.interrupt()
+        if mailbox:
+            for queued in [queued for queued in mailbox
+                                if queued.speculative]:
+                mailbox.remove(queued)
+                self.queued -= 1
+                queued.cancel()
+                self.stats.count('speculations_cancelled')
+
+    def make_room(self):
+        """Interrupts a running speculation so its worker takes the next
+        ready game, call it with lock held."""
+        for running in self.speculating.itervalues():
+            if not running.interrupted:
+                running.interrupt()
+                break
+
+    def speculate(self, command):
+        """Queues speculative @command if no game is waiting for a
+        worker."""
+        if self.ready.qsize():
+            self.stats.count('speculations_dropped')
+            return
+        try:
+            self.add(command)
+        except ServerBusy:
+            self.stats.count('speculations_dropped')
 
     def start(self):
         """Start threads"""
         if not self.running:
             self.running = True
-            self._in_thread = Thread(target=self._in)
-            self._out_thread = Thread(target=self._out)
-            self._in_thread.start()
-            self._out_thread.start()
+            self.workers = [Thread(target=self._work, name='worker %d' % i)
+                                for i in xrange(self.size)]
+            for worker in self.workers:
+                worker.start()
 
     def end(self):
-        """Stop threads"""
+        """Stop threads, commands not ran yet are cancelled."""
         if self.running:
             self.running = False
-            self._in_thread.join()
-            self._out_thread.join()
-
-    def _out(self):
-        """Process threads ran or running. Ran threads are joined while
-        running are left untouched."""
-        while self.running:
-            for thread in self.made:
-                if not thread.is_alive():
-                    thread.join()
-            # Use sleep because Conditions or other locking system does't fit
-            # well to this purpose
-            time.sleep(0.5)
-
-    def _in(self):
-        """Process user moves queue."""
-        while self.running:
-            try: # check for 1 sec and continue if it was empty
-                command = self.pending.get(timeout=1)
-            except Empty:
-                pass
-            else:
-                thread = Thread(target=command.execute)
-                thread.start()
-                self.made.append(thread)
+            self.ready.close() # wake up workers
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+            with self.lock:
+                mailboxes, self.mailboxes = self.mailboxes, {}
+                self.queued = 0
+                self.users = {}
+            self.ready.open()
+            for mailbox in mailboxes.itervalues():
+                for command in mailbox:
+                    command.cancel()
+
+    def budget(self):
+        """Returns engine think time budget in milliseconds for the next
+        command. Latency target is split among the games waiting for a
+        worker, so replies go out in bounded time when the queue backs
+        up."""
+        load = self.ready.qsize() / float(self.size)
+        return max(settings.MIN_MOVETIME,
+                   int(settings.LATENCY_TARGET / (1 + load)))
+
+    def depth(self):
+        """Returns commands queued or running."""
+        return self.queued
+
+    def pending(self, game):
+        """Returns commands queued for @game and not running yet."""
+        with self.lock:
+            return len(self.mailboxes.get(game) or ())
+
+    def snapshot(self):
+        """Returns latency stats with queue gauges and scheduler wait per
+        class."""
+        with self.lock:
+            busy = len(self.mailboxes)
+            pending = sum(len(mailbox)
+                            for mailbox in self.mailboxes.itervalues())
+            queued, rejected = self.queued, self.rejected
+        self.stats.gauge('queue_depth', self.ready.qsize())
+        self.stats.gauge('busy_games', busy)
+        self.stats.gauge('pending_commands', pending)
+        self.stats.gauge('queued_commands', queued)
+        self.stats.gauge('rejected_commands', rejected)
+        self.stats.gauge('workers', self.size)
+        snapshot = self.stats.snapshot()
+        counters = snapshot['counters']
+        hits = counters.get('speculation_hits', 0)
+        lookups = hits + counters.get('speculation_misses', 0)
+        snapshot['gauges']['speculation_hit_rate'] = \
+                lookups and float(hits) / lookups
+        snapshot['scheduler'] = self.ready.stats()
+        return snapshot
+
+    def count(self, command):
+        """Updates engine errors and speculation counters for ran
+        @command. Engine hangs and deaths are counted as they are caught,
+        whether the command recovered from them or failed."""
+        game = command.game
+        failures, game.failures = game.failures, ()
+        for error in failures:
+            self.stats.count('engine_timeouts'
+                                if isinstance(error, EngineTimeout)
+                                else 'engine_deaths')
+        if isinstance(command, Recover) and command.result: # died idle
+            self.stats.count('engine_deaths')
+        if command.speculative:
+            self.stats.count('speculations', command.result or 0)
+            if command.interrupted:
+                self.stats.count('speculations_interrupted')
+        elif isinstance(command, Move) and command.speculated is not None:
+            self.stats.count('speculation_hits' if command.speculated
+                                else 'speculation_misses')
+
+    def ran(self, command):
+        """Records stats of ran @command and queues its followup, called
+        before the command is finished."""
+        self.stats.command(command)
+        self.count(command)
+        followup = command.followup()
+        if followup is not None:
+            self.speculate(followup)
+
+    def _work(self):
+        """Runs next command of a ready game, game is scheduled again
+        while it has commands pending."""
+        while True:
+            with self.lock:
+                self.idle += 1
+            game = self.ready.get()
+            with self.lock:
+                self.idle -= 1
+            if game is None or not self.running: # wake up signal
+                break
+
+            with self.lock:
+                command = self.mailboxes[game].popleft()
+                if command.speculative:
+                    self.speculating[game] = command
+            command.times['dequeue'] = time.time()
+            command.budget = self.budget()
+            try:
+                if command.speculative and self.ready.qsize():
+                    command.cancel() # other games are waiting
+                    self.stats.count('speculations_cancelled')
+                else:
+                    command.execute(self.ran)
+            except Exception: # keep worker alive
+                print_exc()
+            finally:
+                with self.lock:
+                    self.speculating.pop(game, None)
+                    self.release(command)
+                    mailbox = self.mailboxes[game]
+                    if mailbox: # scheduled again for next command
+                        self.ready.put(game, mailbox[0].klass,
+                                       mailbox[0].user)
+                    else:
+                        del self.mailboxes[game]
 
 
 class PlayQueue(object):
-    def __init__(self):
+    def __init__(self, engine=DefaultEngine):
         self.games = {}
+        # games started or moved since they hibernated, multiplexed games
+        # hold no process between moves and aren't counted
+        self.active = set()
+        self.games_lock = Lock()
+        self.engine = engine # engine of new games
         self.mm = ActionManager()
         self.mm.start()
-
-    def new(self, name, engine=DefaultEngine):
+        engine.pool().refill() # pre-spawn default engine processes
+        self.stopped = Event()
+        self._janitor = Thread(target=self._janitor_loop, name='janitor')
+        self._janitor.start()
+        self._dumper = None
+        if settings.STATS_INTERVAL:
+            self._dumper = Thread(target=self._stats_loop,
+                                  name='stats dumper')
+            self._dumper.start()
+
+    def new(self, name, engine=None, limits=None, notify_handler=None):
         """
-        Creates a game for @name and with @engine. Raises GameError if game
-        already exists
+        Creates a game for @name and with @engine (queue engine by default).
+        Raises GameError if game already exists and ServerBusy if there
+        are MAX_GAMES games or MAX_ACTIVE_GAMES active games (see
+        active_games()), the new game counts as active. @limits is a dict with game think limits
+        (movetime, depth, nodes). Engine is started by a queued Start
+        command, if it fails the game is removed and its queued commands
+        fail with GameError. Returns Start command.
         """
-        if name not in self.games:
-            self.games[name] = engine(name=name)
-        else:
-            raise GameExistsError, '%s is already playing a game' % name
+        game = (engine or self.engine)(name)
+        if limits:
+            game.limit(**limits)
+        with self.games_lock:
+            if name in self.games:
+                raise GameExistsError, '%s is already playing a game' % name
+            if settings.MAX_GAMES and len(self.games) >= settings.MAX_GAMES:
+                raise ServerBusy, BUSY
+            if settings.MAX_ACTIVE_GAMES and \
+               len(self.active) >= settings.MAX_ACTIVE_GAMES:
+                raise ServerBusy, BUSY
+            self.games[name] = game
+            if not game.multiplex:
+                self.active.add(game)
+
+        def started(cmd):
+            """Drops game if its engine failed to start."""
+            if cmd.error is not None:
+                self.pop(name, game)
+                self.mm.fail(game, GameError(NO_GAME % name))
+                game.end()
+            if notify_handler:
+                notify_handler(cmd)
+
+        command = Start(game, started)
+        command.user = name
+        self.mm.add(command)
+        return command
 
     def move(self, name, move, notify_handler=print_result):
-        """Passes a move to a game."""
-        self.command(name, Move, notify_handler, move)
+        """Passes a move to a game, a hibernated game counts as active
+        again. Raises ServerBusy if it would wake a hibernated game while
+        there are MAX_ACTIVE_GAMES active games. Returns Move command."""
+        with self.games_lock:
+            game = self.games.get(name)
+            waking = game is not None and not game.multiplex and \
+                     game not in self.active
+            if waking:
+                if settings.MAX_ACTIVE_GAMES and \
+                   len(self.active) >= settings.MAX_ACTIVE_GAMES:
+                    raise ServerBusy, BUSY
+                self.active.add(game)
+        try:
+            return self.command(name, Move, notify_handler, move)
+        except GameError: # rejected or removed meanwhile
+            if waking:
+                with self.games_lock:
+                    if game.is_hibernated() and not self.mm.pending(game):
+                        self.active.discard(game)
+            raise
 
     def fen(self, name, notify_handler=print_result):
-        """Passes a move to a game."""
-        self.command(name, Fen, notify_handler)
+        """Passes a move to a game. Returns Fen command."""
+        return self.command(name, Fen, notify_handler)
 
     def command(self, name, CmdClass, notify_handler, *args, **kwargs):
-        """Passes a command to a game. Raises GameError if game doen't exist"""
+        """Passes a command to a game. Raises GameError if game doen't exist
+        and ServerBusy if queue is overloaded. Returns command instance
+        which can be waited for."""
+        game = self.games.get(name)
+        if game is None:
+            raise GameError, NO_GAME % name
+        command = CmdClass(game, notify_handler, *args, **kwargs)
+        command.user = name
+        self.mm.add(command)
+        return command
+
+    def remove(self, name, notify_handler=None):
+        """Ends game for @name once its pending commands ran. Raises
+        GameError if game doen't exist. Returns End command."""
+        game = self.pop(name) # janitor may remove it too
+        if game is None:
+            raise GameError, NO_GAME % name
+        game.ended = True # no more speculation
+        command = End(game, notify_handler)
+        self.mm.add(command)
+        return command
+
+    def export(self, name, notify_handler=None):
+        """Removes game for @name once its pending commands ran, moves
+        list and limits are stored in command result. Raises GameError if game
+        doen't exist. Returns Export command."""
+        game = self.pop(name) # janitor may remove it too
+        if game is None:
+            raise GameError, NO_GAME % name
+        game.ended = True # no more speculation
+        command = Export(game, notify_handler)
+        self.mm.add(command)
+        return command
+
+    def load(self, name, moves, engine=None, limits=None):
+        """Creates a game for @name with @engine from an exported @moves
+        list and @limits dict, moved games are not limited by MAX_GAMES.
+        Raises GameError if game already exists or moves are invalid."""
         if name in self.games:
-            self.mm.add(CmdClass(self.games[name], notify_handler, *args,
-                                 **kwargs))
-        else:
-            raise GameError, 'No game exists for %s' % name
+            raise GameExistsError, '%s is already playing a game' % name
+        game = (engine or self.engine)(name)
+        if limits:
+            game.limit(**limits)
+        try:
+            game.replay(moves)
+        except GameError:
+            game.end()
+            raise
+        with self.games_lock: # hibernated until next move
+            if name in self.games:
+                game.end()
+                raise GameExistsError, \
+                        '%s is already playing a game' % name
+            self.games[name] = game
+
+    def pop(self, name, game=None):
+        """Removes game for @name (only if it's @game when given) and
+        returns it, or None if there's no such game."""
+        with self.games_lock:
+            current = self.games.get(name)
+            if current is None or (game is not None and current is not game):
+                return None
+            del self.games[name]
+            self.active.discard(current)
+            return current
+
+    def depth(self):
+        """Returns commands queued or running."""
+        return self.mm.depth()
+
+    def names(self):
+        """Returns players with a game."""
+        return self.games.keys()
+
+    def active_games(self):
+        """Returns active games, games started or moved since they last
+        hibernated, whether their engine started yet or not. Hibernated
+        and multiplexed games are not counted."""
+        return len(self.active)
+
+    def hibernated(self, command):
+        """Stops counting game parked by Hibernate @command as active,
+        unless commands that wake it up are queued."""
+        game = command.game
+        if command.result:
+            with self.games_lock:
+                if not self.mm.pending(game):
+                    self.active.discard(game)
+
+    def hibernate(self, timeout=None):
+        """Schedules hibernation of games idle for @timeout seconds
+        (settings.HIBERNATE_TIMEOUT by default)."""
+        timeout = timeout or settings.HIBERNATE_TIMEOUT
+        now = time.time()
+        for game in self.games.values():
+            if not game.is_hibernated() and \
+               now - game.last_active >= timeout:
+                self.mm.add(Hibernate(game, self.hibernated, timeout))
+
+    def reap(self, finished=None, abandoned=None):
+        """Removes games over for @finished seconds and games idle for
+        @abandoned seconds (settings.FINISHED_TIMEOUT and ABANDON_TIMEOUT
+        by default), abandoned games are marked before removal. Games end
+        once their pending commands ran. Returns removed players."""
+        finished = finished or settings.FINISHED_TIMEOUT
+        abandoned = abandoned or settings.ABANDON_TIMEOUT
+        now = time.time()
+        removed = []
+        for name, game in self.games.items():
+            idle = now - game.last_active
+            if game.state == FINISHED and idle >= finished:
+                pass
+            elif abandoned and idle >= abandoned:
+                game.state = ABANDONED
+            else:
+                continue
+            try:
+                self.remove(name)
+            except GameError: # removed meanwhile
+                continue
+            removed.append(name)
+        return removed
+
+    def memory(self):
+        """Returns games memory report:
+            {'games': {player: {'state': state, 'plies': plies,
+                                'bytes': bytes}},
+             'count': games, 'total': bytes}
+        Engine processes are not included."""
+        games = {}
+        for name, game in self.games.items():
+            games[name] = {'state': game.state, 'plies': len(game.plies),
+                           'bytes': game.memory()}
+        return {'games': games, 'count': len(games),
+                'total': sum(game['bytes'] for game in games.itervalues())}
+
+    def supervise(self):
+        """Schedules recovery of games whose engine process died while
+        idle, hung engines are caught by read deadlines."""
+        for game in self.games.values():
+            if game.is_dead():
+                self.mm.add(Recover(game, None))
+
+    def stats(self):
+        """Returns latency stats, queue and games gauges, engine pools and
+        replies cache counters. Active games are counted like admission
+        does (see active_games()), hibernated games are games holding no
+        engine process."""
+        games = self.games.values()
+        hibernated = len([game for game in games if game.is_hibernated()])
+        self.mm.stats.gauge('games', len(games))
+        self.mm.stats.gauge('active_games', self.active_games())
+        self.mm.stats.gauge('hibernated_games', hibernated)
+        for state in (ACTIVE, FINISHED, ABANDONED):
+            self.mm.stats.gauge('games_%s' % state,
+                                len([game for game in games
+                                        if game.state == state]))
+        self.mm.stats.gauge('games_memory',
+                            sum(game.memory() for game in games))
+        stats = self.mm.snapshot()
+        stats['pools'] = pools_stats()
+        cache = reply_cache()
+        if cache is not None:
+            stats['cache'] = cache.stats()
+        return stats
+
+    def _stats_loop(self):
+        """Periodically appends stats as a JSON line to STATS_FILE (stderr
+        if not set)."""
+        while not self.stopped.is_set():
+            self.stopped.wait(settings.STATS_INTERVAL)
+            if self.stopped.is_set():
+                break
+            line = simplejson.dumps(dict(self.stats(), time=time.time()))
+            if settings.STATS_FILE:
+                with open(settings.STATS_FILE, 'a') as fobj:
+                    fobj.write(line + '\n')
+            else:
+                print >>sys.stderr, line
+
+    def _janitor_loop(self):
+        """Periodically removes finished and abandoned games, replaces dead
+        engine processes, parks idle games and checks processes pools."""
+        while not self.stopped.is_set():
+            self.stopped.wait(settings.JANITOR_INTERVAL)
+            if self.stopped.is_set():
+                break
+            try:
+                self.reap()
+                self.supervise()
+                self.hibernate()
+                check_pools()
+            except Exception: # keep janitor alive
+                print_exc()
 
     def end(self):
         """Ends games and queue."""
+        self.stopped.set() # stop janitor and stats dumper
+        self._janitor.join()
+        if self._dumper is not None:
+            self._dumper.join()
         self.mm.end() # end queue
         for game in self.games.itervalues(): # end games
             game.end()
+        close_pools() # kill warm processes
+        cache = reply_cache()
+        if cache is not None:
+            cache.close()
@@ -0,0 +1,245 @@
+"""
+Adaptive mentions poller. Polls often while people are playing and backs
+off exponentially when idle, API calls are taken from a token bucket
+synced with twitter rate limit and mention pages are fetched
+concurrently. API access goes through a pluggable client, FakeClient
+stands in for tweepy in tests and benchmarks.
+"""
+from __future__ import with_statement
+
+import time
+import threading
+
+from twitchess import settings
+from twitchess.ratelimit import TokenBucket
+
+
+class TweepyClient(object):
+    """Mentions client over a tweepy API instance."""
+    def __init__(self, api):
+        self.api = api
+
+    def mentions(self, since_id=None, page=1, max_id=None):
+        """Returns mentions @page (newest first) with @since_id < id <=
+        @max_id."""
+        kwargs = {'page': page}
+        if since_id:
+            kwargs['since_id'] = since_id
+        if max_id:
+            kwargs['max_id'] = max_id
+        return self.api.mentions(**kwargs)
+
+    def rate_limit(self):
+        """Returns (remaining calls, reset timestamp)."""
+        status = self.api.rate_limit_status()
+        return status['remaining_hits'], status['reset_time_in_seconds']
+
+
+class FakeUser(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeMessage(object):
+    """Mention with the attributes used from tweepy status objects."""
+    def __init__(self, id, user, text):
+        self.id = id
+        self.user = FakeUser(user)
+        self.text = text
+
+
+class FakeClient(object):
+    """In-memory mentions client, messages are added with add()."""
+    def __init__(self, page_size=20, remaining=1000):
+        self.page_size = page_size
+        self.remaining = remaining
+        self.messages = []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def add(self, user, text):
+        """Adds a mention, returns it."""
+        with self.lock:
+            msg = FakeMessage(len(self.messages) + 1, user, text)
+            self.messages.append(msg)
+            return msg
+
+    def mentions(self, since_id=None, page=1, max_id=None):
+        with self.lock:
+            self.calls += 1
+            self.remaining -= 1
+            found = [msg for msg in reversed(self.messages)
+                        if (since_id is None or msg.id > since_id) and
+                           (max_id is None or msg.id <= max_id)]
+        start = (page - 1) * self.page_size
+        return found[start:start + self.page_size]
+
+    def rate_limit(self):
+        return self.remaining, time.time() + 3600
+
+
+class PollScheduler(object):
+    """
+    Poll interval scheduler. Interval drops to @min_interval when
+    mentions arrive and grows by @backoff on empty polls, up to
+    @active_interval while there was activity in the last @active_window
+    seconds and up to @max_interval after that. While the play queue
+    rejects messages as busy polls back off from @min_interval up to
+    @max_interval, whatever mentions arrive.
+    """
+    def __init__(self, min_interval=5, active_interval=30, max_interval=300,
+                 backoff=2.0, active_window=600):
+        self.min_interval = min_interval
+        self.active_interval = active_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.active_window = active_window
+        self.interval = min_interval
+        self.last_activity = 0
+        self.busy_interval = 0 # back off while play queue is busy
+
+    def active(self):
+        """Returns True if mentions arrived recently."""
+        return time.time() - self.last_activity < self.active_window
+
+    def update(self, found):
+        """Updates interval after a poll that got @found mentions, returns
+        seconds to wait until next poll."""
+        if found:
+            self.last_activity = time.time()
+            self.interval = self.min_interval
+        else:
+            limit = self.active_interval if self.active() else \
+                    self.max_interval
+            self.interval = min(self.interval * self.backoff, limit)
+        return max(self.interval, self.busy_interval)
+
+    def busy(self, busy):
+        """Updates busy back off, @busy tells if play queue rejected
+        messages since last poll."""
+        if busy:
+            self.busy_interval = min(max(self.busy_interval * self.backoff,
+                                         self.min_interval),
+                                     self.max_interval)
+        else:
+            self.busy_interval = 0
+
+
+class Walk(object):
+    """Mentions newer than @since_id fetched so far, newest first. Pages
+    below @max_id are fetched next."""
+    def __init__(self, since_id):
+        self.since_id = since_id
+        self.max_id = None
+        self.messages = []
+        self.seen = set()
+
+    def add(self, page):
+        """Adds a page of mentions, next pages are fetched below it."""
+        for msg in page:
+            if msg.id not in self.seen:
+                self.seen.add(msg.id)
+                self.messages.append(msg)
+        if page:
+            self.max_id = min(msg.id for msg in page) - 1
+
+
+class Poller(object):
+    """Fetches new mentions using @client, API calls are rate limited by
+    @bucket and up to @concurrency pages are fetched at once. A fetch
+    walks at most @max_pages pages, longer walks go on in next fetches."""
+    def __init__(self, client, scheduler=None, bucket=None, concurrency=1,
+                 max_pages=10):
+        self.client = client
+        self.scheduler = scheduler or PollScheduler()
+        self.bucket = bucket or TokenBucket(1, 1)
+        self.concurrency = max(1, concurrency)
+        self.max_pages = max_pages
+        self.last_sync = 0
+        self.walk = None # walk not reaching since_id yet
+
+    def sync(self):
+        """Syncs bucket with API rate limit, at most once a minute."""
+        if time.time() - self.last_sync < 60:
+            return
+        self.last_sync = time.time()
+        try:
+            remaining, reset = self.client.rate_limit()
+        except Exception: # rate limit status not available
+            return
+        self.bucket.update(remaining, reset)
+
+    def page(self, walk, number, pages):
+        """Fetches @walk page @number into @pages dict, the exception is
+        stored instead if it fails."""
+        self.bucket.consume()
+        try:
+            pages[number] = self.client.mentions(walk.since_id, number,
+                                                 walk.max_id)
+        except Exception, e:
+            pages[number] = e
+
+    def fetch(self, since_id=None):
+        """Returns mentions newer than @since_id, oldest first. Mentions
+        are returned once the walk reaches @since_id, so none is skipped
+        and they stay in order: a walk longer than max_pages goes on
+        below the oldest mention fetched on next fetches, which return
+        nothing meanwhile. Client errors are raised, pages fetched before
+        the failed one are kept for next fetch."""
+        self.sync()
+        if self.walk is None:
+            self.walk = Walk(since_id)
+        walk = self.walk
+        pages = {}
+        number = 1
+        while number <= self.max_pages:
+            batch = range(number, min(number + self.concurrency,
+                                      self.max_pages + 1))
+            if len(batch) == 1:
+                self.page(walk, batch[0], pages)
+            else:
+                threads = [threading.Thread(target=self.page,
+                                            args=(walk, n, pages))
+                                for n in batch]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            for n in batch:
+                if isinstance(pages[n], Exception):
+                    self.resume(walk, pages, n)
+                    raise pages[n]
+            if not all(pages[n] for n in batch): # reached last page
+                self.walk = None
+                for n in sorted(pages):
+                    walk.add(pages[n])
+                return walk.messages[::-1]
+            number += len(batch)
+        self.resume(walk, pages, number)
+        return []
+
+    def resume(self, walk, pages, end):
+        """Adds @pages before page @end to @walk, next fetch goes on below
+        them."""
+        for n in xrange(1, end):
+            walk.add(pages[n])
+
+    def next_interval(self, found):
+        """Returns seconds to wait after a poll that got @found mentions,
+        never less than needed to get an API call from the bucket. A walk
+        in progress goes on after the shortest interval."""
+        interval = self.scheduler.update(found)
+        if self.walk is not None:
+            interval = self.scheduler.min_interval
+        return max(interval, self.bucket.delay())
+
+
+def poller(client):
+    """Returns poller for @client configured from settings."""
+    scheduler = PollScheduler(settings.MIN_CHECK_INTERVAL,
+                              settings.CHECK_INTERVAL,
+                              settings.MAX_CHECK_INTERVAL,
+                              settings.CHECK_BACKOFF,
+                              settings.ACTIVE_WINDOW)
+    bucket = TokenBucket(settings.API_RATE, settings.API_BURST)
+    return Poller(client, scheduler, bucket, settings.POLL_CONCURRENCY)
@@ -0,0 +1,58 @@
+"""Token bucket rate limiter shared by twitter API consumers."""
+from __future__ import with_statement
+
+import time
+import threading
+
+
+class TokenBucket(object):
+    """
+    Token bucket, @rate tokens per second are added up to @capacity.
+    Bucket can be synced with API rate limit information with update().
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.stamp = time.time()
+        self.blocked_until = 0 # API said no calls until then
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        """Adds tokens earned since last refill."""
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, tokens=1):
+        """Returns seconds to wait until @tokens are available."""
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            wait = max(0, self.blocked_until - now)
+            if self.tokens < tokens:
+                wait = max(wait, (tokens - self.tokens) / self.rate)
+            return wait
+
+    def consume(self, tokens=1, block=True):
+        """Takes @tokens from bucket. Waits for them if @block is True,
+        otherwise returns False if they are not available."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+            if not block:
+                return False
+            time.sleep(self.delay(tokens))
+
+    def update(self, remaining, reset):
+        """Syncs bucket with API rate limit, @remaining calls are left
+        until @reset timestamp."""
+        with self.lock:
+            self._refill(time.time())
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0:
+                self.blocked_until = reset
@@ -0,0 +1,368 @@
+"""
+Board images. Boards are rendered from FEN as PNG or SVG without engine
+involvement, rendered images are kept in a LRU cache keyed by position,
+orientation and format, and served over HTTP at settings.BOARD_URL.
+
+PNG boards are composited from sprites rasterized once per piece and
+square color, so rendering a board is copying 8 sprite rows per pixel
+row into a reused buffer and compressing it.
+"""
+from __future__ import with_statement
+
+import sys
+import zlib
+import struct
+import urllib
+import threading
+from urlparse import urlparse, parse_qs
+from os.path import abspath, dirname
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+if __name__ == '__main__': # running as a script, make package importable
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from twitchess import settings
+from twitchess.board import Board
+from twitchess.cache import LRUCache
+from twitchess.exceptions import InvalidMove
+
+
+LIGHT = (240, 217, 181)
+DARK  = (181, 136, 99)
+
+# piece colors, (body, outline)
+WHITE_PIECE = ((255, 255, 255), (0, 0, 0))
+BLACK_PIECE = ((40, 40, 40), (0, 0, 0))
+
+# 16x16 piece masks, # is outline, . is body and space is transparent
+MASKS = {
+    'p': ['                ',
+          '                ',
+          '                ',
+          '       ##       ',
+          '      #..#      ',
+          '      #..#      ',
+          '       ##       ',
+          '      #..#      ',
+          '      #..#      ',
+          '     #....#     ',
+          '     #....#     ',
+          '    #......#    ',
+          '    ########    ',
+          '                ',
+          '                ',
+          '                '],
+    'r': ['                ',
+          '                ',
+          '   ##  ##  ##   ',
+          '   #.##..##.#   ',
+          '   #........#   ',
+          '    #......#    ',
+          '    #......#    ',
+          '    #......#    ',
+          '    #......#    ',
+          '    #......#    ',
+          '   #........#   ',
+          '  #..........#  ',
+          '  ############  ',
+          '                ',
+          '                ',
+          '                '],
+    'n': ['                ',
+          '       # #      ',
+          '      #.#.#     ',
+          '     #.....#    ',
+          '    #...#...#   ',
+          '   #.........#  ',
+          '   #...##....#  ',
+          '    ##  #....#  ',
+          '       #.....#  ',
+          '      #......#  ',
+          '     #.......#  ',
+          '    #........#  ',
+          '    ##########  ',
+          '                ',
+          '                ',
+          '                '],
+    'b': ['                ',
+          '       ##       ',
+          '      #..#      ',
+          '       ##       ',
+          '      #..#      ',
+          '     #.#..#     ',
+          '     #..#.#     ',
+          '     #....#     ',
+          '      #..#      ',
+          '      #..#      ',
+          '     #....#     ',
+          '   #........#   ',
+          '   ##########   ',
+          '                ',
+          '                ',
+          '                '],
+    'q': ['                ',
+          '  #    ##    #  ',
+          ' #.#  #..#  #.# ',
+          '  #.# #..# #.#  ',
+          '  #..#....#..#  ',
+          '   #........#   ',
+          '   #........#   ',
+          '    #......#    ',
+          '    #......#    ',
+          '   #........#   ',
+          '  #..........#  ',
+          '  ############  ',
+          '                ',
+          '                ',
+          '                ',
+          '                '],
+    'k': ['                ',
+          '       ##       ',
+          '     ##..##     ',
+          '       ##       ',
+          '   ### ## ###   ',
+          '  #...#..#...#  ',
+          '  #....##....#  ',
+          '  #..........#  ',
+          '   #........#   ',
+          '    #......#    ',
+          '    #......#    ',
+          '   #........#   ',
+          '   ##########   ',
+          '                ',
+          '                ',
+          '                '],
+}
+
+# SVG pieces glyphs
+GLYPHS = {'K': u'\u2654', 'Q': u'\u2655', 'R': u'\u2656', 'B': u'\u2657',
+          'N': u'\u2658', 'P': u'\u2659', 'k': u'\u265a', 'q': u'\u265b',
+          'r': u'\u265c', 'b': u'\u265d', 'n': u'\u265e', 'p': u'\u265f'}
+
+PNG = 'png'
+SVG = 'svg'
+CONTENT_TYPES = {PNG: 'image/png', SVG: 'image/svg+xml'}
+ORIENTATIONS = ('white', 'black')
+
+
+def png_chunk(kind, data):
+    """Returns PNG chunk."""
+    return struct.pack('>I', len(data)) + kind + data + \
+           struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def encode_png(width, height, raw, level=6):
+    """Returns RGB PNG image for @raw rows, each row starts with filter
+    type byte."""
+    return '\x89PNG\r\n\x1a\n' + \
+           png_chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+                                         8, 2, 0, 0, 0)) + \
+           png_chunk('IDAT', zlib.compress(str(raw), level)) + \
+           png_chunk('IEND', '')
+
+
+def board_squares(fen):
+    """Returns 8 lists of 8 pieces (None for empty squares) from rank 8
+    to rank 1 for @fen, a FEN with only pieces placement is accepted.
+    Raises InvalidMove on invalid FEN."""
+    fields = fen.split()
+    if len(fields) == 1:
+        fields.append('w')
+    board = Board(' '.join(fields))
+    return [[board.squares[rank * 16 + col] for col in xrange(8)]
+                for rank in xrange(7, -1, -1)]
+
+
+class BoardRenderer(object):
+    """
+    Renders board images with a LRU cache of rendered images.
+
+    @square     square size in pixels, multiple of 16
+    @cache_size rendered images kept
+    """
+    def __init__(self, square=32, cache_size=1000):
+        self.square = square - square % 16 or 16
+        self.size = self.square * 8
+        self.cache = LRUCache(cache_size)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sprites = self.rasterize()
+        # rows buffer reused by each PNG, a filter byte and RGB pixels
+        self.row_size = 1 + self.size * 3
+        self.buffer = bytearray(self.row_size * self.size)
+
+    def rasterize(self):
+        """Returns {(piece, square color): sprite rows} where sprite rows
+        are RGB strings of a square, piece None is an empty square."""
+        scale = self.square / 16
+        sprites = {}
+        for background in (LIGHT, DARK):
+            empty = ''.join(chr(c) for c in background) * self.square
+            sprites[(None, background)] = [empty] * self.square
+            for piece in MASKS.keys() + [piece.upper() for piece in MASKS]:
+                body, outline = WHITE_PIECE if piece.isupper() else \
+                                BLACK_PIECE
+                colors = {' ': background, '.': body, '#': outline}
+                rows = []
+                for mask_row in MASKS[piece.lower()]:
+                    row = ''.join(''.join(chr(c) for c in colors[char]) *
+                                        scale
+                                    for char in mask_row)
+                    rows.extend([row] * scale)
+                sprites[(piece, background)] = rows
+        return sprites
+
+    def get(self, fen, orientation='white', format=PNG):
+        """Returns @format image of @fen board seen from @orientation
+        side. Raises InvalidMove on invalid FEN."""
+        placement = fen.split()[0] if fen.strip() else fen
+        key = (placement, orientation, format)
+        image = self.cache.get(key)
+        if image is not None:
+            with self.lock:
+                self.hits += 1
+            return image
+        squares = board_squares(fen)
+        if orientation == 'black':
+            squares = [list(reversed(row)) for row in reversed(squares)]
+        image = self.png(squares) if format == PNG else self.svg(squares)
+        self.cache.set(key, image)
+        with self.lock:
+            self.misses += 1
+        return image
+
+    def png(self, squares):
+        """Returns PNG image for @squares rows."""
+        with self.lock: # buffer is shared
+            buff, row_size, square = self.buffer, self.row_size, self.square
+            for rank, pieces in enumerate(squares):
+                sprites = [self.sprites[(piece, LIGHT if (rank + col) % 2 == 0
+                                                      else DARK)]
+                                for col, piece in enumerate(pieces)]
+                for y in xrange(square):
+                    start = (rank * square + y) * row_size + 1
+                    buff[start:start + row_size - 1] = \
+                        ''.join(sprite[y] for sprite in sprites)
+            return encode_png(self.size, self.size, buff)
+
+    def svg(self, squares):
+        """Returns SVG image for @squares rows."""
+        square = self.square
+        parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" '
+                 'height="%d" viewBox="0 0 %d %d">' % ((self.size,) * 4)]
+        for rank, pieces in enumerate(squares):
+            for col, piece in enumerate(pieces):
+                color = LIGHT if (rank + col) % 2 == 0 else DARK
+                parts.append('<rect x="%d" y="%d" width="%d" height="%d" '
+                             'fill="#%02x%02x%02x"/>' % \
+                                ((col * square, rank * square, square,
+                                  square) + color))
+                if piece is not None:
+                    parts.append(u'<text x="%d" y="%d" font-size="%d" '
+                                 u'text-anchor="middle">%s</text>' % \
+                                    (col * square + square / 2,
+                                     rank * square + square * 4 / 5,
+                                     square * 4 / 5, GLYPHS[piece]))
+        parts.append('</svg>')
+        return u''.join(parts).encode('utf-8')
+
+    def stats(self):
+        """Returns cache counters."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.cache), 'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': lookups and float(self.hits) / lookups}
+
+
+RENDERER = None
+RENDERER_LOCK = threading.Lock()
+
+def renderer():
+    """Returns shared board renderer configured from settings."""
+    global RENDERER
+    with RENDERER_LOCK:
+        if RENDERER is None:
+            RENDERER = BoardRenderer(settings.BOARD_SQUARE,
+                                     settings.BOARD_CACHE_SIZE)
+        return RENDERER
+
+
+def board_path():
+    """Returns (path prefix, extension) of boards in settings.BOARD_URL,
+    like ('/board/', '.png')."""
+    path = urlparse(settings.BOARD_URL).path
+    prefix, suffix = path.split('%s', 1)
+    return prefix, suffix
+
+
+class BoardHandler(BaseHTTPRequestHandler):
+    """Serves board images at BOARD_URL paths, the FEN has spaces
+    replaced by _ and any of .png or .svg extensions. ?orientation=black
+    flips the board, orientations other than white or black are
+    rejected."""
+    def do_GET(self):
+        url = urlparse(self.path)
+        prefix, suffix = board_path()
+        if not url.path.startswith(prefix):
+            self.send_error(404)
+            return
+        fen = url.path[len(prefix):]
+        for format in (PNG, SVG):
+            if fen.endswith('.' + format):
+                fen = fen[:-len(format) - 1]
+                break
+        else:
+            format = suffix.lstrip('.') or PNG
+            if suffix and fen.endswith(suffix):
+                fen = fen[:-len(suffix)]
+        orientation = parse_qs(url.query).get('orientation', ['white'])[0]
+        if orientation not in ORIENTATIONS: # would fill the cache
+            self.send_error(400, 'Invalid orientation')
+            return
+        fen = urllib.unquote(fen).replace('_', ' ')
+        try:
+            image = renderer().get(fen, orientation, format)
+        except InvalidMove:
+            self.send_error(400, 'Invalid FEN')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES[format])
+        self.send_header('Content-Length', str(len(image)))
+        self.send_header('Cache-Control', 'public, max-age=86400')
+        self.end_headers()
+        self.wfile.write(image)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BoardServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def board_server(host='', port=None):
+    """Returns HTTP server of board images, port is taken from
+    settings.BOARD_URL by default."""
+    port = port or urlparse(settings.BOARD_URL).port or 80
+    return BoardServer((host, port), BoardHandler)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', dest='host', default='',
+                      help='Address to listen on')
+    parser.add_option('--port', type='int', dest='port', default=None,
+                      help='Port to listen on (BOARD_URL port by default)')
+    options, args = parser.parse_args()
+
+    server = board_server(options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print >>sys.stderr, 'Interrupted'
+    finally:
+        server.server_close()
@@ -0,0 +1,312 @@
+"""
+Outbound replies pipeline. Command results are queued as replies, replies
+to the same user sent close in time are coalesced in a single status
+(like a move and its board link), and statuses are posted within a token
+bucket budget with retries. Replies for games in progress go first.
+Statuses are posted through a pluggable transport, SinkTransport keeps
+them in memory for tests and benchmarks. Replies still pending when the
+pipeline ends are stored in a journal file and queued again on next
+start.
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import urllib
+import threading
+from traceback import print_exc
+
+import simplejson
+
+from twitchess import settings
+from twitchess.ratelimit import TokenBucket
+
+
+# reply priorities, lower goes first
+PLAYING = 0 # moves in games in progress
+NORMAL  = 1 # boards, new games, errors
+LOW     = 2 # ended games
+
+MAX_LENGTH = 140
+
+
+class TweepyTransport(object):
+    """Posts replies as statuses using a tweepy API instance."""
+    def __init__(self, api):
+        self.api = api
+
+    def send(self, user, text, in_reply_to=None):
+        self.api.update_status('@%s %s' % (user, text),
+                               in_reply_to_status_id=in_reply_to)
+
+
+class SinkTransport(object):
+    """Stores replies in sent list."""
+    def __init__(self):
+        self.sent = []
+
+    def send(self, user, text, in_reply_to=None):
+        self.sent.append((user, text, in_reply_to))
+
+
+class Reply(object):
+    """Pending reply for a user, texts are joined when sent."""
+    def __init__(self, user, text, in_reply_to, priority, due):
+        self.user = user
+        self.texts = [text]
+        self.in_reply_to = in_reply_to
+        self.priority = priority
+        self.due = due
+        self.attempts = 0
+
+    def text(self):
+        return ', '.join(self.texts)
+
+    def fits(self, text):
+        """Returns True if @text can be appended to this reply."""
+        return len('@%s %s, %s' % (self.user, self.text(), text)) <= \
+               MAX_LENGTH
+
+
+def split_text(text, size):
+    """Returns @text split in parts of @size characters at most, on
+    spaces when possible."""
+    parts = []
+    while len(text) > size:
+        cut = text.rfind(' ', 0, size + 1)
+        if cut <= 0: # a single long word, like an URL
+            cut = size
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return parts
+
+
+def board_url(fen):
+    """Returns board image URL for @fen."""
+    return settings.BOARD_URL % urllib.quote(fen.replace(' ', '_'))
+
+
+def result_reply(result):
+    """Returns (text, priority) for a playqueue server result dict."""
+    text = result.get('result')
+    if result.get('error'):
+        return result['error'], NORMAL
+    command = (result.get('msg') or '').split()
+    command = [word for word in command if word[0] not in '@#']
+    command = command and command[0].lower()
+    if command == 'fen':
+        return 'check the board here %s' % board_url(text), NORMAL
+    if command == 'end':
+        return text, LOW
+    if command == 'new':
+        return text, NORMAL
+    return text, PLAYING
+
+
+class ReplyPipeline(object):
+    """
+    Queues and sends replies.
+
+    @transport  object with send(user, text, in_reply_to) method
+    @bucket     TokenBucket limiting posted statuses
+    @window     seconds a reply waits for others to coalesce with
+    @retries    send attempts before a reply is dropped
+    @journal    file where replies pending on end are stored, or None to
+                drop them
+    """
+    def __init__(self, transport, bucket=None, window=2, retries=3,
+                 backoff=5, journal=None):
+        self.transport = transport
+        self.bucket = bucket or TokenBucket(1, 1)
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.journal = journal
+        self.pending = {} # user -> Reply waiting for window
+        self.queue = [] # (priority, due, seq, reply) entries
+        self.seq = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.lock = threading.Condition()
+        self.running = False
+        self._thread = None
+
+    def add(self, user, text, in_reply_to=None, priority=NORMAL):
+        """Queues reply @text for @user, it's coalesced with a pending
+        reply to the same user if it fits. Text too long for a status is
+        split in several replies."""
+        with self.lock:
+            for part in split_text(text, MAX_LENGTH - len('@%s ' % user)):
+                self._add(user, part, in_reply_to, priority)
+            self.lock.notify()
+
+    def _add(self, user, text, in_reply_to, priority):
+        """Queues or coalesces reply @text, call it with lock held."""
+        reply = self.pending.get(user)
+        if reply is not None and reply.fits(text):
+            reply.texts.append(text)
+            if priority < reply.priority: # take better priority
+                reply.priority = priority
+                self._push(reply)
+            self.coalesced += 1
+            return
+        reply = Reply(user, text, in_reply_to, priority,
+                      time.time() + self.window)
+        self.pending[user] = reply
+        self._push(reply)
+
+    def result(self, result):
+        """Queues reply for a playqueue server result dict."""
+        text, priority = result_reply(result)
+        if text and result.get('user'):
+            self.add(result['user'], text, result.get('id'), priority)
+
+    def _push(self, reply):
+        """Schedules @reply, entries left with an old priority are skipped
+        when taken."""
+        self.seq += 1
+        self.queue.append((reply.priority, reply.due, self.seq, reply))
+
+    def _next(self):
+        """Returns best due reply once a bucket token is taken for it,
+        waits for both on the condition so end() wakes it up. Returns
+        None on stop."""
+        with self.lock:
+            while self.running:
+                now = time.time()
+                due = [entry for entry in self.queue if entry[1] <= now]
+                timeout = None
+                if due:
+                    entry = min(due)
+                    reply = entry[3]
+                    if entry[0] != reply.priority: # rescheduled entry
+                        self.queue.remove(entry)
+                        continue
+                    if self.bucket.consume(block=False):
+                        self.queue.remove(entry)
+                        if self.pending.get(reply.user) is reply:
+                            del self.pending[reply.user]
+                        return reply
+                    # still pending meanwhile, so it keeps coalescing
+                    timeout = self.bucket.delay()
+                elif self.queue:
+                    timeout = min(entry[1] for entry in self.queue) - now
+                self.lock.wait(timeout)
+
+    def _send(self, reply):
+        """Sends @reply, returns True if it was sent."""
+        try:
+            self.transport.send(reply.user, reply.text(), reply.in_reply_to)
+        except Exception:
+            print_exc()
+            reply.attempts += 1
+            return False
+        with self.lock:
+            self.sent += 1
+        return True
+
+    def _run(self):
+        """Sender loop."""
+        while True:
+            reply = self._next()
+            if reply is None:
+                break
+            if not self._send(reply):
+                with self.lock:
+                    if reply.attempts < self.retries:
+                        reply.due = time.time() + \
+                                    self.backoff * 2 ** (reply.attempts - 1)
+                        self._push(reply)
+                        self.lock.notify()
+                    else:
+                        self.failed += 1
+
+    def start(self):
+        """Starts sender thread, replies stored in journal are queued
+        again."""
+        if not self.running:
+            self.load()
+            self.running = True
+            self._thread = threading.Thread(target=self._run,
+                                            name='replies sender')
+            self._thread.start()
+
+    def end(self):
+        """Stops sender thread, it's woken up if it waits for a reply or
+        the bucket. Pending replies are sent while the bucket allows it,
+        the rest are stored in journal (see flush())."""
+        if self.running:
+            with self.lock:
+                self.running = False
+                self.lock.notify()
+            self._thread.join()
+            self.flush()
+
+    def flush(self):
+        """Sends pending replies right away while bucket has tokens, the
+        rest are stored in journal, or dropped and counted as failed if
+        there's no journal."""
+        with self.lock:
+            entries, self.queue = sorted(self.queue), []
+            self.pending = {}
+        replies = []
+        for entry in entries:
+            if entry[0] == entry[3].priority and entry[3] not in replies:
+                replies.append(entry[3])
+        left = [reply for reply in replies
+                    if not self.bucket.consume(block=False) or
+                       not self._send(reply)]
+        if left and self.journal:
+            self.store(left)
+        elif left:
+            print >>sys.stderr, '%d pending replies dropped' % len(left)
+            with self.lock:
+                self.failed += len(left)
+
+    def store(self, replies):
+        """Appends @replies to journal, a JSON line each."""
+        with open(self.journal, 'a') as fobj:
+            for reply in replies:
+                fobj.write(simplejson.dumps({'user': reply.user,
+                                             'text': reply.text(),
+                                             'in_reply_to': reply.in_reply_to,
+                                             'priority': reply.priority})
+                           + '\n')
+            fobj.flush()
+            os.fsync(fobj.fileno())
+
+    def load(self):
+        """Queues replies stored in journal and removes it."""
+        if not self.journal or not os.path.exists(self.journal):
+            return
+        with open(self.journal) as fobj:
+            for line in fobj:
+                try:
+                    reply = simplejson.loads(line)
+                except ValueError: # partial line written on a crash
+                    continue
+                self.add(reply['user'], reply['text'],
+                         reply.get('in_reply_to'),
+                         reply.get('priority', NORMAL))
+        os.remove(self.journal)
+
+    def stats(self):
+        """Returns pipeline counters."""
+        with self.lock:
+            return {'queued': len(self.queue), 'sent': self.sent,
+                    'coalesced': self.coalesced, 'failed': self.failed}
+
+
+def pipeline(transport):
+    """Returns started replies pipeline for @transport configured from
+    settings."""
+    replies = ReplyPipeline(transport,
+                            TokenBucket(settings.REPLY_RATE,
+                                        settings.REPLY_BURST),
+                            settings.REPLY_COALESCE, settings.REPLY_RETRIES,
+                            journal=settings.REPLIES_FILE)
+    replies.start()
+    return replies
@@ -0,0 +1,283 @@
+"""
+Play queue schedulers. ActionManager keeps commands in per-game mailboxes
+and puts a game in the scheduler while it has commands pending, workers
+take the next game from it. A game is scheduled in the class of its next
+command:
+
+    interactive     player moves, an engine search
+    lookup          board lookups, game ends and exports, no engine
+                    search so they are cheap
+    background      speculation, hibernation and recovery
+
+Schedulers:
+
+    fifo    games in arrival order, whatever their class or user
+    fair    classes share workers by weight and users take turns within
+            a class, so a cheap lookup doesn't wait behind a backlog of
+            moves and a user with many games doesn't starve the others.
+            Games waiting for too long are ran first.
+
+Queue wait (put -> get) is reported per class.
+"""
+from __future__ import with_statement
+
+import time
+import heapq
+import threading
+from itertools import count
+from collections import deque
+
+from twitchess import settings
+from twitchess.stats import Histogram
+
+
+INTERACTIVE = 'interactive'
+LOOKUP      = 'lookup'
+BACKGROUND  = 'background'
+CLASSES     = (INTERACTIVE, LOOKUP, BACKGROUND)
+
+
+class Entry(object):
+    """Scheduled game."""
+    def __init__(self, game, klass, user):
+        self.game = game
+        self.klass = klass
+        self.user = user
+        self.time = time.time()
+        self.valid = True # False once served or rescheduled
+
+
+class Scheduler(object):
+    """
+    Ready games queue shared by workers, works like Queue for put(), get()
+    and qsize(). A game is queued at most once, subclasses decide which
+    game goes next implementing push() and pop(), both called with lock
+    held.
+    """
+    def __init__(self, samples=None):
+        self.lock = threading.Condition()
+        self.entries = {} # game -> waiting entry
+        self.closed = False
+        self.waits = dict((klass,
+                           Histogram(samples or settings.STATS_SAMPLES))
+                                for klass in CLASSES)
+
+    def put(self, game, klass=INTERACTIVE, user=None):
+        """Schedules @game in class @klass for @user."""
+        with self.lock:
+            entry = Entry(game, klass, user)
+            self.entries[game] = entry
+            self.push(entry)
+            self.lock.notify()
+
+    def reschedule(self, game, klass, user=None):
+        """Moves @game to class @klass if it's waiting in another class,
+        used when its next command changed. Game keeps its waiting time
+        for aging and wait stats."""
+        with self.lock:
+            entry = self.entries.get(game)
+            if entry is not None and entry.klass != klass:
+                entry.valid = False
+                self.discard(entry)
+                waiting, entry = entry, Entry(game, klass, user)
+                entry.time = waiting.time
+                self.entries[game] = entry
+                self.push(entry)
+
+    def get(self):
+        """Blocks until a game is ready and returns it, None is returned
+        once the scheduler is closed."""
+        with self.lock:
+            while not self.entries and not self.closed:
+                self.lock.wait()
+            if self.closed:
+                return None
+            entry = self.pop()
+            entry.valid = False
+            del self.entries[entry.game]
+            self.waits[entry.klass].add((time.time() - entry.time) * 1000.0)
+            return entry.game
+
+    def qsize(self):
+        """Returns games waiting for a worker."""
+        return len(self.entries)
+
+    def close(self):
+        """Wakes up workers, games waiting are dropped."""
+        with self.lock:
+            self.closed = True
+            self.entries = {}
+            self.clear()
+            self.lock.notifyAll()
+
+    def open(self):
+        """Accepts games again after close()."""
+        with self.lock:
+            self.closed = False
+
+    def stats(self):
+        """Returns {class: {'queued': games, 'wait': summary}}, wait is
+        in milliseconds."""
+        with self.lock:
+            queued = dict((klass, 0) for klass in CLASSES)
+            for entry in self.entries.itervalues():
+                queued[entry.klass] += 1
+            return dict((klass, {'queued': queued[klass],
+                                 'wait': self.waits[klass].summary()})
+                            for klass in CLASSES)
+
+    def push(self, entry):
+        """Adds @entry. Override in subclasses."""
+        raise NotImplementedError
+
+    def pop(self):
+        """Removes and returns next valid entry, there is at least one.
+        Override in subclasses."""
+        raise NotImplementedError
+
+    def discard(self, entry):
+        """Called after a waiting @entry was invalidated, entries may be
+        left in place and skipped by pop()."""
+        pass
+
+    def clear(self):
+        """Drops every entry."""
+        pass
+
+
+class FIFOScheduler(Scheduler):
+    """Games in arrival order."""
+    def __init__(self, samples=None):
+        super(FIFOScheduler, self).__init__(samples)
+        self.queue = deque()
+
+    def reschedule(self, game, klass, user=None):
+        """Class is updated in place, game keeps its turn."""
+        with self.lock:
+            entry = self.entries.get(game)
+            if entry is not None:
+                entry.klass, entry.user = klass, user
+
+    def push(self, entry):
+        self.queue.append(entry)
+
+    def pop(self):
+        entry = self.queue.popleft()
+        while not entry.valid:
+            entry = self.queue.popleft()
+        return entry
+
+    def clear(self):
+        self.queue.clear()
+
+
+class Lane(object):
+    """
+    Waiting games of a class, ordered by virtual finish tag. Each game of
+    a user is tagged one after the user previous game, or after the tag
+    last served if the user had none waiting, smallest tag goes first so
+    users take turns whatever their games count.
+    """
+    def __init__(self, weight):
+        self.weight = weight
+        self.heap = [] # (tag, sequence, entry)
+        self.size = 0 # valid entries
+        self.clock = 0.0 # tag last served
+        self.tags = {} # user -> last tag given
+        self.users = {} # user -> valid entries
+        self.stride = 0.0 # class turn among classes
+        self.sequence = count()
+
+    def push(self, entry):
+        tag = max(self.clock, self.tags.get(entry.user, 0.0)) + 1
+        self.tags[entry.user] = tag
+        self.users[entry.user] = self.users.get(entry.user, 0) + 1
+        self.size += 1
+        heapq.heappush(self.heap, (tag, self.sequence.next(), entry))
+
+    def remove(self, entry):
+        """Accounts for @entry being served or invalidated elsewhere, it's
+        skipped when it reaches the top."""
+        self.size -= 1
+        self.users[entry.user] -= 1
+        if not self.users[entry.user]: # next game tagged from the clock
+            del self.users[entry.user]
+            del self.tags[entry.user]
+
+    def pop(self):
+        while True:
+            tag, sequence, entry = heapq.heappop(self.heap)
+            if entry.valid:
+                self.clock = tag
+                self.remove(entry)
+                return entry
+
+
+class FairScheduler(Scheduler):
+    """
+    Weighted fair queuing. Classes take turns in proportion to @weights,
+    the class whose next turn ends first goes (stride scheduling), and
+    users take turns within a class. A game waiting over @aging seconds
+    is ran before anything else, so background work and users sharing a
+    class with heavy users can't starve.
+    """
+    def __init__(self, weights=None, aging=None, samples=None):
+        super(FairScheduler, self).__init__(samples)
+        self.weights = weights or settings.SCHEDULER_WEIGHTS
+        self.aging = settings.SCHEDULER_AGING if aging is None else aging
+        self.lanes = dict((klass, Lane(self.weights[klass]))
+                                for klass in CLASSES)
+        self.arrivals = [] # heap of (time, sequence, entry), oldest first
+        self.sequence = count()
+        self.stride = 0.0 # stride of last served class
+        self.aged = 0 # games ran first for waiting too long
+
+    def push(self, entry):
+        lane = self.lanes[entry.klass]
+        if not lane.size: # idle class doesn't bank turns
+            lane.stride = max(lane.stride, self.stride)
+        lane.push(entry)
+        heapq.heappush(self.arrivals,
+                       (entry.time, self.sequence.next(), entry))
+
+    def discard(self, entry):
+        self.lanes[entry.klass].remove(entry)
+
+    def pop(self):
+        arrivals = self.arrivals
+        while not arrivals[0][2].valid:
+            heapq.heappop(arrivals)
+        oldest = arrivals[0][2]
+        if self.aging and time.time() - oldest.time >= self.aging:
+            self.aged += 1
+            lane = self.lanes[oldest.klass]
+            lane.remove(oldest)
+            entry = oldest
+        else:
+            lane = min((lane for lane in self.lanes.itervalues()
+                            if lane.size),
+                       key=lambda lane: lane.stride + 1.0 / lane.weight)
+            entry = lane.pop()
+        self.stride = lane.stride
+        lane.stride += 1.0 / lane.weight
+        return entry
+
+    def clear(self):
+        self.lanes = dict((klass, Lane(self.weights[klass]))
+                                for klass in CLASSES)
+        self.arrivals = []
+
+    def stats(self):
+        """Adds 'aged' count to scheduler stats."""
+        stats = super(FairScheduler, self).stats()
+        stats['aged'] = self.aged
+        return stats
+
+
+SCHEDULERS = {'fifo': FIFOScheduler, 'fair': FairScheduler}
+
+
+def get_scheduler(name=None):
+    """Returns a new scheduler @name (settings.PLAYQUEUE_SCHEDULER by
+    default)."""
+    return SCHEDULERS[name or settings.PLAYQUEUE_SCHEDULER]()
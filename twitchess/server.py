@@ -0,0 +1,424 @@
+"""
+PlayQueue daemon. Listens on settings.PLAYQUEUE_SOCKET unix socket for
+messages sent by tweets.py and streams command results back.
+
+Protocol is newline delimited JSON, each line is a message or a list of
+messages (a batch) and many lines can be sent in a single write:
+    {"id": 123, "user": "john", "msg": "@t2chess e4 #gameid"}
+Results are sent back as a line per message:
+    {"id": 123, "user": "john", "msg": "...", "result": "e5"}
+or with an "error" key if the message failed. Messages rejected by an
+overloaded queue get a "busy" key set to true, and the server stops
+reading producers while the queue is over QUEUE_HIGH_WATERMARK commands
+until it drops to QUEUE_LOW_WATERMARK.
+
+Messages with an "op" key are queue operations used by the shards router
+(see shards.py) instead of twitter messages:
+    {"id": 1, "op": "games"}                          (players with a game)
+    {"id": 2, "op": "stats"}                          (latency stats)
+    {"id": 5, "op": "memory"}                       (games memory report)
+    {"id": 3, "op": "export", "user": "john"}  (remove, get moves, limits)
+    {"id": 4, "op": "load", "user": "john", "moves": [["e4", "e5"]],
+     "limits": {"movetime": 2000, "depth": null, "nodes": null}}
+
+Server listens on a unix socket path or on a host:port TCP address.
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import errno
+import select
+import socket
+import threading
+from os.path import abspath, dirname
+from optparse import OptionParser
+
+import simplejson
+
+if __name__ == '__main__': # running as a script, make package importable
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from twitchess import settings
+from twitchess.exceptions import GameError, ServerBusy
+from twitchess.playqueue import PlayQueue, INVALID_MOVE
+from twitchess.engines.utils import set_nonblocking
+
+
+CHUNK = 65536
+ENGINE_FAILED = 'engine failed, try again (%s)'
+
+
+def parse_address(address):
+    """Returns (socket family, address) for a unix socket path or a
+    host:port string."""
+    if ':' in address and os.sep not in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def parse_message(text):
+    """Returns (command, arguments) for a twitter message text. Mentions
+    and hashtags are dropped, but users mentioned after new.
+    Supported messages:
+        new           (new game)
+        new @user2    (new game)
+        end           (surrender)
+        draw          (offer draw)
+        fen           (board FEN)
+        *             (anything else is interpreted as a move)
+    """
+    words = [word for word in text.split() if not word.startswith('#')]
+    while words and words[0].startswith('@'): # addressed mentions
+        words.pop(0)
+    if not words:
+        return None, []
+    command = words[0].lower()
+    if command in ('new', 'end', 'draw', 'fen'):
+        return command, [word.lstrip('@') for word in words[1:]]
+    return 'move', words[:1]
+
+
+class Connection(object):
+    """Producer connection, buffers partial input lines and output not
+    sent yet."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, response):
+        """Queues @response dict to be sent."""
+        with self.lock:
+            if not self.closed:
+                self.outbuf.extend(simplejson.dumps(response) + '\n')
+
+
+class PlayQueueServer(object):
+    """Non-blocking unix socket server feeding a PlayQueue."""
+    def __init__(self, queue, path=None):
+        self.queue = queue
+        self.path = path or settings.PLAYQUEUE_SOCKET
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.IN, self.OUT = select.EPOLLIN, select.EPOLLOUT
+            self.ERR = select.EPOLLHUP | select.EPOLLERR
+        else:
+            self.poller = select.poll()
+            self.IN, self.OUT = select.POLLIN, select.POLLOUT
+            self.ERR = select.POLLHUP | select.POLLERR
+        self.connections = {} # fd -> Connection
+        self.pending = set() # connections with output to send
+        self.lock = threading.Lock()
+        self.paused = False # producers are not read while queue is full
+        self.running = False
+        self.listener = None
+        self._wake_in, self._wake_out = os.pipe()
+        set_nonblocking(self._wake_in)
+        set_nonblocking(self._wake_out)
+
+    def listen(self):
+        """Binds socket, a stale unix socket file is removed."""
+        family, address = parse_address(self.path)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(address)
+        listener.listen(128)
+        listener.setblocking(0)
+        self.listener = listener
+        self.poller.register(listener.fileno(), self.IN)
+        self.poller.register(self._wake_in, self.IN)
+
+    def serve_forever(self):
+        """Serves connections until stop() is called."""
+        if self.listener is None:
+            self.listen()
+        self.running = True
+        while self.running:
+            try:
+                events = self.poller.poll()
+            except (IOError, OSError, select.error), e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self.listener.fileno():
+                    self.accept()
+                elif fd == self._wake_in:
+                    self.drain_wakeups()
+                else:
+                    conn = self.connections.get(fd)
+                    if conn is None:
+                        continue
+                    if event & (self.IN | self.ERR):
+                        self.read(conn)
+                    if event & self.OUT and not conn.closed:
+                        self.write(conn)
+        self.close()
+
+    def stop(self):
+        """Stops serving, safe to call from any thread."""
+        self.running = False
+        self.wakeup()
+
+    def close(self):
+        """Closes every connection and the listener socket."""
+        for conn in self.connections.values():
+            self.disconnect(conn)
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            family, address = parse_address(self.path)
+            if family == socket.AF_UNIX and os.path.exists(address):
+                os.unlink(address)
+
+    def wakeup(self):
+        """Wakes up poller loop."""
+        try:
+            os.write(self._wake_out, 'x')
+        except OSError: # pipe full, poller will wake up anyway
+            pass
+
+    def drain_wakeups(self):
+        """Empties wake up pipe and watches output of connections with
+        pending results."""
+        try:
+            while os.read(self._wake_in, CHUNK):
+                pass
+        except OSError: # drained
+            pass
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        for conn in pending:
+            if not conn.closed:
+                self.watch(conn)
+        self.check_backpressure()
+
+    def watch(self, conn):
+        """Watches connection input unless paused and output if there's
+        data to send."""
+        events = 0 if self.paused else self.IN
+        if conn.outbuf:
+            events |= self.OUT
+        self.poller.modify(conn.fileno(), events)
+
+    def depth(self):
+        """Returns commands queued or running."""
+        return self.queue.depth()
+
+    def check_backpressure(self):
+        """Stops reading producers when queue is over high watermark and
+        resumes once it drops to low watermark."""
+        depth = self.depth()
+        if not self.paused and settings.QUEUE_HIGH_WATERMARK and \
+           depth >= settings.QUEUE_HIGH_WATERMARK:
+            self.paused = True
+        elif self.paused and depth <= settings.QUEUE_LOW_WATERMARK:
+            self.paused = False
+        else:
+            return
+        for conn in self.connections.values():
+            self.watch(conn)
+
+    def accept(self):
+        """Accepts every waiting connection."""
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            sock.setblocking(0)
+            conn = Connection(sock)
+            self.connections[conn.fileno()] = conn
+            self.poller.register(conn.fileno(), 0 if self.paused else self.IN)
+
+    def disconnect(self, conn):
+        """Closes connection."""
+        with conn.lock:
+            conn.closed = True
+        self.connections.pop(conn.fileno(), None)
+        try:
+            self.poller.unregister(conn.fileno())
+        except (IOError, OSError, KeyError):
+            pass
+        conn.sock.close()
+
+    def read(self, conn):
+        """Reads available data and handles complete lines."""
+        while True:
+            try:
+                data = conn.sock.recv(CHUNK)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    break
+                data = ''
+            if not data: # producer went away
+                self.disconnect(conn)
+                return
+            end = data.rfind('\n')
+            if end == -1:
+                conn.inbuf.extend(data)
+                continue
+            lines = data[:end].split('\n')
+            if conn.inbuf: # first line started on a previous read
+                conn.inbuf.extend(lines[0])
+                lines[0] = str(conn.inbuf)
+                del conn.inbuf[:]
+            conn.inbuf.extend(data[end + 1:])
+            for line in lines:
+                if line.strip():
+                    self.handle_line(conn, line)
+            self.check_backpressure()
+            if self.paused: # rest is read when the queue drains
+                break
+
+    def write(self, conn):
+        """Sends pending output, stops watching output once sent."""
+        with conn.lock:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return
+                sent = None
+            if sent is not None:
+                del conn.outbuf[:sent]
+                done = not conn.outbuf
+        if sent is None:
+            self.disconnect(conn)
+        elif done:
+            self.watch(conn)
+
+    def respond(self, conn, message, **values):
+        """Queues response for @message to connection, can be called from
+        any thread."""
+        response = {'id': message.get('id'), 'user': message.get('user'),
+                    'msg': message.get('msg')}
+        response.update(values)
+        conn.send(response)
+        with self.lock:
+            self.pending.add(conn)
+        self.wakeup()
+
+    def handle_line(self, conn, line):
+        """Decodes a line with a message or a batch of messages."""
+        try:
+            messages = simplejson.loads(line)
+        except ValueError:
+            self.respond(conn, {}, error='invalid message')
+            return
+        if not isinstance(messages, list):
+            messages = [messages]
+        for message in messages:
+            if isinstance(message, dict):
+                self.handle(conn, message)
+            else:
+                self.respond(conn, {}, error='invalid message')
+
+    def handle(self, conn, message):
+        """Passes message to play queue, result is sent back when ready."""
+        if message.get('op'):
+            self.handle_op(conn, message)
+            return
+        user, text = message.get('user'), message.get('msg') or ''
+        command, args = parse_message(text)
+        if not user or command is None:
+            self.respond(conn, message, error='invalid message')
+            return
+
+        def notify(cmd):
+            """Sends command result back."""
+            if cmd.error is not None:
+                self.respond(conn, message, error=str(cmd.error))
+            elif cmd.result is INVALID_MOVE:
+                self.respond(conn, message, error='invalid move')
+            else:
+                self.respond(conn, message, result=cmd.result)
+
+        def started(cmd):
+            """Sends new game result back once engine started."""
+            if cmd.error is not None:
+                self.respond(conn, message, error=str(cmd.error))
+            else:
+                self.respond(conn, message,
+                             result='game started, whites move first')
+
+        try:
+            if command == 'new':
+                if args:
+                    raise GameError, 'multiplayer games are not supported yet'
+                self.queue.new(user, notify_handler=started)
+            elif command == 'end':
+                self.queue.remove(user, lambda cmd: self.respond(conn, message,
+                                                         result='game ended'))
+            elif command == 'draw':
+                raise GameError, 'draw offers are not supported yet'
+            elif command == 'fen':
+                self.queue.fen(user, notify)
+            else:
+                self.queue.move(user, args[0], notify)
+        except ServerBusy, e:
+            self.respond(conn, message, error=str(e), busy=True)
+        except GameError, e:
+            self.respond(conn, message, error=str(e))
+        except EnvironmentError, e: # engine couldn't be spawned
+            self.respond(conn, message, error=ENGINE_FAILED % e)
+
+    def handle_op(self, conn, message):
+        """Runs a queue operation message."""
+        op, user = message['op'], message.get('user')
+
+        def exported(cmd):
+            """Sends exported moves back."""
+            if cmd.error is not None:
+                self.respond(conn, message, error=str(cmd.error))
+            else:
+                self.respond(conn, message, result=cmd.result)
+
+        try:
+            if op == 'games':
+                self.respond(conn, message, result=self.queue.names())
+            elif op == 'stats':
+                self.respond(conn, message, result=self.queue.stats())
+            elif op == 'memory':
+                self.respond(conn, message, result=self.queue.memory())
+            elif op == 'export':
+                self.queue.export(user, exported)
+            elif op == 'load':
+                self.queue.load(user, message.get('moves') or [],
+                                limits=message.get('limits'))
+                self.respond(conn, message, result=True)
+            else:
+                self.respond(conn, message, error='unknown operation')
+        except GameError, e:
+            self.respond(conn, message, error=str(e))
+        except EnvironmentError, e: # engine couldn't be spawned
+            self.respond(conn, message, error=ENGINE_FAILED % e)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--socket', help='Unix socket path or host:port',
+                      dest='socket', default=settings.PLAYQUEUE_SOCKET)
+    options, args = parser.parse_args()
+
+    queue = PlayQueue()
+    server = PlayQueueServer(queue, options.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print >>sys.stderr, 'Interrupted'
+    finally:
+        server.close()
+        queue.end()
@@ -13,9 +13,136 @@ T2CHESS_DIR_PATH = os.path.join(os.environ['HOME'], T2CHESS_DIR_NAME)
 # file where to store last read message id
 LASTMSGID_FILENAME = 'last_msgid'
 SOCKET_FILENAME    = 'queue.sock'
+REPLIES_FILENAME   = 'replies'
 LASTMSGID_FILE     = os.path.join(T2CHESS_DIR_PATH, LASTMSGID_FILENAME)
+REPLIES_FILE       = os.path.join(T2CHESS_DIR_PATH, REPLIES_FILENAME)
 PLAYQUEUE_SOCKET   = os.path.join(T2CHESS_DIR_PATH, SOCKET_FILENAME)
-CHECK_INTERVAL     = 30 # check each 30s
+CHECK_INTERVAL     = 30 # check each 30s while games are active
+MIN_CHECK_INTERVAL = 5 # check each 5s after mentions arrive
+MAX_CHECK_INTERVAL = 300 # back off up to 5m when idle
+CHECK_BACKOFF      = 2 # interval multiplier on empty checks
+ACTIVE_WINDOW      = 600 # games are active for 10m after a mention
+POLL_CONCURRENCY   = 3 # mention pages fetched at once
+API_RATE           = 350 / 3600.0 # API calls per second
+API_BURST          = 10 # API calls allowed in a burst
+CHECKPOINT_EVERY   = 100 # store last message id each 100 messages
+CHECKPOINT_INTERVAL = 30 # or each 30s
+
+# replies, board links use BOARD_URL with the FEN (spaces as _), replies
+# to the same user within REPLY_COALESCE seconds are sent together, up to
+# REPLY_RATE statuses per second (REPLY_BURST at once) with
+# REPLY_RETRIES attempts. Replies not sent on shutdown are stored in
+# REPLIES_FILE and sent on next start
+BOARD_URL          = 'http://localhost:8080/board/%s.png'
+REPLY_COALESCE     = 2
+REPLY_RATE         = 1000 / 86400.0
+REPLY_BURST        = 20
+REPLY_RETRIES      = 3
+
+# board images served at BOARD_URL (see render.py), BOARD_SQUARE pixels
+# per square and BOARD_CACHE_SIZE rendered images kept in memory
+BOARD_SQUARE       = 32
+BOARD_CACHE_SIZE   = 1000
+
+# warm engine processes pool, min idle processes pre-spawned per engine
+# configuration and max idle processes kept after games end
+ENGINE_POOL_MIN    = 2
+ENGINE_POOL_MAX    = 8
+
+# engine replies to SPECULATE_MOVES likely player moves are computed by
+# idle workers after each engine move, so a matching player move is
+# answered right away (0 disables speculation)
+SPECULATE_MOVES    = 0
+
+# engines must answer within ENGINE_TIMEOUT seconds beyond their think
+# time, hung or dead engine processes are replaced, the game restored on
+# the new process and the command retried ENGINE_RETRIES times
+ENGINE_TIMEOUT     = 30
+ENGINE_RETRIES     = 1
+
+# multiplexed games don't own an engine process, a process is leased for
+# each engine move and its position reloaded if another game used it, so
+# processes are bound by PLAYQUEUE_WORKERS instead of games
+ENGINE_MULTIPLEX   = False
+
+# max commands ran at the same time by the play queue
+PLAYQUEUE_WORKERS  = 8
+
+# play queue scheduler (see scheduler.py), 'fair' shares workers among
+# command classes by SCHEDULER_WEIGHTS and among users within a class,
+# games waiting SCHEDULER_AGING seconds are ran first (0 disables aging).
+# 'fifo' runs games in arrival order
+PLAYQUEUE_SCHEDULER = 'fair'
+SCHEDULER_WEIGHTS  = {'interactive': 4, 'lookup': 8, 'background': 1}
+SCHEDULER_AGING    = 5
+
+# latency stats, percentiles are computed over the last STATS_SAMPLES
+# commands of each engine and command type. Stats are appended to
+# STATS_FILE (stderr if None) each STATS_INTERVAL seconds, None disables
+# the dump
+STATS_SAMPLES      = 1000
+STATS_INTERVAL     = None
+STATS_FILE         = None
+
+# admission control, play queue rejects new games past MAX_GAMES open
+# or MAX_ACTIVE_GAMES holding or starting an engine process (hibernated
+# games don't count, moves waking them are rejected past it too), and
+# commands past MAX_QUEUED_COMMANDS queued in total,
+# MAX_GAME_COMMANDS waiting per game or MAX_USER_COMMANDS per user (0
+# disables a limit). Server stops reading producers when
+# QUEUE_HIGH_WATERMARK commands are queued until they drop to
+# QUEUE_LOW_WATERMARK
+MAX_GAMES          = 50000
+MAX_ACTIVE_GAMES   = 500
+MAX_QUEUED_COMMANDS = 1000
+MAX_GAME_COMMANDS  = 4
+MAX_USER_COMMANDS  = 8
+QUEUE_HIGH_WATERMARK = 800
+QUEUE_LOW_WATERMARK = 400
+
+# sharded play queue (see shards.py), router spreads games over
+# PLAYQUEUE_SHARDS server processes with SHARD_REPLICAS virtual nodes
+# each in the hash ring. Shards must answer router calls (stats, moving
+# games) within SHARD_TIMEOUT seconds
+PLAYQUEUE_SHARDS   = 2
+SHARD_REPLICAS     = 100
+SHARD_TIMEOUT      = 5
+
+# engine think limits per move, movetime in milliseconds, None disables
+# a limit. ENGINE_LIMITS overrides them per engine class name, like
+# {'Crafty': {'depth': 12}}
+ENGINE_MOVETIME    = 2000
+ENGINE_DEPTH       = None
+ENGINE_NODES       = None
+ENGINE_LIMITS      = {}
+
+# target reply latency in milliseconds, engine think time is reduced
+# when the queue backs up, but never below MIN_MOVETIME. Depth and nodes
+# limits are capped by this think time too
+LATENCY_TARGET     = 5000
+MIN_MOVETIME       = 100
+
+# games idle for HIBERNATE_TIMEOUT seconds give their engine process back
+# and are restored on next move, janitor checks each JANITOR_INTERVAL
+HIBERNATE_TIMEOUT  = 600
+JANITOR_INTERVAL   = 60
+
+# finished games are removed FINISHED_TIMEOUT seconds after last move and
+# games idle for ABANDON_TIMEOUT seconds are abandoned and removed (None
+# keeps idle games forever)
+FINISHED_TIMEOUT   = 300
+ABANDON_TIMEOUT    = 7 * 86400
+
+# engine replies cache, REPLY_CACHE_SIZE in-memory entries (0 disables
+# the cache), REPLY_CACHE_FILE on-disk database and REPLY_CACHE_BOOK
+# opening book used to seed it (None disables them). Replies of searches
+# cut short by the play queue budget (see LATENCY_TARGET) are never
+# stored. Only replies of games limited by depth or nodes alone (no
+# ENGINE_MOVETIME) are stored if REPLY_CACHE_DETERMINISTIC is True
+REPLY_CACHE_SIZE   = 10000
+REPLY_CACHE_FILE   = None
+REPLY_CACHE_BOOK   = None
+REPLY_CACHE_DETERMINISTIC = False
 
 
 try:
@@ -0,0 +1,520 @@
+"""
+Sharded play queue. Games are spread over several play queue servers
+(see server.py) by consistent hashing of the player name, so engine
+driving overhead is not bound to a single interpreter. A router listens
+on the ingestion socket like a single play queue server would, forwards
+each message to the shard owning the player game and streams results
+back.
+
+Shards are server processes spawned by the router on this host or
+servers already listening on other hosts (host:port addresses). When a
+shard is added or removed, games whose owner changed are moved by
+exporting their moves list and think limits from the old shard and
+loading it on the new one. Rebalancing runs on its own thread, only
+messages of players whose owner changed are held until their game was
+moved. Shards must answer router calls within SHARD_TIMEOUT seconds.
+
+Router operations, besides server messages (see server.py):
+    {"id": 1, "op": "shards"}                               (addresses)
+    {"id": 2, "op": "stats"}                       (stats of each shard)
+    {"id": 3, "op": "add_shard", "address": "host2:9000"}
+    {"id": 4, "op": "remove_shard", "address": "host2:9000"}
+"""
+from __future__ import with_statement
+
+import sys
+import time
+import bisect
+import socket
+import threading
+import subprocess
+from hashlib import md5
+from itertools import count
+from os.path import abspath, dirname, join
+from optparse import OptionParser
+
+import simplejson
+
+if __name__ == '__main__': # running as a script, make package importable
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from twitchess import settings
+from twitchess.exceptions import GameError
+from twitchess.server import PlayQueueServer, parse_address, CHUNK
+
+
+class HashRing(object):
+    """Consistent hash ring, each node owns @replicas virtual nodes so
+    keys are spread evenly and only the keys of an added or removed node
+    change owner."""
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.hashes = [] # sorted virtual nodes hashes
+        self.owners = {} # virtual node hash -> node
+        for node in nodes:
+            self.add(node)
+
+    def hash(self, key):
+        """Returns ring position for @key."""
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return long(md5(key).hexdigest()[:16], 16)
+
+    def add(self, node):
+        """Adds @node virtual nodes to the ring."""
+        for i in xrange(self.replicas):
+            value = self.hash('%s#%d' % (node, i))
+            if value not in self.owners:
+                bisect.insort(self.hashes, value)
+            self.owners[value] = node
+
+    def remove(self, node):
+        """Removes @node virtual nodes from the ring."""
+        for i in xrange(self.replicas):
+            value = self.hash('%s#%d' % (node, i))
+            if self.owners.get(value) == node:
+                del self.owners[value]
+                del self.hashes[bisect.bisect_left(self.hashes, value)]
+
+    def node(self, key):
+        """Returns node owning @key or None if ring is empty."""
+        if not self.hashes:
+            return None
+        index = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.owners[self.hashes[index]]
+
+    def nodes(self):
+        """Returns nodes in the ring."""
+        return set(self.owners.itervalues())
+
+    def copy(self):
+        """Returns a ring with the same nodes."""
+        ring = HashRing(replicas=self.replicas)
+        ring.hashes = list(self.hashes)
+        ring.owners = dict(self.owners)
+        return ring
+
+
+class ShardClient(object):
+    """
+    Connection to a shard server. Responses are passed to @relay unless
+    they answer a call().
+
+    @address    unix socket path or host:port
+    @relay      function called with each response dict
+    @closed     function called with this client when connection is lost
+    @timeout    seconds to connect and to answer calls (SHARD_TIMEOUT by
+                default)
+    """
+    def __init__(self, address, relay, closed=None, timeout=None):
+        self.address = address
+        self.relay = relay
+        self.closed = closed
+        self.timeout = timeout or settings.SHARD_TIMEOUT
+        self.dead = False # connection lost, nothing can be sent
+        self.calls = {} # call id -> [Event, response, late handler]
+        self.ids = count(1)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.sock = self.connect(self.timeout)
+        self._reader = threading.Thread(target=self._read,
+                                        name='shard %s' % address)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def connect(self, timeout):
+        """Connects to shard, retries for @timeout seconds while the shard
+        starts."""
+        family, address = parse_address(self.address)
+        deadline = time.time() + timeout
+        while True:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(address)
+                return sock
+            except socket.error:
+                sock.close()
+                if time.time() >= deadline:
+                    raise
+                time.sleep(0.1)
+
+    def send(self, message):
+        """Sends @message dict to shard. Raises socket.error if connection
+        was lost, a half closed socket may still take data."""
+        if self.dead:
+            raise socket.error, 'connection lost'
+        data = simplejson.dumps(message) + '\n'
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def call(self, message, timeout=None, late=None):
+        """Sends operation @message and waits for its response, @timeout
+        seconds at most (client timeout by default). Raises GameError if
+        shard doesn't answer, @late is then called with the response if
+        it comes later."""
+        timeout = timeout or self.timeout
+        call_id = 'call-%d' % self.ids.next()
+        waiter = [threading.Event(), None, None]
+        with self.lock:
+            self.calls[call_id] = waiter
+        try:
+            self.send(dict(message, id=call_id))
+            waiter[0].wait(timeout)
+        except socket.error, e:
+            with self.lock:
+                self.calls.pop(call_id, None)
+            raise GameError, 'shard %s unavailable: %s' % (self.address, e)
+        with self.lock:
+            if waiter[1] is None and late is not None:
+                waiter[2] = late # keep waiting for a late response
+            else:
+                self.calls.pop(call_id, None)
+        if waiter[1] is None:
+            raise GameError, 'shard %s unavailable' % self.address
+        return waiter[1]
+
+    def _read(self):
+        """Reads responses until connection is lost."""
+        buff = ''
+        while True:
+            try:
+                data = self.sock.recv(CHUNK)
+            except socket.error:
+                data = ''
+            if not data:
+                break
+            lines = (buff + data).split('\n')
+            buff = lines.pop()
+            for line in lines:
+                if line.strip():
+                    self.dispatch(simplejson.loads(line))
+        self.dead = True
+        with self.lock: # wake up waiting calls
+            calls, self.calls = self.calls, {}
+        for waiter in calls.itervalues():
+            waiter[0].set()
+        if self.closed:
+            self.closed(self)
+
+    def dispatch(self, response):
+        """Passes @response to its caller or to relay."""
+        with self.lock:
+            waiter = self.calls.get(response.get('id'))
+            if waiter is not None:
+                waiter[1] = response
+                if waiter[2] is not None: # call timed out
+                    del self.calls[response['id']]
+        if waiter is None:
+            self.relay(response)
+        elif waiter[2] is not None:
+            waiter[2](response)
+        else:
+            waiter[0].set()
+
+    def close(self):
+        """Closes connection."""
+        self.closed = None
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class ShardRouter(PlayQueueServer):
+    """Ingestion server forwarding messages to shards by player name.
+    Router operations doing shard calls run on their own threads, so the
+    poll thread keeps forwarding meanwhile."""
+    def __init__(self, addresses=(), path=None, replicas=None):
+        super(ShardRouter, self).__init__(None, path)
+        self.ring = HashRing(replicas=replicas or settings.SHARD_REPLICAS)
+        self.shards = {} # address -> ShardClient
+        self.requests = {} # forwarded id -> (conn, message, address)
+        self.ids = count(1)
+        self.shards_lock = threading.RLock()
+        self.requests_lock = threading.Lock()
+        self.rebalance_lock = threading.Lock() # a rebalance at a time
+        # while rebalancing, ring before the change, and messages of
+        # players whose owner changed held until their game was moved
+        self.previous = None
+        self.held = {} # user -> [(conn, message)]
+        self.settled = set() # users whose game was moved
+        for address in addresses:
+            self.add_shard(address)
+
+    def handle(self, conn, message):
+        """Forwards message to the shard owning player game, messages of
+        games being moved are held."""
+        op = message.get('op')
+        if op in ('shards', 'stats', 'add_shard', 'remove_shard'):
+            self.handle_router_op(conn, message)
+            return
+        user = message.get('user')
+        if not user:
+            self.respond(conn, message, error='invalid message')
+            return
+        with self.shards_lock:
+            address = self.ring.node(user)
+            if address is None:
+                self.respond(conn, message, error='no shards available')
+                return
+            if self.previous is not None and user not in self.settled and \
+               self.previous.node(user) != address:
+                self.held.setdefault(user, []).append((conn, message))
+                return
+            shard = self.shards[address]
+            if shard.dead: # its requests would never be answered
+                self.respond(conn, message, error='shard unavailable')
+                return
+            request_id = self.ids.next()
+            with self.requests_lock:
+                self.requests[request_id] = (conn, message, address)
+            try:
+                shard.send(dict(message, id=request_id))
+            except socket.error:
+                with self.requests_lock:
+                    self.requests.pop(request_id, None)
+                self.respond(conn, message, error='shard unavailable')
+
+    def depth(self):
+        """Returns forwarded requests without result per shard, used for
+        backpressure."""
+        with self.requests_lock:
+            return len(self.requests) / max(1, len(self.shards))
+
+    def handle_router_op(self, conn, message):
+        """Runs a router operation message, operations calling shards run
+        on a new thread."""
+        if message['op'] == 'shards':
+            with self.shards_lock:
+                self.respond(conn, message, result=self.shards.keys())
+            return
+        worker = threading.Thread(target=self.router_op,
+                                  args=(conn, message),
+                                  name='router %s' % message['op'])
+        worker.daemon = True
+        worker.start()
+
+    def router_op(self, conn, message):
+        """Runs stats, add_shard or remove_shard @message and responds."""
+        op = message['op']
+        try:
+            if op == 'stats':
+                self.respond(conn, message, result=self.stats())
+            elif op == 'add_shard':
+                moved = self.add_shard(message.get('address'))
+                self.respond(conn, message, result=moved)
+            else:
+                moved = self.remove_shard(message.get('address'))
+                self.respond(conn, message, result=moved)
+        except (GameError, socket.error), e:
+            self.respond(conn, message, error=str(e))
+
+    def stats(self):
+        """Returns stats of each shard keyed by address."""
+        with self.shards_lock:
+            shards = self.shards.items()
+        stats = {}
+        for address, shard in shards:
+            try:
+                response = shard.call({'op': 'stats'})
+            except GameError, e:
+                response = {'error': str(e)}
+            stats[address] = response.get('result') or response.get('error')
+        return stats
+
+    def relay(self, response):
+        """Sends shard @response back to the producer connection. Shard
+        readers don't take the shards lock, so calls made while
+        rebalancing get their responses."""
+        with self.requests_lock:
+            request = self.requests.pop(response.get('id'), None)
+        if request is None:
+            return
+        conn, message, address = request
+        values = dict((key, value) for key, value in response.iteritems()
+                            if key not in ('id', 'user', 'msg'))
+        self.respond(conn, message, **values)
+
+    def shard_closed(self, shard):
+        """Fails requests forwarded to a lost shard, its games stay in the
+        ring until the shard is removed and their messages are answered
+        with an error meanwhile."""
+        print >>sys.stderr, 'Shard %s connection lost' % shard.address
+        with self.requests_lock:
+            lost = [request_id for request_id, request
+                        in self.requests.iteritems()
+                            if request[2] == shard.address]
+            requests = [self.requests.pop(request_id) for request_id in lost]
+        for conn, message, address in requests:
+            self.respond(conn, message, error='shard unavailable')
+
+    def add_shard(self, address):
+        """Connects shard at @address and moves its games to it. Returns
+        number of games moved."""
+        if not address:
+            raise GameError, 'missing shard address'
+        with self.rebalance_lock:
+            with self.shards_lock:
+                if address in self.shards:
+                    raise GameError, 'shard %s already added' % address
+            shard = ShardClient(address, self.relay, self.shard_closed)
+            with self.shards_lock:
+                self.previous = self.ring.copy()
+                self.shards[address] = shard
+                self.ring.add(address)
+            return self.rebalance()
+
+    def remove_shard(self, address):
+        """Moves games out of shard at @address and disconnects it.
+        Returns number of games moved."""
+        with self.rebalance_lock:
+            with self.shards_lock:
+                if address not in self.shards:
+                    raise GameError, 'unknown shard %s' % address
+                self.previous = self.ring.copy()
+                self.ring.remove(address)
+            try:
+                return self.rebalance()
+            finally:
+                with self.shards_lock:
+                    shard = self.shards.pop(address)
+                shard.close()
+
+    def rebalance(self):
+        """Moves every game to the shard owning it, call it with the
+        rebalance lock held after changing the ring. Held messages are
+        forwarded as games are moved and once done. Returns number of
+        games moved."""
+        moved = 0
+        try:
+            with self.shards_lock:
+                shards = self.shards.items()
+            for address, shard in shards:
+                try:
+                    games = shard.call({'op': 'games'}).get('result') or []
+                except GameError, e:
+                    print >>sys.stderr, e
+                    continue
+                for user in games:
+                    with self.shards_lock:
+                        owner = self.ring.node(user)
+                        target = self.shards.get(owner)
+                    if owner == address or target is None:
+                        continue
+                    if self.move_game(user, shard, target):
+                        moved += 1
+                    self.release(user)
+        finally:
+            with self.shards_lock: # before later messages
+                self.previous = None
+                held, self.held = self.held, {}
+                self.settled = set()
+                for messages in held.itervalues():
+                    for conn, message in messages:
+                        self.handle(conn, message)
+        return moved
+
+    def release(self, user):
+        """Forwards messages held for @user, whose game was moved."""
+        with self.shards_lock:
+            self.settled.add(user)
+            held = self.held.pop(user, [])
+            for conn, message in held: # before later messages
+                self.handle(conn, message)
+
+    def move_game(self, user, source, target):
+        """Moves @user game from @source shard to @target shard. Returns
+        True once @target loaded the game, if it didn't the game is loaded
+        back in @source. A game exported after the export call timed out
+        is loaded back in @source too."""
+        def exported(response):
+            """Restores a late export, runs in the source reader thread
+            so the load call is made from another thread."""
+            if 'result' in response:
+                threading.Thread(target=self.restore,
+                                 args=(user, source,
+                                       response['result'])).start()
+
+        try:
+            response = source.call({'op': 'export', 'user': user},
+                                   late=exported)
+            if 'error' in response:
+                raise GameError, response['error']
+        except GameError, e:
+            print >>sys.stderr, 'Game of %s not moved: %s' % (user, e)
+            return False
+        game = response['result']
+        try:
+            response = target.call({'op': 'load', 'user': user,
+                                    'moves': game['moves'],
+                                    'limits': game['limits']})
+            if 'error' in response:
+                raise GameError, response['error']
+        except GameError, e:
+            print >>sys.stderr, 'Game of %s not moved: %s' % (user, e)
+            self.restore(user, source, game)
+            return False
+        return True
+
+    def restore(self, user, shard, game):
+        """Loads exported @game of @user back in @shard."""
+        try:
+            response = shard.call({'op': 'load', 'user': user,
+                                   'moves': game['moves'],
+                                   'limits': game['limits']})
+            if 'error' in response:
+                raise GameError, response['error']
+        except GameError, e:
+            print >>sys.stderr, 'Game of %s lost: %s' % (user, e)
+
+    def close(self):
+        """Closes producer connections and shard connections."""
+        super(ShardRouter, self).close()
+        with self.shards_lock:
+            shards, self.shards = self.shards, {}
+        for shard in shards.itervalues():
+            shard.close()
+
+
+# started as a script, so shards run from any working directory
+SERVER_SCRIPT = join(dirname(abspath(__file__)), 'server.py')
+
+
+def spawn_shards(number, path=None):
+    """Starts @number play queue server processes listening on path.N
+    unix sockets. Returns (addresses, processes)."""
+    path = path or settings.PLAYQUEUE_SOCKET
+    addresses, processes = [], []
+    for i in xrange(number):
+        address = '%s.%d' % (path, i)
+        processes.append(subprocess.Popen([sys.executable, SERVER_SCRIPT,
+                                           '--socket', address]))
+        addresses.append(address)
+    return addresses, processes
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--socket', help='Unix socket path or host:port',
+                      dest='socket', default=settings.PLAYQUEUE_SOCKET)
+    parser.add_option('--shards', type='int', dest='shards',
+                      default=settings.PLAYQUEUE_SHARDS,
+                      help='Local shard processes to start')
+    parser.add_option('--connect', dest='connect', default='',
+                      help='Comma separated shard addresses to connect')
+    options, args = parser.parse_args()
+
+    addresses, processes = spawn_shards(options.shards, options.socket)
+    addresses += [address for address in options.connect.split(',')
+                    if address]
+    router = ShardRouter(addresses, options.socket)
+    try:
+        router.serve_forever()
+    except KeyboardInterrupt:
+        print >>sys.stderr, 'Interrupted'
+    finally:
+        router.close()
+        for process in processes:
+            process.terminate()
+            process.wait()
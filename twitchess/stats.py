@@ -0,0 +1,125 @@
+"""
+Play queue latency stats. Commands record timestamps as they go through
+the queue and the engine (see playqueue.Command), stats turns them into
+per engine and command type latency histograms:
+
+    wait        enqueue -> dequeue (time waiting for a worker)
+    engine      last engine write -> match (engine think and IO)
+    output      last engine write -> first output line
+    parse       first output line -> match
+    run         dequeue -> finish
+    total       enqueue -> finish
+
+Values are reported in milliseconds.
+"""
+from __future__ import with_statement
+
+import time
+import threading
+from collections import deque
+
+
+# phase -> (start timestamp, end timestamp)
+PHASES = (('wait', 'enqueue', 'dequeue'),
+          ('engine', 'write', 'match'),
+          ('output', 'write', 'output'),
+          ('parse', 'output', 'match'),
+          ('run', 'dequeue', 'finish'),
+          ('total', 'enqueue', 'finish'))
+
+
+class Histogram(object):
+    """Latency samples, percentiles are computed over the last @size
+    samples."""
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """Adds a sample."""
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, sorted_samples, percent):
+        """Returns @percent percentile of @sorted_samples."""
+        if not sorted_samples:
+            return 0.0
+        index = int(round(percent / 100.0 * (len(sorted_samples) - 1)))
+        return sorted_samples[index]
+
+    def summary(self):
+        """Returns dict with count, mean, max and p50/p95/p99."""
+        samples = sorted(self.samples)
+        return {'count': self.count,
+                'mean': self.count and self.total / self.count,
+                'max': self.max,
+                'p50': self.percentile(samples, 50),
+                'p95': self.percentile(samples, 95),
+                'p99': self.percentile(samples, 99)}
+
+
+class Stats(object):
+    """Latency histograms keyed by engine, command type and phase, gauges
+    and counters."""
+    def __init__(self, size=1000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.histograms = {} # (engine, command, phase) -> Histogram
+        self.gauges = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def observe(self, engine, command, phase, value):
+        """Adds @value milliseconds sample."""
+        key = (engine, command, phase)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.size)
+            histogram.add(value)
+
+    def command(self, command):
+        """Adds phases latencies from @command timestamps."""
+        times = command.times
+        engine = command.game.__class__.__name__
+        name = command.__class__.__name__
+        for phase, start, end in PHASES:
+            if times.get(start) and times.get(end):
+                self.observe(engine, name, phase,
+                             (times[end] - times[start]) * 1000.0)
+
+    def gauge(self, name, value):
+        """Sets gauge @name."""
+        with self.lock:
+            self.gauges[name] = value
+
+    def count(self, name, value=1):
+        """Adds @value to counter @name."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """Returns stats as a nested dict:
+            {'uptime': seconds,
+             'gauges': {name: value},
+             'counters': {name: value},
+             'latency': {engine: {command: {phase: summary}}}}"""
+        with self.lock:
+            latency = {}
+            for (engine, command, phase), histogram in \
+                    self.histograms.iteritems():
+                latency.setdefault(engine, {}).setdefault(command, {})\
+                       [phase] = histogram.summary()
+            return {'uptime': time.time() - self.started,
+                    'gauges': dict(self.gauges),
+                    'counters': dict(self.counters),
+                    'latency': latency}
+
+    def reset(self):
+        """Drops histograms."""
+        with self.lock:
+            self.histograms = {}
@@ -0,0 +1,79 @@
+"""
+Replies cache tests, games are played on the fake UCI engine.
+
+Usage:
+    python -m unittest discover twitchess/tests
+"""
+import unittest
+
+from twitchess import settings, cache
+from twitchess.cache import ReplyCache
+from twitchess.board import Board
+from twitchess.engines import fakes
+from twitchess.engines.uci import UCIEngine
+from twitchess.engines.utils import close_pools
+
+
+Engine = fakes.engine(UCIEngine, 'uci', '--think', '0')
+
+
+def fen_after(*moves):
+    """Returns FEN of position reached by @moves from starting position."""
+    board = Board()
+    for move in moves:
+        board.push(board.parse(move))
+    return board.fen()
+
+
+class ReplyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = (settings.REPLY_CACHE_SIZE,
+                         settings.REPLY_CACHE_DETERMINISTIC,
+                         settings.ENGINE_MOVETIME)
+        settings.REPLY_CACHE_SIZE = 100
+        settings.REPLY_CACHE_DETERMINISTIC = False
+        cache.REPLY_CACHE = ReplyCache(100)
+        self.games = []
+
+    def tearDown(self):
+        for game in self.games:
+            game.end()
+        close_pools()
+        cache.REPLY_CACHE = None
+        settings.REPLY_CACHE_SIZE, settings.REPLY_CACHE_DETERMINISTIC, \
+                settings.ENGINE_MOVETIME = self.settings
+
+    def game(self, **limits):
+        game = Engine('player%d' % len(self.games), **limits)
+        self.games.append(game)
+        return game
+
+    def test_full_strength_reply_is_cached(self):
+        self.game(movetime=2000).move('e4', budget=5000)
+        self.assertEqual(cache.REPLY_CACHE.stats()['stores'], 1)
+        self.game(movetime=2000).move('e4', budget=100)
+        self.assertEqual(cache.REPLY_CACHE.stats()['hits'], 1)
+
+    def test_capped_reply_not_served_to_uncapped_game(self):
+        capped = self.game(movetime=2000)
+        capped.move('e4', budget=100)
+        self.assertEqual(cache.REPLY_CACHE.stats()['stores'], 0)
+        self.assertEqual(cache.REPLY_CACHE.get(capped.cache_id(),
+                                               fen_after('e4')), None)
+        self.game(movetime=2000).move('e4', budget=5000)
+        stats = cache.REPLY_CACHE.stats()
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['stores'], 1)
+
+    def test_deterministic_depth_search_is_cached(self):
+        settings.REPLY_CACHE_DETERMINISTIC = True
+        self.game(movetime=2000).move('e4', budget=5000)
+        self.assertEqual(cache.REPLY_CACHE.stats()['stores'], 0)
+        # play queue always sends a budget, depth was reached first
+        settings.ENGINE_MOVETIME = None
+        self.game(depth=5).move('e4', budget=5000)
+        self.assertEqual(cache.REPLY_CACHE.stats()['stores'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
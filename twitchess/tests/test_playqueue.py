@@ -0,0 +1,116 @@
+"""
+Play queue tests, games are played on the fake UCI engine.
+
+Usage:
+    python -m unittest discover twitchess/tests
+"""
+import time
+import unittest
+
+from twitchess import settings
+from twitchess.playqueue import PlayQueue
+from twitchess.replies import result_reply
+from twitchess.exceptions import GameError, ServerBusy
+from twitchess.engines import fakes
+from twitchess.engines.uci import UCIEngine
+
+
+Engine = fakes.engine(UCIEngine, 'uci', '--think', '0')
+SlowEngine = fakes.engine(UCIEngine, 'uci', '--think', '300')
+
+
+class BrokenEngine(UCIEngine):
+    """Engine whose binary is missing."""
+    @classmethod
+    def pool(cls, pondering=False, *overrides):
+        return super(BrokenEngine, cls).pool(pondering, '/nonexistent/uci')
+
+
+class PlayQueueTest(unittest.TestCase):
+    settings = ('PLAYQUEUE_WORKERS', 'MAX_ACTIVE_GAMES')
+
+    def setUp(self):
+        self.saved = dict((name, getattr(settings, name))
+                            for name in self.settings)
+        settings.PLAYQUEUE_WORKERS = 1
+        settings.MAX_ACTIVE_GAMES = 3
+        self.queue = PlayQueue(Engine)
+
+    def tearDown(self):
+        self.queue.end()
+        for name, value in self.saved.iteritems():
+            setattr(settings, name, value)
+
+    def test_failed_start_fails_queued_commands(self):
+        self.queue.new('slow', SlowEngine).wait()
+        self.queue.move('slow', 'e4', None) # keeps the only worker busy
+        start = self.queue.new('john', BrokenEngine)
+        move = self.queue.move('john', 'e4', None)
+        fen = self.queue.fen('john', None)
+        for command in (start, move, fen):
+            self.assertTrue(command.wait(10))
+        self.assertTrue(start.error is not None)
+        for command in (move, fen):
+            self.assertTrue(isinstance(command.error, GameError))
+            self.assertEqual(str(command.error), 'No game exists for john')
+            self.assertEqual(command.result, None)
+        self.assertFalse('john' in self.queue.names())
+        self.assertRaises(GameError, self.queue.move, 'john', 'd4', None)
+        self.assertEqual(self.queue.depth(), 0)
+
+    def test_burst_of_starts_is_capped(self):
+        started, rejected = [], 0
+        for i in xrange(10): # Start commands are still queued
+            try:
+                started.append(self.queue.new('player%d' % i))
+            except ServerBusy:
+                rejected += 1
+        self.assertEqual((len(started), rejected), (3, 7))
+        self.assertEqual(self.queue.active_games(), 3)
+        for command in started:
+            self.assertTrue(command.wait(10))
+
+    def test_hibernated_games_free_active_slots(self):
+        for i in xrange(3):
+            self.queue.new('player%d' % i).wait(10)
+        self.assertRaises(ServerBusy, self.queue.new, 'john')
+        time.sleep(0.01)
+        self.queue.hibernate(0.001)
+        while self.queue.depth():
+            time.sleep(0.01)
+        self.assertEqual(self.queue.active_games(), 0)
+        self.queue.new('john').wait(10)
+        self.queue.move('player0', 'e4', None).wait(10)
+        self.assertEqual(self.queue.active_games(), 2)
+        self.queue.remove('player0').wait(10)
+        self.assertEqual(self.queue.active_games(), 1)
+
+    def test_waking_games_is_capped(self):
+        for i in xrange(3):
+            self.queue.new('player%d' % i).wait(10)
+        time.sleep(0.01)
+        self.queue.hibernate(0.001)
+        while self.queue.depth():
+            time.sleep(0.01)
+        for i in xrange(3, 6):
+            self.queue.new('player%d' % i).wait(10)
+        self.assertRaises(ServerBusy, self.queue.move, 'player0', 'e4', None)
+        self.assertEqual(self.queue.active_games(), 3)
+        self.queue.remove('player3').wait(10)
+        self.queue.move('player0', 'e4', None).wait(10)
+        self.assertEqual(self.queue.active_games(), 3)
+
+    def test_mating_move_gets_a_reply(self):
+        self.queue.load('john', [['e4', 'e5'], ['Bc4', 'Nc6'],
+                                 ['Qh5', 'Nf6']])
+        move = self.queue.move('john', 'Qxf7#', None)
+        self.assertTrue(move.wait(10))
+        self.assertEqual(move.error, None)
+        self.assertEqual(move.result, '1-0, checkmate')
+        text, priority = result_reply({'user': 'john', 'msg': 'Qxf7#',
+                                       'result': move.result})
+        self.assertEqual(text, '1-0, checkmate')
+
+
+if __name__ == '__main__':
+    unittest.main()
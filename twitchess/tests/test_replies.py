@@ -0,0 +1,68 @@
+"""
+Replies pipeline tests.
+
+Usage:
+    python -m unittest discover twitchess/tests
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from twitchess.ratelimit import TokenBucket
+from twitchess.replies import ReplyPipeline, SinkTransport
+
+
+class ReplyPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.dir, 'replies')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def pipeline(self, transport, bucket):
+        replies = ReplyPipeline(transport, bucket, window=0,
+                                journal=self.journal)
+        replies.start()
+        return replies
+
+    def test_end_wakes_sender_and_stores_pending_replies(self):
+        transport = SinkTransport()
+        replies = self.pipeline(transport, TokenBucket(1 / 86.4, 1))
+        replies.add('john', 'e5')
+        replies.add('jane', 'c5')
+        while not transport.sent: # second reply waits ~86s for a token
+            time.sleep(0.01)
+        time.sleep(0.05)
+        started = time.time()
+        replies.end()
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(len(transport.sent), 1)
+
+        transport = SinkTransport()
+        replies = self.pipeline(transport, TokenBucket(1, 1))
+        while not transport.sent:
+            time.sleep(0.01)
+        replies.end()
+        self.assertEqual([sent[0] for sent in transport.sent], ['jane'])
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_long_text_is_split(self):
+        transport = SinkTransport()
+        replies = self.pipeline(transport, TokenBucket(100, 100))
+        text = 'check the board here http://localhost/%s' % \
+                    ('rnbqkbnr/' * 20)
+        replies.add('john', text)
+        while len(transport.sent) < 3:
+            time.sleep(0.01)
+        replies.end()
+        statuses = [status for user, status, in_reply_to in transport.sent]
+        self.assertEqual(len(statuses), 3)
+        for status in statuses:
+            self.assertTrue(len('@john ' + status) <= 140)
+        self.assertEqual(' '.join(statuses[:2]) + statuses[2], text)
+
+if __name__ == '__main__':
+    unittest.main()
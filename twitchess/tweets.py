@@ -5,29 +5,41 @@ import sys
 import time
 import socket
 import simplejson
-from os.path import isdir, stat
+from select import select
+from os.path import isdir, stat, abspath, dirname
 from optparse import OptionParser
 
-import tweepy
+if __name__ == '__main__': # running as a script, make package importable
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
 
-import settings
+from twitchess import settings
+from twitchess.checkpoint import Checkpoint
+from twitchess.poller import TweepyClient, poller
+from twitchess.replies import TweepyTransport, pipeline
 
 
 API    = None
 LASTID = None
 SOCKET = None
+CHECKPOINT = None
+POLLER = None
+REPLIES = None
+BUFFER = '' # partial result line read from SOCKET
+BUSY = False # play queue rejected messages since last poll
 
 
-def init(socket=True):
-    """Reads configuration and initializes twitter connection"""
-    global API, LASTID, SOCKET
+def init(use_socket=True, client=None, transport=None):
+    """Reads configuration and initializes twitter connection. @client
+    replaces tweepy mentions client (see poller.FakeClient) and
+    @transport replaces replies transport (see replies.SinkTransport)."""
+    global API, LASTID, SOCKET, CHECKPOINT, POLLER, REPLIES
 
     if not isdir(settings.T2CHESS_DIR_PATH):
         print >>sys.stderr, '"%s" is not a directory' % \
                     settings.T2CHESS_DIR_PATH
         sys.exit(1)
 
-    if socket:
+    if use_socket:
         try:
             sstat = os.stat(settings.PLAYQUEUE_SOCKET)
             if sstat.st_mode & stat.S_IFSOCK != stat.S_IFSOCK:
@@ -42,32 +54,35 @@ def init(socket=True):
         SOCKET = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         SOCKET.connect(settings.PLAYQUEUE_SOCKET)
 
-    # read last message id retrieved or None to start from beggining
-    try:
-        with open(settings.LASTMSGID_FILE, 'r') as fobj:
-            try:
-                LASTID = int(fobj.readline())
-            except ValueError:
-                LASTID = None
-    except IOError: # file does not exist
-        open(settings.LASTMSGID_FILE, 'w').close()
-        LASTID = None
+    # read last message id retrieved or None to start from beggining,
+    # messages journaled after it are skipped
+    CHECKPOINT = Checkpoint(settings.LASTMSGID_FILE,
+                            settings.CHECKPOINT_EVERY,
+                            settings.CHECKPOINT_INTERVAL)
+    LASTID = CHECKPOINT.lastid
+
+    if client is None or transport is None:
+        API = tweepy_api()
+    POLLER = poller(client or TweepyClient(API))
+    REPLIES = pipeline(transport or TweepyTransport(API))
+    return API
+
 
+def tweepy_api():
+    """Returns tweepy API authenticated with settings keys. tweepy is
+    imported here, so fake clients and transports run without it."""
+    import tweepy
     auth = tweepy.OAuthHandler(settings.APP_KEY, settings.APP_SECRET)
     auth.set_access_token(settings.ACCOUNT_KEY, settings.ACCOUNT_SECRET)
-    API = tweepy.API(auth)
-    return API
+    return tweepy.API(auth)
 
 
-def store_lastid(message):
-    """Stores last message id in settings.LASTMSGID_FILE file and in LASTID
-    variable.
+def store_lastid(messages):
+    """Journals processed @messages ids, checkpoint is stored in
+    settings.LASTMSGID_FILE every settings.CHECKPOINT_EVERY messages or
+    settings.CHECKPOINT_INTERVAL seconds.
     """
-    global LASTID
-    LASTID = message.id
-    with open(settings.LASTMSGID_FILE, 'w') as fobj:
-        fobj.writelines([str(message.id)])
-
+    CHECKPOINT.mark([msg.id for msg in messages])
 
 
 # Messages supported format
@@ -87,38 +102,88 @@ def store_lastid(message):
 #                                         #gameid
 
 def process_message(msg):
-    """Process incoming messages, passes message to playqueue server
-    using SOCKET, data sent is JSON."""
+    """Process incoming message, passes message to playqueue server."""
+    process_messages([msg])
+
+
+def process_messages(messages):
+    """Process incoming messages, passes messages to playqueue server
+    using SOCKET in a single write, data sent is a JSON line per
+    message."""
     global SOCKET
-    print '    %s: %s (%s)' % (msg.user.name, msg.text, msg.id)
-    if SOCKET:
-        SOCKET.send(simplejson.dumps({'user': msg.user.name,
-                                      'msg': msg.text}))
+    for msg in messages:
+        print '    %s: %s (%s)' % (msg.user.name, msg.text, msg.id)
+    if SOCKET and messages:
+        SOCKET.sendall(''.join(simplejson.dumps({'id': msg.id,
+                                                 'user': msg.user.name,
+                                                 'msg': msg.text}) + '\n'
+                                    for msg in messages))
+
+
+def read_results(timeout=0):
+    """Reads results sent back by playqueue server, waits up to @timeout
+    seconds for data. Busy results slow down polling. Returns list of
+    result dicts."""
+    global SOCKET, BUFFER, BUSY
+    results = []
+    if not SOCKET:
+        return results
+    while select([SOCKET], [], [], timeout)[0]:
+        data = SOCKET.recv(65536)
+        if not data: # server went away
+            break
+        lines = (BUFFER + data).split('\n')
+        BUFFER = lines.pop()
+        results.extend(simplejson.loads(line) for line in lines if line)
+        timeout = 0
+    for result in results:
+        print '    %s: %s' % (result.get('user'),
+                              result.get('result') or result.get('error'))
+        if result.get('busy'):
+            BUSY = True
+        REPLIES.result(result)
+    return results
 
 
 def get_messages():
-    """Gets messages sent to account and process them."""
-    global API, LASTID
+    """Gets messages sent to account and process them. Checks are more
+    frequent while people are playing."""
+    global LASTID, BUSY
     end = False
 
     while not end:
         try:
             last_id = str(LASTID) or 'no last id'
             print 'Checking for messages > ' + last_id
-            for page in tweepy.Cursor(API.mentions, since_id=LASTID).pages():
-                for msg in reversed(page):
-                    store_lastid(msg)
-                    process_message(msg)
+            try:
+                messages = [msg for msg in POLLER.fetch(LASTID)
+                                if not CHECKPOINT.is_done(msg.id)]
+            except Exception, e: # fetched again on next check
+                print 'Failed checking for messages: %s' % e
+                messages = []
+            # journaled before sending, a crash in between loses the
+            # moves instead of sending them twice on restart
+            store_lastid(messages)
+            process_messages(messages)
+            LASTID = CHECKPOINT.newest()
             print 'Checked for messages > ' + last_id
-            time.sleep(settings.CHECK_INTERVAL)
+            POLLER.scheduler.busy(BUSY)
+            BUSY = False
+            wait_until = time.time() + POLLER.next_interval(len(messages))
+            while time.time() < wait_until: # results stream in meanwhile
+                read_results(wait_until - time.time())
         except KeyboardInterrupt:
             print 'Interrupted'
             end = True
 
 def end():
-    """Closes socket"""
+    """Closes socket, stops replies and stores checkpoint"""
     if SOCKET:
         SOCKET.close()
+    if REPLIES:
+        REPLIES.end()
+    if CHECKPOINT:
+        CHECKPOINT.close()
 
 if __name__ == '__main__':
     parser = OptionParser(usage='%prog [options]')
@@ -127,6 +192,6 @@ if __name__ == '__main__':
                       default=True)
     options, args = parser.parse_args()
 
-    init(socket=options.nosocket)
+    init(use_socket=options.nosocket)
     get_messages()
     end()